@@ -0,0 +1,302 @@
+"""
+Backfill: scrobbles the past spins of a time range, e.g. when a new station account is set up.
+
+Spins are streamed from Spinitron a page at a time and go through the same rules, show filters,
+normalization and length check as live spins. Scrobbles are submitted in batches (of up to 50 for
+Last.fm) by a small pool of threads, through the shared HTTP client and so within its rate limits, while only a
+bounded number of batches is held in memory.
+
+Progress is saved in the state store: the start time of the oldest spin whose page of scrobbles
+has been submitted in full, and the outcome of every scrobble. Spins are read newest first, so
+running the same backfill again resumes with the spins that started before that time, and skips
+spins that were already scrobbled, by a backfill or by the live scrobbler. Page numbers are not
+saved, as the spins logged in the meantime would shift the pages.
+
+Last.fm ignores scrobbles more than 14 days old, so older spins are not fetched at all, whatever
+the sink.
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from colors import Colors
+from scrobble_queue import (
+    ACCEPTED,
+    DROPPED,
+    REJECTED,
+    RETRY,
+    AuthenticationFailed,
+    BatchRejected,
+    RetryLater,
+)
+from state import QUEUED, SCROBBLE
+from station import spin_to_scrobble
+
+log = logging.getLogger(__name__)
+
+# Oldest scrobble Last.fm accepts
+MAX_SCROBBLE_AGE = timedelta(days=14)
+
+
+class BackfillAborted(Exception):
+    """
+    Raised when a backfill cannot carry on, e.g. because Last.fm refused the account's credentials
+    or the daily scrobble limit was reached. Running it again later resumes where it stopped.
+    """
+
+
+class Backfill:
+    """
+    Backfill of one station's spins into one of its Last.fm accounts or other sinks
+    """
+
+    def __init__(
+        self,
+        station_name,
+        spinitron,
+        account,
+        rules,
+        store,
+        normalizer=None,
+        workers=4,
+        page_size=200,
+        clock=time.monotonic,
+    ):
+        """
+        Args:
+            station_name (str): Name of the station
+            spinitron (spinitron.SpinitronAPI): The station's Spinitron client
+            account (sinks.Sink): The Last.fm account or other sink to scrobble to
+            rules (rules.RuleSet): The station's rules
+            store (state.StateStore): Store the progress and scrobble outcomes are kept in
+            normalizer (normalize.Normalizer, optional): Cleans up spin metadata
+            workers (int, optional): Number of batches submitted at once
+            page_size (int, optional): Number of spins fetched from Spinitron per request
+            clock (callable, optional): Function returning a time in seconds, for throughput
+        """
+        self.station_name = station_name
+        self.spinitron = spinitron
+        self.account = account
+        self.rules = rules
+        self.store = store
+        self.normalizer = normalizer
+        self.workers = workers
+        self.page_size = page_size
+        self.clock = clock
+
+        # Number of spins by what happened to them
+        self.counts = {
+            "read": 0,
+            "filtered": 0,
+            "too_old": 0,
+            "done_before": 0,
+            ACCEPTED: 0,
+            REJECTED: 0,
+            DROPPED: 0,
+        }
+
+    def checkpoint_name(self, start, end):
+        """
+        Returns:
+            str: Name the backfill's progress is saved under
+        """
+        return f"backfill/{self.station_name}/{self.account.name}/{start.isoformat()}/{end.isoformat()}"
+
+    def scrobbles(self, spins, now):
+        """
+        Filters a page of spins and turns the remaining ones into scrobbles
+
+        Args:
+            spins (list): The spins
+            now (datetime): The current time, to skip spins Last.fm would ignore
+        Returns:
+            list: The scrobbles, oldest first
+        """
+        scrobbles = []
+        for spin in reversed(spins):
+            self.counts["read"] += 1
+            if parser.parse(spin["end"]) < now - MAX_SCROBBLE_AGE:
+                self.counts["too_old"] += 1
+                continue
+            playlist = self.spinitron.get_playlist(spin["playlist_id"])
+            persona = self.spinitron.get_persona(playlist["persona_id"])
+            if self.rules.evaluate(
+                spin, playlist, persona
+            ) is not None or not self.account.wants(playlist):
+                self.counts["filtered"] += 1
+                continue
+            if self.store.has_outcome(
+                self.station_name,
+                self.account.name,
+                spin["id"],
+                SCROBBLE,
+                # Dropped scrobbles were refused as invalid, and would be refused again
+                (QUEUED, ACCEPTED, REJECTED, DROPPED),
+            ):
+                self.counts["done_before"] += 1
+                continue
+            if self.normalizer is not None:
+                spin = self.normalizer.normalize(spin)
+            scrobble = spin_to_scrobble(spin)
+            if scrobble is None:
+                self.counts["filtered"] += 1
+                continue
+            scrobble.update(station=self.station_name, show=playlist.get("title"))
+            scrobbles.append(scrobble)
+        return scrobbles
+
+    def submit(self, batch):
+        """
+        Submits one batch, one scrobble at a time if Last.fm refuses the batch as a whole. Runs
+        on a worker thread.
+
+        Args:
+            batch (list): Up to 50 scrobbles
+        Returns:
+            list: Each scrobble and its outcome
+        Raises:
+            BackfillAborted: If the backfill cannot carry on
+        """
+        try:
+            outcomes = self.account.submit(batch)
+        except AuthenticationFailed as e:
+            raise BackfillAborted(f"{self.account.name} was refused: {e}") from e
+        except RetryLater as e:
+            raise BackfillAborted(f"could not submit scrobbles: {e}") from e
+        except BatchRejected:
+            if len(batch) == 1:
+                return [(batch[0], DROPPED)]
+            return [result for scrobble in batch for result in self.submit([scrobble])]
+        if RETRY in outcomes:
+            raise BackfillAborted(
+                f"{self.account.name} has reached Last.fm's daily scrobble limit"
+            )
+        return list(zip(batch, outcomes))
+
+    def run(self, start, end):
+        """
+        Scrobbles the spins that started within a time range, resuming a previous run of the
+        same backfill
+
+        Args:
+            start (datetime): Start of the range, timezone-aware
+            end (datetime): End of the range, timezone-aware
+        Raises:
+            BackfillAborted: If the backfill cannot carry on
+            requests.RequestException: If Spinitron could not be reached
+        """
+        name = self.checkpoint_name(start, end)
+        started = self.clock()
+        now = datetime.now(timezone.utc)
+        # Spins Last.fm would ignore are not even fetched, and spins logged while the backfill
+        # runs are left out so that they do not shift the pages being read
+        fetch_start = max(start, now - MAX_SCROBBLE_AGE - timedelta(days=1))
+        fetch_end = min(end, now)
+        resume = self.store.get_checkpoint(name)
+        if resume is not None:
+            log.info(
+                "Resuming with the spins that started before %s",
+                resume,
+                extra={"station": self.station_name, "account": self.account.name},
+            )
+            # A second later, in case the spins that started at the same time did not all fit
+            # in the last page; those that did are skipped as already scrobbled
+            fetch_end = min(fetch_end, parser.parse(resume) + timedelta(seconds=1))
+        # Batches being submitted, the page each belongs to, the number of unfinished batches of
+        # each page and the start of its oldest spin; the checkpoint only moves past pages with
+        # no unfinished batches left
+        pending = {}
+        unfinished = {}
+        oldest_start = {}
+        completed_through = 0
+
+        def finish(done):
+            nonlocal completed_through
+            for future in done:
+                page = pending.pop(future)
+                for scrobble, outcome in future.result():
+                    self.counts[outcome] += 1
+                    self.store.record_outcome(
+                        self.station_name,
+                        self.account.name,
+                        scrobble["spin_id"],
+                        SCROBBLE,
+                        outcome,
+                    )
+                unfinished[page] -= 1
+            while unfinished.get(completed_through + 1) == 0:
+                del unfinished[completed_through + 1]
+                completed_through += 1
+                self.store.set_checkpoint(name, oldest_start.pop(completed_through))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for page, spins in self.spinitron.iter_spins(
+                    fetch_start, fetch_end, page_size=self.page_size
+                ):
+                    scrobbles = self.scrobbles(spins, now)
+                    oldest_start[page] = spins[-1]["start"]
+                    # Held at one until every batch of the page has been handed out
+                    unfinished[page] = 1
+                    batch_size = self.account.batch_size
+                    for i in range(0, len(scrobbles), batch_size):
+                        # Hold at most two batches per worker in memory
+                        while len(pending) >= 2 * self.workers:
+                            finish(wait(pending, return_when=FIRST_COMPLETED).done)
+                        future = pool.submit(self.submit, scrobbles[i : i + batch_size])
+                        pending[future] = page
+                        unfinished[page] += 1
+                    unfinished[page] -= 1
+                    finish([])
+                    self.print_progress(page, started)
+                while pending:
+                    finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            except BaseException:
+                # Let the submissions in progress finish so that their outcomes are recorded.
+                # Pages with cancelled batches stay unfinished and are read again on resume.
+                for future in pending:
+                    future.cancel()
+                for future in [future for future in pending if future.cancelled()]:
+                    del pending[future]
+                for future in wait(pending).done:
+                    if future.exception() is None:
+                        finish([future])
+                raise
+        self.print_progress(None, started)
+
+    def throughput(self, started):
+        """
+        Returns:
+            float: Spins read per second since the backfill started
+        """
+        elapsed = self.clock() - started
+        return self.counts["read"] / elapsed if elapsed > 0 else 0.0
+
+    def print_progress(self, page, started):
+        """
+        Prints the counts so far, after a page or (with page None) at the end
+        """
+        counts = self.counts
+        throughput = self.throughput(started)
+        text = (
+            f"{counts['read']} spins read, {counts[ACCEPTED]} scrobbled, {counts[REJECTED]} ignored by Last.fm, "
+            f"{counts['filtered']} filtered out, {counts['too_old']} too old, {counts['done_before']} already scrobbled "
+            f"({throughput:.1f} spins/s)"
+        )
+        fields = {
+            "station": self.station_name,
+            "account": self.account.name,
+            "page": page,
+            "spins_per_second": round(throughput, 1),
+            **counts,
+        }
+        if page is None:
+            log.info(
+                "Backfill complete: %s", text, extra={**fields, "color": Colors.GREEN}
+            )
+        else:
+            log.info("Page %d: %s", page, text, extra=fields)
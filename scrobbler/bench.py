@@ -0,0 +1,331 @@
+"""
+Microbenchmarks of the work the scrobbler does on every poll and scrobble, run on the payloads of
+a recorded broadcast day (see standin.py) or a synthesized one (see replay.py):
+
+    decode     JSON decoding of a /spins poll response (5 spins with their playlists)
+    timestamp  parsing of one Spinitron timestamp with dateutil
+    filter     the rules and show filters applied to one spin
+    reconcile  comparing one poll's window of 5 spins against the index of handled spins
+    normalize  the text clean-up of one spin
+    scrobble   building the scrobble of one finished spin
+    sign_np    signing one Now Playing request
+    sign_batch signing one scrobble request of 50 scrobbles
+    xml        parsing Last.fm's response to a scrobble request of 50 scrobbles
+
+Each benchmark runs over every payload of the day, repeatedly, and the fastest repetition is
+reported as the time per operation. Run from the scrobbler folder:
+
+    python bench.py                          # benchmarks a synthesized day
+    python bench.py day.json --save base.json
+    python bench.py day.json --baseline base.json
+
+With --baseline, benchmarks more than --threshold times slower than the saved results are
+reported as regressions and the exit status is 1. Only compare results from the same machine.
+"""
+
+import argparse
+import copy
+import json
+import sys
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from lastfm import LastfmAccount
+from normalize import Normalizer
+from reconcile import SpinIndex
+from replay import synthesize_day
+from rules import RuleSet
+from scrobble_queue import MAX_BATCH_SIZE
+from spinitron import SPIN_FIELDS
+from standin import load_recording
+from station import spin_to_scrobble
+
+
+def poll_payloads(recording, count=5):
+    """
+    Builds the bodies of the /spins responses polls would have received over the day
+
+    Args:
+        recording (dict): The recording
+        count (int, optional): Number of spins per response, as POLL_SPIN_COUNT
+    Returns:
+        list: The response bodies, as bytes
+    """
+    playlists = {playlist["id"]: playlist for playlist in recording["playlists"]}
+    spins = sorted(recording["spins"], key=lambda spin: (spin["start"], spin["id"]))
+    bodies = []
+    for newest in range(len(spins)):
+        items = []
+        for spin in reversed(spins[max(0, newest - count + 1) : newest + 1]):
+            item = {key: spin[key] for key in SPIN_FIELDS if key in spin}
+            item["playlist"] = playlists.get(spin["playlist_id"])
+            items.append(item)
+        bodies.append(json.dumps({"items": items}).encode("utf-8"))
+    return bodies
+
+
+def scrobble_response(scrobbles):
+    """
+    Builds Last.fm's response to a track.scrobble request that accepted every scrobble
+
+    Args:
+        scrobbles (list): The scrobbles submitted
+    Returns:
+        bytes: The XML response body
+    """
+    root = ET.Element("lfm", status="ok")
+    element = ET.SubElement(
+        root, "scrobbles", accepted=str(len(scrobbles)), ignored="0"
+    )
+    for scrobble in scrobbles:
+        item = ET.SubElement(element, "scrobble")
+        ET.SubElement(item, "track", corrected="0").text = scrobble["track"]
+        ET.SubElement(item, "artist", corrected="0").text = scrobble["artist"]
+        ET.SubElement(item, "album", corrected="0").text = scrobble["album"]
+        ET.SubElement(item, "timestamp").text = str(scrobble["timestamp"])
+        ET.SubElement(item, "ignoredMessage", code="0")
+    return ET.tostring(root, encoding="utf-8")
+
+
+def batch_params(scrobbles):
+    """
+    Returns:
+        dict: The parameters of a track.scrobble request, as lastfm.request_scrobbles() builds
+            them before signing
+    """
+    params = {"method": "track.scrobble", "api_key": "bench-key", "sk": "bench-sk"}
+    for i, scrobble in enumerate(scrobbles):
+        params[f"artist[{i}]"] = scrobble["artist"]
+        params[f"track[{i}]"] = scrobble["track"]
+        params[f"timestamp[{i}]"] = scrobble["timestamp"]
+        params[f"album[{i}]"] = scrobble["album"]
+        params[f"duration[{i}]"] = scrobble["duration"]
+    return params
+
+
+def make_benchmarks(recording):
+    """
+    Prepares the payloads and the function of each benchmark
+
+    Args:
+        recording (dict): The recording
+    Returns:
+        dict: The benchmarks by name, each a function taking no arguments and the number of
+            operations one call of it performs
+    """
+    playlists = {playlist["id"]: playlist for playlist in recording["playlists"]}
+    personas = {persona["id"]: persona for persona in recording["personas"]}
+    spins = recording["spins"]
+    details = []
+    for spin in spins:
+        playlist = playlists[spin["playlist_id"]]
+        details.append((spin, playlist, personas[playlist["persona_id"]]))
+    timestamps = [spin[key] for spin in spins for key in ("start", "end")]
+    bodies = poll_payloads(recording)
+    # Each poll's window, with the index as it stood when the poll was made: every spin up to
+    # the newest one of the window
+    windows = []
+    spin_index = SpinIndex()
+    for spin, body in zip(
+        sorted(spins, key=lambda spin: (spin["start"], spin["id"])), bodies
+    ):
+        spin_index.add(spin)
+        windows.append((json.loads(body)["items"], copy.deepcopy(spin_index)))
+    scrobbles = [
+        scrobble for scrobble in map(spin_to_scrobble, spins) if scrobble is not None
+    ]
+    batches = [
+        scrobbles[i : i + MAX_BATCH_SIZE]
+        for i in range(0, len(scrobbles), MAX_BATCH_SIZE)
+    ]
+    batches = [batch for batch in batches if len(batch) == MAX_BATCH_SIZE] or batches
+    signed_batches = [batch_params(batch) for batch in batches]
+    responses = [scrobble_response(batch) for batch in batches]
+    now_playing = [
+        {
+            "method": "track.updateNowPlaying",
+            "artist": spin["artist"],
+            "track": spin["song"],
+            "album": spin["release"],
+            "duration": spin["duration"],
+            "api_key": "bench-key",
+            "sk": "bench-sk",
+        }
+        for spin in spins
+    ]
+    account = LastfmAccount("bench", "bench-key", "bench-secret", client=None)
+    rules = RuleSet.from_hours(0, 24)
+    normalizer = Normalizer()
+
+    def decode():
+        for body in bodies:
+            json.loads(body)
+
+    def timestamp():
+        for value in timestamps:
+            parser.parse(value)
+
+    def filter_spins():
+        for spin, playlist, persona in details:
+            rules.evaluate(spin, playlist, persona)
+            account.wants(playlist)
+
+    def reconcile():
+        for window, window_index in windows:
+            window_index.compare(window)
+
+    def normalize():
+        for spin in spins:
+            normalizer.normalize(spin)
+
+    def scrobble():
+        for spin in spins:
+            spin_to_scrobble(spin)
+
+    def sign_np():
+        for params in now_playing:
+            account.generate_signature(params)
+
+    def sign_batch():
+        for params in signed_batches:
+            account.generate_signature(params)
+
+    def xml():
+        for response in responses:
+            ET.fromstring(response).findall("./scrobbles/scrobble")
+
+    return {
+        "decode": (decode, len(bodies)),
+        "timestamp": (timestamp, len(timestamps)),
+        "filter": (filter_spins, len(details)),
+        "reconcile": (reconcile, len(windows)),
+        "normalize": (normalize, len(spins)),
+        "scrobble": (scrobble, len(spins)),
+        "sign_np": (sign_np, len(now_playing)),
+        "sign_batch": (sign_batch, len(signed_batches)),
+        "xml": (xml, len(responses)),
+    }
+
+
+def measure(function, operations, repeat=5, min_time=0.2):
+    """
+    Times a benchmark
+
+    Args:
+        function (callable): The benchmark
+        operations (int): Number of operations one call performs
+        repeat (int, optional): Number of repetitions, of which the fastest is kept
+        min_time (float, optional): Seconds each repetition runs for at least
+    Returns:
+        float: Seconds per operation
+    """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        started = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - started
+        per_operation = elapsed / (calls * operations)
+        best = per_operation if best is None else min(best, per_operation)
+    return best
+
+
+def run_benchmarks(recording, names=None, repeat=5, min_time=0.2):
+    """
+    Runs the benchmarks
+
+    Args:
+        recording (dict): The recording whose payloads are used
+        names (list, optional): The benchmarks to run. All of them if omitted
+        repeat (int, optional): Number of repetitions of each benchmark
+        min_time (float, optional): Seconds each repetition runs for at least
+    Returns:
+        dict: Seconds per operation, by benchmark
+    """
+    benchmarks = make_benchmarks(recording)
+    return {
+        name: measure(function, operations, repeat, min_time)
+        for name, (function, operations) in benchmarks.items()
+        if names is None or name in names
+    }
+
+
+def print_results(results, baseline=None, threshold=1.25):
+    """
+    Prints the time per operation of each benchmark, compared with a baseline if given
+
+    Returns:
+        list: Names of the benchmarks more than threshold times slower than the baseline
+    """
+    regressions = []
+    for name, seconds in results.items():
+        line = f"{name:<11}{1e6 * seconds:>10.2f} us/op {1 / seconds:>12,.0f} ops/s"
+        if baseline and name in baseline:
+            ratio = seconds / baseline[name]
+            line += f"   {ratio:5.2f}x baseline"
+            if ratio > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Benchmark the per-poll and per-scrobble work on a recorded day"
+    )
+    cli_parser.add_argument(
+        "recording", nargs="?", help="Recording to take payloads from (see standin.py)"
+    )
+    cli_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the synthesized day"
+    )
+    cli_parser.add_argument(
+        "--only", nargs="+", metavar="NAME", help="Run only these benchmarks"
+    )
+    cli_parser.add_argument("--repeat", type=int, default=5)
+    cli_parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="Seconds each repetition runs for at least",
+    )
+    cli_parser.add_argument(
+        "--save", metavar="PATH", help="Write the results to PATH as JSON"
+    )
+    cli_parser.add_argument(
+        "--baseline", metavar="PATH", help="Compare with results saved by --save"
+    )
+    cli_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="How many times slower than the baseline counts as a regression",
+    )
+    args = cli_parser.parse_args()
+
+    if args.recording:
+        day = load_recording(args.recording)
+    else:
+        day = synthesize_day(
+            (datetime.now(timezone.utc) - timedelta(days=1)).date(), args.seed
+        )
+    baseline_results = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            baseline_results = json.load(baseline_file)
+
+    bench_results = run_benchmarks(day, args.only, args.repeat, args.min_time)
+    regressed = print_results(bench_results, baseline_results, args.threshold)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as save_file:
+            json.dump(bench_results, save_file, indent=2)
+    if regressed:
+        print(f"Slower than the baseline: {', '.join(regressed)}")
+        sys.exit(1)
@@ -0,0 +1,272 @@
+"""
+Small caches used to avoid re-fetching data that rarely changes, such as the Spinitron playlist
+and persona behind the current spin (which only change when a new show starts), kept in memory,
+or Last.fm track corrections, kept on disk so that they survive restarts.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded, thread-safe LRU cache whose entries also expire a fixed number of seconds after they
+    were stored. Hits and misses are counted so the cache's effectiveness can be reported.
+    """
+
+    def __init__(self, maxsize=128, ttl=1800, clock=time.monotonic):
+        """
+        Args:
+            maxsize (int, optional): Maximum number of entries kept. The least recently used entry
+                is evicted once this is exceeded
+            ttl (float, optional): Seconds an entry stays valid after being stored
+            clock (callable, optional): Function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Looks up a key, counting the lookup as a hit or a miss
+
+        Args:
+            key (hashable): The key to look up
+            default (optional): Value returned if the key is absent or expired
+        Returns:
+            The cached value, or default
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """
+        Looks up a key without counting the lookup or refreshing its recency
+
+        Args:
+            key (hashable): The key to look up
+            default (optional): Value returned if the key is absent or expired
+        Returns:
+            The cached value, or default
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > self._clock():
+                return entry[1]
+            return default
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full
+
+        Args:
+            key (hashable): The key to store the value under
+            value: The value to store
+        """
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached value for a key, calling fetch() and caching its result on a miss
+
+        Args:
+            key (hashable): The key to look up
+            fetch (callable): Zero-argument function producing the value on a miss. Exceptions
+                it raises are propagated and nothing is cached
+        Returns:
+            The cached or freshly fetched value
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fetch()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Removes a single key from the cache, if present
+
+        Args:
+            key (hashable): The key to remove
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry from the cache (counters are kept)
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def hit_ratio(self):
+        """
+        Returns:
+            float: Fraction of lookups that were hits, or 0.0 if there have been no lookups
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of the cache's counters
+        """
+        return (
+            f"{len(self)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses "
+            f"({100 * self.hit_ratio():.1f}% hit ratio)"
+        )
+
+
+class DiskCache(TTLCache):
+    """
+    TTLCache kept in an SQLite file instead of memory. Keys are tuples of JSON values (e.g.
+    strings) and values must be JSON serializable. Entries expire by wall-clock time, since they
+    outlive the process.
+    """
+
+    def __init__(self, path, maxsize=5000, ttl=30 * 86400, clock=time.time):
+        """
+        Args:
+            path (str): Location of the cache file, created if it does not exist
+            maxsize (int, optional): Maximum number of entries kept. The least recently used
+                entries are evicted once this is exceeded
+            ttl (float, optional): Seconds an entry stays valid after being stored
+            clock (callable, optional): Function returning the current UNIX time
+        """
+        super().__init__(maxsize=maxsize, ttl=ttl, clock=clock)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires REAL NOT NULL, used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_by_use ON entries (used)"
+            )
+            self._db.execute("DELETE FROM entries WHERE expires <= ?", (clock(),))
+
+    @staticmethod
+    def _encode(key):
+        return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _lookup(self, key):
+        row = self._db.execute(
+            "SELECT value, expires FROM entries WHERE key = ?", (self._encode(key),)
+        ).fetchone()
+        if row is None or row[1] <= self._clock():
+            return _MISSING
+        return json.loads(row[0])
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._db.execute(
+                "UPDATE entries SET used = ? WHERE key = ?",
+                (self._clock(), self._encode(key)),
+            )
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            return default if value is _MISSING else value
+
+    def set(self, key, value):
+        now = self._clock()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (self._encode(key), json.dumps(value), now + self.ttl, now),
+            )
+            self._db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def invalidate(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (self._encode(key),))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+
+
+class RecentIds:
+    """
+    Set of the most recently added ids, bounded to a fixed size. Used to make sure a spin is never
+    processed twice without remembering every spin forever.
+    """
+
+    def __init__(self, maxlen=1000):
+        """
+        Args:
+            maxlen (int, optional): Number of ids remembered. The oldest id is forgotten once this
+                is exceeded
+        """
+        self._order = deque()
+        self._ids = set()
+        self.maxlen = maxlen
+
+    def __contains__(self, item):
+        return item in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, item):
+        """
+        Remembers an id
+
+        Args:
+            item (hashable): The id
+        """
+        if item in self._ids:
+            return
+        self._order.append(item)
+        self._ids.add(item)
+        while len(self._order) > self.maxlen:
+            self._ids.discard(self._order.popleft())
@@ -0,0 +1,88 @@
+"""
+Source of time for the scheduler, the stations and the scrobble worker.
+
+Everything that reads the time or waits goes through a Clock, so that a recorded broadcast day
+can be replayed against the local stand-in server at many times real speed (see replay.py)
+without changing the polling code.
+"""
+
+import time
+from datetime import datetime, timezone
+
+
+class Clock:
+    """
+    The real time
+    """
+
+    # Clock seconds that pass per real second
+    speed = 1.0
+
+    def monotonic(self):
+        """
+        Returns:
+            float: Seconds on a clock that never goes backwards, for measuring intervals
+        """
+        return time.monotonic()
+
+    def time(self):
+        """
+        Returns:
+            float: The current UNIX time
+        """
+        return time.time()
+
+    def now(self):
+        """
+        Returns:
+            datetime: The current time, in UTC
+        """
+        return datetime.now(timezone.utc)
+
+    def real_seconds(self, seconds):
+        """
+        Converts a span of clock time to real time, for timeouts of blocking waits
+
+        Args:
+            seconds (float): Seconds of clock time
+        Returns:
+            float: Seconds of real time
+        """
+        return seconds / self.speed
+
+    def sleep(self, seconds):
+        """
+        Blocks for a span of clock time
+
+        Args:
+            seconds (float): Seconds of clock time
+        """
+        time.sleep(self.real_seconds(seconds))
+
+
+class WarpedClock(Clock):
+    """
+    A clock that starts at a given point in time and runs faster than real time
+    """
+
+    def __init__(self, start, speed):
+        """
+        Args:
+            start (float): UNIX time the clock starts at
+            speed (float): Clock seconds that pass per real second, e.g. 1000
+        """
+        self.start = start
+        self.speed = speed
+        self._origin = time.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self._origin) * self.speed
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def now(self):
+        return datetime.fromtimestamp(self.time(), timezone.utc)
+
+
+SYSTEM_CLOCK = Clock()
@@ -0,0 +1,18 @@
+"""
+ANSI color codes used to make terminal log output easier to read
+"""
+
+
+class Colors:
+    """
+    Pretty terminal colors for logging
+    """
+
+    RED = "\033[91m"
+    GREEN = "\033[92m"
+    YELLOW = "\033[93m"
+    BLUE = "\033[94m"
+    MAGENTA = "\033[95m"
+    CYAN = "\033[96m"
+    WHITE = "\033[97m"
+    RESET = "\033[0m"
@@ -0,0 +1,543 @@
+"""
+Loading of the stations and Last.fm accounts the scrobbler runs for.
+
+By default a single station is configured from the SPINITRON_API_KEY, LASTFM_API_KEY,
+LASTFM_API_SECRET and LASTFM_SESSION_KEY values in /env/.env, exactly as before. To run several
+stations, or several Last.fm accounts per station (e.g. a station account plus per-show
+accounts), list them in /env/stations.json instead:
+
+    {
+      "stations": [
+        {
+          "name": "WBOR",
+          "spinitron_api_key": "...",
+          "accounts": [
+            {"name": "wbor", "session_key": "..."},
+            {"name": "wbor-jazz", "session_key": "...", "shows": ["Jazz Hour"]}
+          ]
+        }
+      ]
+    }
+
+Accounts use LASTFM_API_KEY and LASTFM_API_SECRET from .env unless they set their own
+"api_key" and "api_secret". A station may also set its own "start_hour" and "end_hour", or its
+own rule file (see rules.py) under "rules".
+
+Besides Last.fm accounts, a station's "accounts" may list the other sinks of sinks.py, by "type":
+
+    {"name": "wbor-lb", "type": "listenbrainz", "token": "..."}
+    {"name": "archive", "type": "archive", "path": "/env/archive-wbor.jsonl.gz"}
+
+With the single station of .env, LISTENBRAINZ_TOKEN adds a ListenBrainz sink. ARCHIVE_PATH adds
+an archive to every station that does not list one.
+
+Everything read from these files, schedule.json and the rule files is held in a ConfigSnapshot.
+While the scrobbler runs, a ConfigWatcher checks the files' modification times and loads a new
+snapshot when one of them changes. A snapshot that fails to load is rejected and the previous
+one stays in use.
+"""
+
+import json
+import logging
+import os
+from dataclasses import dataclass, replace
+
+from dotenv import dotenv_values
+
+from rules import RuleError, load_rules
+
+log = logging.getLogger(__name__)
+
+DEFAULT_NAME = "default"
+
+# Types of account, one per kind of sink (see sinks.py)
+LASTFM = "lastfm"
+LISTENBRAINZ = "listenbrainz"
+ARCHIVE = "archive"
+ACCOUNT_TYPES = (LASTFM, LISTENBRAINZ, ARCHIVE)
+
+
+class ConfigError(Exception):
+    """
+    Raised when the configuration is missing values or is malformed
+    """
+
+
+@dataclass(frozen=True)
+class AccountConfig:
+    """
+    Credentials of one Last.fm account, or the settings of another sink
+    """
+
+    name: str
+    api_key: str
+    api_secret: str
+    session_key: str
+    shows: tuple = None
+    # One of ACCOUNT_TYPES
+    kind: str = LASTFM
+    # ListenBrainz user token
+    token: str = None
+    # Location of an archive
+    path: str = None
+
+
+@dataclass(frozen=True)
+class StationConfig:
+    """
+    One Spinitron station and the Last.fm accounts its spins are sent to
+    """
+
+    name: str
+    spinitron_api_key: str
+    accounts: tuple
+    start_hour: int
+    end_hour: int
+    rules: object = None
+    # Location of the rule file the station uses, if any
+    rules_path: str = None
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    The stations and accounts loaded from the configuration files at one point in time. A
+    snapshot is never changed; a new one replaces it when the files change.
+    """
+
+    stations: tuple
+    start_hour: int
+    end_hour: int
+    # Every file the snapshot was built from, including optional ones that do not exist yet
+    files: tuple = ()
+    # Incremented by each reload, for logging and metrics
+    version: int = 1
+
+
+def is_placeholder(value):
+    """
+    Checks whether a configuration value is missing or left as its example value (all x's)
+
+    Args:
+        value (str): The value
+    Returns:
+        bool: True if the value has not actually been set
+    """
+    return not value or all(char == "x" for char in value.lower())
+
+
+def journal_path(base_path, station, account):
+    """
+    Works out where an account's scrobble journal is kept. The single account configured from
+    .env keeps using base_path itself, so that existing journals are picked up.
+
+    Args:
+        base_path (str): The configured journal path, e.g. /env/scrobble_queue.jsonl
+        station (StationConfig): The station the account belongs to
+        account (AccountConfig): The account
+    Returns:
+        str: The path of the account's journal
+    """
+    if station.name == DEFAULT_NAME and account.name == DEFAULT_NAME:
+        return base_path
+    root, extension = os.path.splitext(base_path)
+    return f"{root}-{station.name}-{account.name}{extension}"
+
+
+def load_schedule(schedule_path):
+    """
+    Reads the default scrobbling hours from schedule.json
+
+    Args:
+        schedule_path (str): Location of schedule.json
+    Returns:
+        tuple: The start_hour and end_hour (UTC)
+    Raises:
+        ConfigError: If the file cannot be read or the hours are not whole numbers from 0 to 24
+    """
+    try:
+        with open(schedule_path, "r") as schedule_file:
+            schedule = json.load(schedule_file)
+        hours = (schedule.get("start_hour"), schedule.get("end_hour"))
+    except (OSError, ValueError, AttributeError) as e:
+        raise ConfigError(f"Could not read {schedule_path}: {e}") from e
+    _check_hours(hours, f"in {schedule_path}")
+    return hours
+
+
+def _check_hours(hours, where):
+    """
+    Raises:
+        ConfigError: If a start_hour or end_hour is not a whole number from 0 to 24
+    """
+    for hour in hours:
+        if not isinstance(hour, int) or isinstance(hour, bool) or not 0 <= hour <= 24:
+            raise ConfigError(
+                f"start_hour and end_hour {where} must be whole numbers from 0 to 24, not {hour!r}"
+            )
+
+
+def _load_rules(path, start_hour, end_hour):
+    try:
+        return load_rules(path, start_hour, end_hour)
+    except RuleError as e:
+        raise ConfigError(str(e)) from e
+    except (ValueError, TypeError) as e:
+        raise ConfigError(f"Invalid rules in {path or 'schedule.json'}: {e}") from e
+
+
+def load_stations(
+    stations_path,
+    start_hour,
+    end_hour,
+    require_session=True,
+    rules_path=None,
+    env=None,
+):
+    """
+    Loads the stations to run, from stations_path if it exists, otherwise from the environment
+
+    Args:
+        stations_path (str): Location of the optional stations.json file
+        start_hour (int): Default hour (UTC) to start scrobbling at
+        end_hour (int): Default hour (UTC) to stop scrobbling at
+        require_session (bool, optional): Whether accounts must have a session key
+        rules_path (str, optional): Location of the optional rule file stations use unless they
+            name their own. Without one, start_hour and end_hour apply
+        env (mapping, optional): Values of the .env settings. The environment by default
+    Returns:
+        list: The StationConfig of every station
+    Raises:
+        ConfigError: If a required value is missing or the file is malformed
+    """
+    env = os.environ if env is None else env
+    api_key = env.get("LASTFM_API_KEY")
+    api_secret = env.get("LASTFM_API_SECRET")
+
+    if not os.path.exists(stations_path):
+        if any(
+            is_placeholder(value)
+            for value in (api_key, api_secret, env.get("SPINITRON_API_KEY"))
+        ):
+            raise ConfigError(
+                'Please make sure you have set your LASTFM_API_KEY, LASTFM_API_SECRET, and SPINITRON_API_KEY values in the ".env" file.'
+            )
+        session_key = env.get("LASTFM_SESSION_KEY")
+        if require_session and is_placeholder(session_key):
+            raise ConfigError(
+                'Please make sure you have set your LASTFM_SESSION_KEY value in the ".env" file. If you have not yet established a web service session, please run the script in setup mode using the --setup argument.'
+            )
+        accounts = [AccountConfig(DEFAULT_NAME, api_key, api_secret, session_key)]
+        if not is_placeholder(env.get("LISTENBRAINZ_TOKEN")):
+            accounts.append(
+                AccountConfig(
+                    LISTENBRAINZ,
+                    None,
+                    None,
+                    None,
+                    kind=LISTENBRAINZ,
+                    token=env.get("LISTENBRAINZ_TOKEN"),
+                )
+            )
+        return _add_archive(
+            [
+                StationConfig(
+                    DEFAULT_NAME,
+                    env.get("SPINITRON_API_KEY"),
+                    tuple(accounts),
+                    start_hour,
+                    end_hour,
+                    _load_rules(rules_path, start_hour, end_hour),
+                    rules_path,
+                )
+            ],
+            env.get("ARCHIVE_PATH"),
+        )
+
+    try:
+        with open(stations_path, "r") as stations_file:
+            data = json.load(stations_file)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"Could not read {stations_path}: {e}") from e
+
+    if not isinstance(data, dict) or not isinstance(data.get("stations", []), list):
+        raise ConfigError(
+            f"{stations_path} must hold an object with a list of stations"
+        )
+    stations = []
+    names = set()
+    for station in data.get("stations", []):
+        station_accounts = (
+            station.get("accounts", []) if isinstance(station, dict) else None
+        )
+        if not isinstance(station_accounts, list) or not all(
+            isinstance(account, dict) for account in station_accounts
+        ):
+            raise ConfigError(
+                f"Each station in {stations_path} must be an object with a list of account objects, not {station!r}"
+            )
+        try:
+            accounts = tuple(
+                AccountConfig(
+                    name=account["name"],
+                    api_key=account.get("api_key", api_key),
+                    api_secret=account.get("api_secret", api_secret),
+                    session_key=account.get("session_key"),
+                    shows=tuple(account["shows"]) if account.get("shows") else None,
+                    kind=account.get("type", LASTFM),
+                    token=account.get("token"),
+                    path=account.get("path"),
+                )
+                for account in station["accounts"]
+            )
+            station_start = station.get("start_hour", start_hour)
+            station_end = station.get("end_hour", end_hour)
+            _check_hours(
+                (station_start, station_end),
+                f"of station {station.get('name')} in {stations_path}",
+            )
+            station_rules_path = station.get("rules", rules_path)
+            config = StationConfig(
+                name=station["name"],
+                spinitron_api_key=station["spinitron_api_key"],
+                accounts=accounts,
+                start_hour=station_start,
+                end_hour=station_end,
+                rules=_load_rules(station_rules_path, station_start, station_end),
+                rules_path=station_rules_path,
+            )
+        except (KeyError, TypeError) as e:
+            raise ConfigError(
+                f"Station entry in {stations_path} is missing a value: {e}"
+            ) from e
+
+        if config.name in names:
+            raise ConfigError(
+                f"Station {config.name} is listed twice in {stations_path}"
+            )
+        names.add(config.name)
+        if is_placeholder(config.spinitron_api_key):
+            raise ConfigError(f"Station {config.name} has no spinitron_api_key")
+        account_names = set()
+        for account in accounts:
+            if account.name in account_names:
+                raise ConfigError(
+                    f"Account {account.name} is listed twice for station {config.name}"
+                )
+            account_names.add(account.name)
+            _check_account(account, config.name, require_session)
+        stations.append(config)
+
+    if not stations:
+        raise ConfigError(f"No stations are listed in {stations_path}")
+    return _add_archive(stations, env.get("ARCHIVE_PATH"))
+
+
+def _check_account(account, station_name, require_session):
+    """
+    Raises:
+        ConfigError: If the account lacks a value its type needs
+    """
+    if account.kind not in ACCOUNT_TYPES:
+        raise ConfigError(
+            f"Account {account.name} of station {station_name} has an unknown type {account.kind!r}, expected one of {', '.join(ACCOUNT_TYPES)}"
+        )
+    if account.kind == LISTENBRAINZ:
+        if is_placeholder(account.token):
+            raise ConfigError(
+                f"Account {account.name} of station {station_name} has no ListenBrainz token"
+            )
+    elif account.kind == ARCHIVE:
+        if not account.path:
+            raise ConfigError(
+                f"Account {account.name} of station {station_name} has no archive path"
+            )
+    elif is_placeholder(account.api_key) or is_placeholder(account.api_secret):
+        raise ConfigError(
+            f"Account {account.name} of station {station_name} has no Last.fm API key and secret"
+        )
+    elif require_session and is_placeholder(account.session_key):
+        raise ConfigError(
+            f"Account {account.name} of station {station_name} has no session_key"
+        )
+
+
+def _add_archive(stations, archive_path):
+    """
+    Adds an archive at archive_path to every station that does not list an archive itself
+
+    Returns:
+        list: The stations
+    """
+    if not archive_path:
+        return stations
+    return [
+        (
+            station
+            if any(account.kind == ARCHIVE for account in station.accounts)
+            else replace(
+                station,
+                accounts=station.accounts
+                + (
+                    AccountConfig(
+                        ARCHIVE, None, None, None, kind=ARCHIVE, path=archive_path
+                    ),
+                ),
+            )
+        )
+        for station in stations
+    ]
+
+
+def load_config(
+    env_path,
+    schedule_path,
+    stations_path,
+    rules_path=None,
+    require_session=True,
+    base_env=None,
+    version=1,
+):
+    """
+    Loads a snapshot of the configuration
+
+    Args:
+        env_path (str): Location of the .env file
+        schedule_path (str): Location of schedule.json
+        stations_path (str): Location of the optional stations.json file
+        rules_path (str, optional): Location of the optional default rule file
+        require_session (bool, optional): Whether accounts must have a session key
+        base_env (mapping, optional): Environment variables set outside the .env file, which
+            take precedence over it. The environment by default
+        version (int, optional): Version number of the snapshot
+    Returns:
+        ConfigSnapshot: The snapshot
+    Raises:
+        ConfigError: If a required value is missing or a file is malformed
+    """
+    env = {
+        **dotenv_values(env_path),
+        **(os.environ if base_env is None else base_env),
+    }
+    start_hour, end_hour = load_schedule(schedule_path)
+    stations = tuple(
+        load_stations(
+            stations_path,
+            start_hour,
+            end_hour,
+            require_session=require_session,
+            rules_path=rules_path,
+            env=env,
+        )
+    )
+    files = [env_path, schedule_path, stations_path, rules_path]
+    files += [station.rules_path for station in stations]
+    return ConfigSnapshot(
+        stations=stations,
+        start_hour=start_hour,
+        end_hour=end_hour,
+        files=tuple(dict.fromkeys(path for path in files if path)),
+        version=version,
+    )
+
+
+def file_signature(path):
+    """
+    Returns:
+        tuple: The modification time and size of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigWatcher:
+    """
+    Checks the configuration files for changes on a scheduler, and replaces the snapshot when
+    they change. Since the check runs on the same scheduler as the stations, a poll only ever
+    sees one snapshot.
+    """
+
+    def __init__(self, snapshot, load, on_change, scheduler, interval=5):
+        """
+        Args:
+            snapshot (ConfigSnapshot): The configuration in use
+            load (callable): Function taking a version number and returning a new
+                ConfigSnapshot, or raising ConfigError
+            on_change (callable): Function called with the old and new snapshot once a new one
+                has loaded
+            scheduler (scheduler.Scheduler): Scheduler to run the checks on
+            interval (float, optional): Seconds between checks
+        """
+        self.snapshot = snapshot
+        self.load = load
+        self.on_change = on_change
+        self.scheduler = scheduler
+        self.interval = interval
+        # Signatures of the files the snapshot in use was loaded from, and of the last files that
+        # were rejected, so that a rejected change is not loaded again until the files change
+        self.signatures = self._signatures(snapshot.files)
+        self.rejected = None
+
+        # Number of reloads by outcome, for metrics
+        self.reloads = {"applied": 0, "rejected": 0}
+
+    @staticmethod
+    def _signatures(files):
+        return {path: file_signature(path) for path in files}
+
+    def start(self):
+        """
+        Schedules the first check
+        """
+        self.scheduler.call_later(self.interval, self.check, name="config-watch")
+
+    def check(self):
+        """
+        Scheduled task: reloads the configuration if one of its files has changed, then
+        schedules the next check
+        """
+        try:
+            # Taken before loading, so that a change made while loading is seen next time
+            signatures = self._signatures(self.snapshot.files)
+            if signatures != self.signatures and signatures != self.rejected:
+                self.reload(signatures)
+        finally:
+            self.scheduler.call_later(self.interval, self.check, name="config-watch")
+
+    def reload(self, signatures=None):
+        """
+        Loads a new snapshot and switches to it, or keeps the current one if it fails to load
+
+        Args:
+            signatures (dict, optional): Signatures of the current snapshot's files, taken before
+                loading. Taken now if omitted
+        Returns:
+            bool: True if the new snapshot is in use
+        """
+        if signatures is None:
+            signatures = self._signatures(self.snapshot.files)
+        try:
+            snapshot = self.load(self.snapshot.version + 1)
+        except ConfigError as e:
+            self.rejected = signatures
+            self.reloads["rejected"] += 1
+            log.error(
+                "Configuration change rejected, still using version %d: %s",
+                self.snapshot.version,
+                e,
+                extra={"version": self.snapshot.version},
+            )
+            return False
+        # Files the new snapshot reads for the first time, e.g. a station's new rule file
+        self.signatures = {
+            path: signatures[path] if path in signatures else file_signature(path)
+            for path in snapshot.files
+        }
+        self.rejected = None
+        old, self.snapshot = self.snapshot, snapshot
+        self.reloads["applied"] += 1
+        self.on_change(old, snapshot)
+        return True
@@ -0,0 +1,301 @@
+"""
+Shared HTTP client used for every Spinitron and Last.fm request.
+
+A single requests.Session is kept for the lifetime of the process so that connections are pooled
+per host and reused (keep-alive) instead of paying for a new TCP and TLS handshake on every call.
+Every request goes out with a connect/read timeout, so a hung socket can no longer block the
+polling loop forever, and the latency and size of each request is recorded per endpoint.
+Requests are rate limited per host and per API key, and retried with backoff when they fail in a
+way that may go away on its own.
+"""
+
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests as r
+from requests.adapters import HTTPAdapter
+
+from metrics import Histogram
+from ratelimit import RateLimiter
+from retry import IDEMPOTENT_METHODS, RetryPolicy, classify_http
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 15.0
+DEFAULT_POOL_SIZE = 10
+
+# Last.fm allows an average of 5 requests per second per IP address
+DEFAULT_HOST_RATE_LIMIT = 5.0
+DEFAULT_KEY_RATE_LIMIT = 2.0
+DEFAULT_RATE_BURST = 10
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Numeric path segments (playlist and persona ids) are collapsed so that latency is grouped by
+# endpoint rather than by individual resource
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_label(method, url, params=None):
+    """
+    Builds a short, low-cardinality label for a request to group its latency under
+
+    Args:
+        method (str): HTTP method of the request
+        url (str): Full request URL
+        params (dict, optional): Query parameters of the request. For Last.fm, the API method
+            name is taken from here since every call shares the same URL
+    Returns:
+        str: The label, e.g. "GET spinitron.com/api/playlists/{id}" or "POST track.scrobble"
+    """
+    if isinstance(params, dict) and "method" in params:
+        return f"{method} {params['method']}"
+    parts = urlsplit(url)
+    path = _ID_SEGMENT.sub("/{id}", parts.path)
+    return f"{method} {parts.netloc}{path}"
+
+
+def _wire_size(response):
+    """
+    Returns:
+        int: Number of body bytes read off the connection for a fully consumed response (the
+            compressed size when the server used gzip)
+    """
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError):
+        return len(response.content)
+
+
+class LatencyStats:
+    """
+    Thread-safe running totals of request count, errors, latency and bytes per endpoint, along
+    with a latency histogram per endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, label, seconds, size=0, wire_size=0, error=False):
+        """
+        Records the outcome of a single request
+
+        Args:
+            label (str): Endpoint label, see endpoint_label()
+            seconds (float): Wall-clock duration of the request
+            size (int, optional): Number of (decoded) response body bytes
+            wire_size (int, optional): Number of response body bytes actually transferred, before
+                decompression
+            error (bool, optional): Whether the request failed at the transport level
+        """
+        with self._lock:
+            entry = self._endpoints.setdefault(
+                label,
+                {
+                    "count": 0,
+                    "errors": 0,
+                    "total": 0.0,
+                    "min": None,
+                    "max": 0.0,
+                    "bytes": 0,
+                    "wire_bytes": 0,
+                    "histogram": Histogram(),
+                },
+            )
+            entry["histogram"].observe(seconds)
+            entry["count"] += 1
+            entry["errors"] += int(error)
+            entry["total"] += seconds
+            entry["bytes"] += size
+            entry["wire_bytes"] += wire_size
+            entry["max"] = max(entry["max"], seconds)
+            if entry["min"] is None or seconds < entry["min"]:
+                entry["min"] = seconds
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: A copy of the per-endpoint totals, keyed by endpoint label
+        """
+        with self._lock:
+            return {label: dict(entry) for label, entry in self._endpoints.items()}
+
+    def summary(self):
+        """
+        Returns:
+            str: A human-readable, multi-line table of the recorded latencies
+        """
+        lines = []
+        for label, entry in sorted(self.snapshot().items()):
+            mean_ms = 1000 * entry["total"] / entry["count"]
+            lines.append(
+                f"{label}: {entry['count']} requests ({entry['errors']} failed), "
+                f"avg {mean_ms:.0f} ms, min {1000 * entry['min']:.0f} ms, "
+                f"max {1000 * entry['max']:.0f} ms, {entry['bytes']} bytes "
+                f"({entry['wire_bytes']} transferred)"
+            )
+        return "\n".join(lines) if lines else "No requests made yet."
+
+
+class HttpClient:
+    """
+    Pooled, keep-alive HTTP client with default timeouts, rate limiting, retries and
+    per-endpoint latency reporting. One instance should be shared by every API function in the
+    process, so that the rate limits apply across all of them.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        pool_size=DEFAULT_POOL_SIZE,
+        host_rate_limit=DEFAULT_HOST_RATE_LIMIT,
+        key_rate_limit=DEFAULT_KEY_RATE_LIMIT,
+        rate_burst=DEFAULT_RATE_BURST,
+        retry_policy=None,
+    ):
+        """
+        Args:
+            connect_timeout (float, optional): Seconds to wait for a connection to be established
+            read_timeout (float, optional): Seconds to wait between bytes of the response
+            pool_size (int, optional): Maximum number of connections kept open per host
+            host_rate_limit (float, optional): Requests per second allowed to each host, 0 for
+                no limit
+            key_rate_limit (float, optional): Requests per second allowed with each API key, 0
+                for no limit
+            rate_burst (int, optional): Requests that may be made at once before the rate limits
+                apply
+            retry_policy (retry.RetryPolicy, optional): Policy for retrying failed requests.
+                Defaults to three attempts with jittered exponential backoff
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = LatencyStats()
+        self.host_limiter = RateLimiter(host_rate_limit, rate_burst)
+        self.key_limiter = RateLimiter(key_rate_limit, rate_burst)
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_attempts=DEFAULT_MAX_ATTEMPTS
+        )
+
+        self.session = r.Session()
+        self.session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+                "User-Agent": "wbor-scrobbler",
+            }
+        )
+        # pool_connections is the number of hosts to keep a pool for, pool_maxsize the number of
+        # connections kept alive per host. Retries are left to the caller.
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Creates a client configured from the optional HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+        HTTP_POOL_SIZE, HTTP_HOST_RATE_LIMIT, HTTP_KEY_RATE_LIMIT, HTTP_RATE_BURST and
+        HTTP_MAX_ATTEMPTS environment variables
+
+        Returns:
+            HttpClient: The configured client
+        """
+        return cls(
+            connect_timeout=float(
+                os.getenv("HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+            ),
+            read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+            pool_size=int(os.getenv("HTTP_POOL_SIZE", DEFAULT_POOL_SIZE)),
+            host_rate_limit=float(
+                os.getenv("HTTP_HOST_RATE_LIMIT", DEFAULT_HOST_RATE_LIMIT)
+            ),
+            key_rate_limit=float(
+                os.getenv("HTTP_KEY_RATE_LIMIT", DEFAULT_KEY_RATE_LIMIT)
+            ),
+            rate_burst=int(os.getenv("HTTP_RATE_BURST", DEFAULT_RATE_BURST)),
+            retry_policy=RetryPolicy(
+                max_attempts=int(os.getenv("HTTP_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+            ),
+        )
+
+    def request(self, method, url, rate_key=None, classify=classify_http, **kwargs):
+        """
+        Performs a request through the shared session, applying the default timeout, the rate
+        limits and the retry policy, and recording the latency of each attempt. Requests with a
+        method that is not idempotent, such as POST, are not retried after a read timeout
+
+        Args:
+            method (str): HTTP method
+            url (str): Full request URL
+            rate_key (str, optional): API key the request is made with, to rate limit per key
+            classify (callable, optional): Function deciding whether a response should be
+                retried, see retry.RetryPolicy.call()
+            **kwargs: Passed through to requests.Session.request
+        Returns:
+            requests.Response: The response of the last attempt
+        Raises:
+            requests.RequestException: If the request failed at the transport level (including
+                timeouts)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.retry_policy.call(
+            lambda: self._send(method, url, rate_key, **kwargs),
+            classify,
+            idempotent=method.upper() in IDEMPOTENT_METHODS,
+        )
+
+    def _send(self, method, url, rate_key, **kwargs):
+        """
+        Makes a single attempt at a request, see request()
+        """
+        self.host_limiter.acquire(urlsplit(url).netloc)
+        if rate_key is not None:
+            self.key_limiter.acquire(rate_key)
+
+        label = endpoint_label(method, url, kwargs.get("params") or kwargs.get("data"))
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except r.RequestException:
+            self.stats.record(label, time.perf_counter() - start, error=True)
+            raise
+        self.stats.record(
+            label,
+            time.perf_counter() - start,
+            size=len(response.content),
+            wire_size=_wire_size(response),
+        )
+        return response
+
+    def get(self, url, **kwargs):
+        """
+        Performs a GET request, see request()
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Performs a POST request, see request()
+        """
+        return self.request("POST", url, **kwargs)
+
+    def limits_summary(self):
+        """
+        Returns:
+            str: A human-readable, multi-line description of the rate limiting and retries
+        """
+        return (
+            f"Per-host rate limit: {self.host_limiter.summary()}\n"
+            f"Per-key rate limit: {self.key_limiter.summary()}\n"
+            f"Retries: {self.retry_policy.summary()}"
+        )
+
+    def close(self):
+        """
+        Closes every pooled connection
+        """
+        self.session.close()
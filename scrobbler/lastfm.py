@@ -0,0 +1,485 @@
+"""
+Last.fm API access. Each LastfmAccount holds the credentials of one Last.fm user (a station
+account or a per-show account) and signs its own requests, so that any number of accounts can
+share one process and one HTTP client. Accounts are sinks (see sinks.py), like the other
+destinations of a station's spins.
+"""
+
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+import requests as r
+
+from profiling import profiler
+from retry import FATAL, RETRYABLE, SUCCESS, classify_http
+from scrobble_queue import (
+    ACCEPTED,
+    REJECTED,
+    RETRY,
+    AuthenticationFailed,
+    BatchRejected,
+    RetryLater,
+)
+from sinks import Sink
+
+log = logging.getLogger(__name__)
+
+LASTFM_API_URL = "https://ws.audioscrobbler.com/2.0/"
+
+# Kinds of Last.fm errors, which decide how a failed request is handled
+TEMPORARY = "temporary"  # Goes away on its own, so the request is retried
+AUTH = "auth"  # The API key, secret or session key is wrong; nothing works until it is fixed
+INVALID_REQUEST = "invalid request"  # The scrobbles themselves are refused; resubmitting will not help
+OTHER = "other"
+
+# Last.fm error codes, with their meaning according to the Last.fm documentation
+ERROR_CODES = {
+    2: ("Invalid service - This service does not exist", OTHER),
+    3: ("Invalid Method - No method with that name in this package", OTHER),
+    4: (
+        "Authentication Failed - You do not have permissions to access the service",
+        AUTH,
+    ),
+    5: ("Invalid format - This service doesn't exist in that format", OTHER),
+    6: (
+        "Invalid parameters - Your request is missing a required parameter",
+        INVALID_REQUEST,
+    ),
+    7: ("Invalid resource specified", INVALID_REQUEST),
+    8: ("Operation failed - Something else went wrong", OTHER),
+    9: ("Invalid session key - Please re-authenticate", AUTH),
+    10: ("Invalid API key - You must be granted a valid key by last.fm", AUTH),
+    11: (
+        "Service Offline - This service is temporarily offline. Try again later.",
+        TEMPORARY,
+    ),
+    # The signature is made with the API secret, so this means the secret is wrong
+    13: ("Invalid method signature supplied", AUTH),
+    16: (
+        "There was a temporary error processing your request. Please try again",
+        TEMPORARY,
+    ),
+    26: (
+        "Suspended API key - Access for your account has been suspended, please contact Last.fm",
+        AUTH,
+    ),
+    29: (
+        "Rate limit exceeded - Your IP has made too many requests in a short period",
+        TEMPORARY,
+    ),
+}
+
+
+def _error_codes(kind):
+    return frozenset(code for code, (_, k) in ERROR_CODES.items() if k == kind)
+
+
+INVALID_REQUEST_ERROR_CODES = _error_codes(INVALID_REQUEST)
+AUTH_ERROR_CODES = _error_codes(AUTH)
+
+# ignoredMessage code Last.fm uses when the daily scrobble limit has been reached
+IGNORED_DAILY_LIMIT = 5
+
+
+@dataclass(frozen=True)
+class LastfmCredentials:
+    """
+    The keys a Last.fm account signs its requests with. They are replaced as a whole when the
+    configuration is reloaded, so a request never mixes a new key with an old secret
+    """
+
+    api_key: str
+    api_secret: str
+    session_key: str = None
+
+
+class LastfmAccount(Sink):
+    """
+    A Last.fm user that Now Playing updates and scrobbles are sent to
+    """
+
+    sends_now_playing = True
+
+    def __init__(
+        self,
+        name,
+        api_key,
+        api_secret,
+        client,
+        session_key=None,
+        shows=None,
+        api_url=LASTFM_API_URL,
+    ):
+        """
+        Args:
+            name (str): Name of the account, for logging
+            api_key (str): Last.fm API key
+            api_secret (str): Last.fm API shared secret, used to sign requests
+            client (http_client.HttpClient): Shared HTTP client to send requests through
+            session_key (str, optional): Web service session key, from auth.getSession. Not needed
+                for setup
+            shows (list, optional): Playlist titles this account should receive spins from. All
+                shows are received if omitted
+            api_url (str, optional): URL of the Last.fm API
+        """
+        super().__init__(name, shows)
+        # Read once by each request, which then uses the same credentials throughout
+        self.credentials = LastfmCredentials(api_key, api_secret, session_key)
+        self.client = client
+        self.api_url = api_url
+
+    @property
+    def api_key(self):
+        return self.credentials.api_key
+
+    @property
+    def api_secret(self):
+        return self.credentials.api_secret
+
+    @property
+    def session_key(self):
+        return self.credentials.session_key
+
+    def generate_signature(self, params, credentials=None):
+        """
+        Takes parameters for a request and generates an md5 hash signature as specified in the
+        Last.fm authentication specs
+
+        Args:
+            params (library): Library of stringe representing the parameters for the request
+            credentials (LastfmCredentials, optional): The credentials the request is made with.
+                The account's current ones if omitted
+        Returns:
+            str: The generated signature, as a string
+        """
+        credentials = credentials or self.credentials
+        with profiler.stage("sign"):
+            signature = ""
+            for key in sorted(params):
+                signature += key + str(params[key])
+            signature += credentials.api_secret
+            return hashlib.md5(signature.encode("utf-8")).hexdigest()
+
+    def get_token(self):
+        """
+        Performs API call auth.getToken to fetch a request token
+
+        Returns:
+            str: Returned token, as a string
+        """
+        credentials = self.credentials
+        params = {"method": "auth.getToken", "api_key": credentials.api_key}
+        params["api_sig"] = self.generate_signature(params, credentials)
+
+        response = self.client.post(
+            self.api_url,
+            params=params,
+            rate_key=credentials.api_key,
+            classify=classify_response,
+        )
+        root = ET.fromstring(response.content)
+        return root.find("./token").text
+
+    def get_session_key(self, token):
+        """
+        Performs API call to auth.getSession to create a web service session and fetch the
+        associated session key
+
+        Args:
+            token (str): A request token, retrived from auth.getToken
+        Returns:
+            str or None: Returned session key, as a string, or None if Last.fm did not return one
+        """
+        credentials = self.credentials
+        params = {
+            "method": "auth.getSession",
+            "api_key": credentials.api_key,
+            "token": token,
+        }
+        params["api_sig"] = self.generate_signature(params, credentials)
+
+        response = self.client.post(
+            self.api_url,
+            params=params,
+            rate_key=credentials.api_key,
+            classify=classify_response,
+        )
+        root = ET.fromstring(response.content)
+        session_key_element = root.find("./session/key")
+        if session_key_element is None:
+            return None
+        return session_key_element.text
+
+    def update_np(self, artist, track, album=None, duration=None):
+        """
+        Performs API call to track.updateNowPlaying to indicate to Last.fm that the user has
+        started listening to a new track
+
+        Args:
+            artist (str): The artist name
+            track (str): The track name
+            album (str, optional): The album name
+            duration (int, optional): The length of the track in seconds
+        Returns:
+            bool: True if Last.fm accepted the update
+        """
+        credentials = self.credentials
+        params = {
+            "method": "track.updateNowPlaying",
+            "artist": artist,
+            "track": track,
+            "api_key": credentials.api_key,
+            "sk": credentials.session_key,
+        }
+        if album:
+            params["album"] = album
+        if duration:
+            params["duration"] = duration
+        params["api_sig"] = self.generate_signature(params, credentials)
+
+        try:
+            with profiler.stage("submit"):
+                response = self.client.post(
+                    self.api_url,
+                    params=params,
+                    rate_key=credentials.api_key,
+                    classify=classify_response,
+                )
+        except r.RequestException as e:
+            log.error(
+                "The NP request could not be completed: %s",
+                e,
+                extra={"account": self.name},
+            )
+            self.now_playing_outcomes["failure"] += 1
+            return False
+
+        # Handle http error if necessary
+        if not response.ok:
+            handle_lastfm_http_error(
+                response=response, request_type="NP", account=self.name
+            )
+            self.now_playing_outcomes["failure"] += 1
+            return False
+        self.now_playing_outcomes["success"] += 1
+        return True
+
+    def now_playing(self, track):
+        """
+        Sends a track to Last.fm as Now Playing, see update_np() and Sink.now_playing()
+        """
+        return self.update_np(
+            artist=track["artist"],
+            track=track["track"],
+            album=track.get("album"),
+            duration=track.get("duration"),
+        )
+
+    def get_correction(self, artist, track):
+        """
+        Performs API call to track.getCorrection to look up Last.fm's canonical spelling of an
+        artist and track name
+
+        Args:
+            artist (str): The artist name
+            track (str): The track name
+        Returns:
+            tuple: The corrected artist and track names, or None if Last.fm has no correction
+        Raises:
+            requests.RequestException: If the request could not be completed or Last.fm returned
+                an error
+        """
+        credentials = self.credentials
+        response = self.client.get(
+            self.api_url,
+            params={
+                "method": "track.getCorrection",
+                "artist": artist,
+                "track": track,
+                "api_key": credentials.api_key,
+            },
+            rate_key=credentials.api_key,
+            classify=classify_response,
+        )
+        response.raise_for_status()
+        try:
+            correction = ET.fromstring(response.content).find(
+                "./corrections/correction/track"
+            )
+        except ET.ParseError as e:
+            raise r.RequestException("could not parse the Last.fm response") from e
+        if correction is None:
+            return None
+        corrected_artist = correction.findtext("./artist/name")
+        corrected_track = correction.findtext("./name")
+        if not corrected_artist or not corrected_track:
+            return None
+        return corrected_artist, corrected_track
+
+    def request_scrobbles(self, scrobbles):
+        """
+        Performs API call to track.scrobble to indicate to Last.fm that the user has listened to
+        one or more songs, using the indexed batch form (artist[i], track[i], timestamp[i], ...)
+
+        Args:
+            scrobbles (list): Up to 50 dicts with "artist", "track" and "timestamp" (UTC, in UNIX
+                timestamp format) keys and optional "album" and "duration" keys
+        Returns:
+            list: ACCEPTED or REJECTED for each scrobble, or RETRY if Last.fm asked for it to be
+                submitted again later (daily scrobble limit)
+        Raises:
+            RetryLater: If the request could not be completed or Last.fm returned an error that
+                may go away on its own
+            AuthenticationFailed: If Last.fm refused the API key or session key
+            BatchRejected: If Last.fm refused the request as invalid
+        """
+        credentials = self.credentials
+        params = {
+            "method": "track.scrobble",
+            "api_key": credentials.api_key,
+            "sk": credentials.session_key,
+        }
+        for i, scrobble in enumerate(scrobbles):
+            params[f"artist[{i}]"] = scrobble["artist"]
+            params[f"track[{i}]"] = scrobble["track"]
+            params[f"timestamp[{i}]"] = int(scrobble["timestamp"])
+            if scrobble.get("album"):
+                params[f"album[{i}]"] = scrobble["album"]
+            if scrobble.get("duration"):
+                params[f"duration[{i}]"] = scrobble["duration"]
+        params["api_sig"] = self.generate_signature(params, credentials)
+
+        try:
+            with profiler.stage("submit"):
+                response = self.client.post(
+                    self.api_url,
+                    data=params,
+                    rate_key=credentials.api_key,
+                    classify=classify_response,
+                )
+        except r.RequestException as e:
+            raise RetryLater(e) from e
+
+        if not response.ok:
+            handle_lastfm_http_error(
+                response=response, request_type="scrobble", account=self.name
+            )
+            code, message = parse_lastfm_error(response)
+            if code in INVALID_REQUEST_ERROR_CODES:
+                raise BatchRejected(f"Last.fm error code {code}: {message}")
+            if code in AUTH_ERROR_CODES:
+                raise AuthenticationFailed(f"Last.fm error code {code}: {message}")
+            raise RetryLater(f"HTTP error code {response.status_code}")
+
+        try:
+            with profiler.stage("parse"):
+                root = ET.fromstring(response.content)
+        except ET.ParseError as e:
+            raise RetryLater("could not parse the Last.fm response") from e
+
+        # Last.fm reports on each scrobble, in the order they were submitted
+        outcomes = []
+        for element in root.findall("./scrobbles/scrobble"):
+            ignored = element.find("./ignoredMessage")
+            code = int(ignored.get("code", 0)) if ignored is not None else 0
+            if code == 0:
+                outcomes.append(ACCEPTED)
+            elif code == IGNORED_DAILY_LIMIT:
+                outcomes.append(RETRY)
+            else:
+                log.warning(
+                    "SCROBBLE IGNORED: %s - %s (%s)",
+                    element.findtext("./artist"),
+                    element.findtext("./track"),
+                    ignored.text or f"code {code}",
+                    extra={"account": self.name, "ignored_code": code},
+                )
+                outcomes.append(REJECTED)
+        if len(outcomes) != len(scrobbles):
+            raise RetryLater("Last.fm did not report on every scrobble")
+        return outcomes
+
+    def submit(self, scrobbles):
+        """
+        Submits scrobbles to Last.fm, see request_scrobbles() and Sink.submit()
+        """
+        return self.request_scrobbles(scrobbles)
+
+
+def parse_lastfm_error(response):
+    """
+    Extracts the Last.fm error code and message from an error response
+
+    Args:
+        response (requests.Response): Response object returned by a Last.fm API call
+    Returns:
+        tuple: The error code (int) and message (str), or (None, None) if the response body did
+            not contain a Last.fm error. The code is None if the error did not have a numeric one
+    """
+    try:
+        data = ET.fromstring(response.content).find("./error")
+    except ET.ParseError:
+        return None, None
+    if data is None:
+        return None, None
+    try:
+        return int(data.get("code")), data.text
+    except (TypeError, ValueError):
+        return None, data.text
+
+
+def classify_response(response):
+    """
+    Decides whether a Last.fm request should be retried, from the Last.fm error code in the
+    response body, looked up in ERROR_CODES, or, failing that, the HTTP status code. Temporary
+    errors and rate limiting are retried, while authentication and other errors fail right away.
+
+    Args:
+        response (requests.Response): Response object returned by a Last.fm API call
+    Returns:
+        str: retry.SUCCESS, retry.RETRYABLE or retry.FATAL
+    """
+    if response.ok:
+        return SUCCESS
+    code, _ = parse_lastfm_error(response)
+    if code is None:
+        return classify_http(response)
+    _, kind = ERROR_CODES.get(code, (None, OTHER))
+    return RETRYABLE if kind == TEMPORARY else FATAL
+
+
+def handle_lastfm_http_error(response, request_type, account=None):
+    """
+    Helper function for update_np and request_scrobbles, which takes the returned response from an
+    HTTP error, parses, and logs the information.
+
+    Args:
+        response (requests.Response): Response object that is returned by an HTTP request.
+            Should only be responses where response.ok is false (status code >= 400)
+        request_type (str): A string indicating the source of the HTTP error ('NP' if it comes
+            from an NP request, 'scrobble' if it comes from a scrobble request)
+        account (str, optional): Name of the account the request was made for
+    """
+    http_error_str = f"An HTTP error occured while making a {request_type} request.\nHTTP error code {response.status_code}: {response.reason}"
+    code = None
+    try:
+        # Get error info sent from last.fm if available
+        root = ET.fromstring(response.content)
+        data = root.find("./error")
+        code = int(data.get("code"))
+        http_error_str += f"\nLast.fm error code {code}: {data.text}"
+        if code in AUTH_ERROR_CODES:
+            http_error_str += "\nCheck the account's API key and secret, or run --setup again to get a new session key."
+    except (ET.ParseError, AttributeError, TypeError, ValueError):
+        http_error_str += "\nCould not parse response data for more information."
+
+    log.error(
+        http_error_str,
+        extra={
+            "account": account,
+            "status": response.status_code,
+            "lastfm_code": code,
+        },
+    )
@@ -0,0 +1,236 @@
+"""
+Logging setup. Modules log through the standard logging module (logging.getLogger(__name__)).
+Logging a message only puts it on a queue, and a background thread formats and writes it, so a
+slow terminal or Docker log driver never holds up polling or scrobbling.
+
+LOG_FORMAT picks how each event is written:
+
+    text    2024-03-01 14:03:30 [WBOR] NEW SONG: Artist - Track
+    logfmt  time=2024-03-01T14:03:30Z level=info logger=station msg="NEW SONG: Artist - Track"
+            station=WBOR spin_id=123
+    json    {"time": "2024-03-01T14:03:30Z", "level": "info", "logger": "station",
+             "msg": "NEW SONG: Artist - Track", "station": "WBOR", "spin_id": 123}
+
+Values passed with extra= (such as station, account and spin_id) become fields of the event in
+the logfmt and json formats. The text format is colored, by level or by a "color" passed with
+extra=, but only when it is written to a terminal.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+from colors import Colors
+from config import DEFAULT_NAME
+
+FORMATS = ("text", "logfmt", "json")
+
+# Attributes every log record has, which are not fields of the event
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "color",
+}
+
+_LEVEL_COLORS = {
+    logging.WARNING: Colors.YELLOW,
+    logging.ERROR: Colors.RED,
+    logging.CRITICAL: Colors.RED,
+}
+
+# The handler queueing events and the listener writing them, once setup_logging() has run
+_handler = None
+_listener = None
+
+
+def event_fields(record):
+    """
+    Returns:
+        dict: The fields passed with extra= when the record was logged
+    """
+    return {
+        key: value
+        for key, value in vars(record).items()
+        if key not in _RECORD_ATTRIBUTES and value is not None
+    }
+
+
+def _utc_time(record):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(record.created))
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Human-readable lines, prefixed with the local time and the station, account or scrobble
+    queue the event is about (unless it is the single station or account configured from .env)
+    """
+
+    def __init__(self, colors=False):
+        """
+        Args:
+            colors (bool, optional): Whether to color lines with ANSI codes
+        """
+        super().__init__(datefmt="%Y-%m-%d %H:%M:%S")
+        self.colors = colors
+
+    def format(self, record):
+        message = record.getMessage()
+        names = [
+            name
+            for name in (
+                getattr(record, "station", None),
+                getattr(record, "account", None),
+                getattr(record, "queue", None),
+            )
+            if name and name != DEFAULT_NAME
+        ]
+        if names:
+            prefix = f"[{'/'.join(names)}] "
+            message = "\n".join(
+                prefix + line if line else line for line in message.split("\n")
+            )
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        color = getattr(record, "color", None) or _LEVEL_COLORS.get(record.levelno)
+        if self.colors and color:
+            message = color + message + Colors.RESET
+        return f"{self.formatTime(record, self.datefmt)} {message}"
+
+
+class LogfmtFormatter(logging.Formatter):
+    """
+    One line of key=value pairs per event
+    """
+
+    @staticmethod
+    def _value(value):
+        text = value if isinstance(value, str) else json.dumps(value, default=str)
+        if text and not any(char in text for char in ' ="\\\n\t'):
+            return text
+        return json.dumps(text)
+
+    def format(self, record):
+        pairs = {
+            "time": _utc_time(record),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **event_fields(record),
+        }
+        if record.exc_info:
+            pairs["exc"] = self.formatException(record.exc_info)
+        return " ".join(f"{key}={self._value(value)}" for key, value in pairs.items())
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per event
+    """
+
+    def format(self, record):
+        body = {
+            "time": _utc_time(record),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **event_fields(record),
+        }
+        if record.exc_info:
+            body["exc"] = self.formatException(record.exc_info)
+        return json.dumps(body, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue for the listener thread, dropping them rather than waiting
+    when the queue is full
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        # Number of records dropped because the output could not keep up
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare(), leave formatting to the listener's formatter. The
+        # message is still merged with its arguments now, in case they change later.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level="INFO", log_format="text", stream=None, queue_size=10000):
+    """
+    Sends every log record through a queue to a background thread writing to a stream. Safe to
+    call again, e.g. to change the level; the previous listener is stopped first.
+
+    Args:
+        level (str or int, optional): Lowest level written, e.g. "DEBUG" or "WARNING"
+        log_format (str, optional): One of FORMATS
+        stream (file, optional): Where to write. Standard output by default
+        queue_size (int, optional): Number of records held before new ones are dropped
+    Returns:
+        DroppingQueueHandler: The handler records are queued by
+    Raises:
+        ValueError: If the level or format is unknown
+    """
+    global _handler, _listener
+    if log_format not in FORMATS:
+        raise ValueError(
+            f"Unknown log format {log_format!r}, expected one of {', '.join(FORMATS)}"
+        )
+    stream = stream or sys.stdout
+    if log_format == "json":
+        formatter = JsonFormatter()
+    elif log_format == "logfmt":
+        formatter = LogfmtFormatter()
+    else:
+        formatter = TextFormatter(colors=stream.isatty())
+
+    stop_logging()
+    output = logging.StreamHandler(stream)
+    output.setFormatter(formatter)
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    # Libraries' own debug output is not wanted even in verbose mode
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(handler.queue, output)
+    _listener.start()
+    if _handler is None:
+        atexit.register(stop_logging)
+    _handler = handler
+    return handler
+
+
+def dropped_events():
+    """
+    Returns:
+        int: Number of events dropped because the output could not keep up
+    """
+    return _handler.dropped if _handler is not None else 0
+
+
+def stop_logging():
+    """
+    Writes the records still queued and stops the background thread. Called before the process
+    exits, so that its last messages are not lost.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
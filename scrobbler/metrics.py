@@ -0,0 +1,376 @@
+"""
+Prometheus text format exposition of the scrobbler's internal statistics.
+
+Nothing is recorded twice: the HTTP client, caches, scrobble queues and stations already keep
+their own counters, and render_metrics() reads them at scrape time. The only metric type kept
+here is Histogram, which the other modules use for latencies.
+"""
+
+import bisect
+import threading
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Upper bounds (in seconds) of the time spent cleaning up each spin's metadata, which is well
+# under a millisecond unless a Last.fm correction has to be looked up
+NORMALIZE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Upper bounds (in seconds) of the scrobble lag histogram buckets, from near real time to a day
+LAG_BUCKETS = (10, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+
+class Histogram:
+    """
+    Thread-safe histogram with fixed bucket upper bounds, as exposed by Prometheus
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            buckets (tuple, optional): Sorted upper bounds of the buckets. An implicit +Inf bucket
+                is always added
+        """
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Records one observation
+
+        Args:
+            value (float): The observed value
+        """
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """
+        Returns:
+            tuple: The cumulative count of each bucket (the last one being +Inf), and the sum of
+                all observations
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+def _number(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class _Exposition:
+    """
+    Builds a Prometheus text format document. Samples are grouped under their metric family's
+    HELP and TYPE lines, whatever order they are added in.
+    """
+
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, name, kind, help_text):
+        if name not in self._families:
+            self._families[name] = [
+                f"# HELP {name} {help_text}",
+                f"# TYPE {name} {kind}",
+            ]
+        return self._families[name]
+
+    def sample(self, name, kind, help_text, value, **labels):
+        self._family(name, kind, help_text).append(
+            f"{name}{_labels(labels)} {_number(value)}"
+        )
+
+    def histogram(self, name, help_text, histogram, **labels):
+        lines = self._family(name, "histogram", help_text)
+        cumulative, total = histogram.snapshot()
+        bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, cumulative):
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative[-1]}")
+
+    def render(self):
+        return "".join(
+            line + "\n" for lines in self._families.values() for line in lines
+        )
+
+
+def render_metrics(
+    client,
+    metadata_cache,
+    scrobble_worker,
+    stations,
+    push_receiver=None,
+    normalizer=None,
+    config_watcher=None,
+    log_events_dropped=0,
+):
+    """
+    Collects the current statistics of every part of the scrobbler
+
+    Args:
+        client (http_client.HttpClient): The shared HTTP client
+        metadata_cache (cache.TTLCache): The shared playlist and persona cache
+        scrobble_worker (scrobble_queue.ScrobbleWorker): The worker and its queues
+        stations (list): The station.Station objects being run
+        push_receiver (push.PushReceiver, optional): The push receiver, in push mode
+        normalizer (normalize.Normalizer, optional): The spin metadata normalizer
+        config_watcher (config.ConfigWatcher, optional): Reloads the configuration files
+        log_events_dropped (int, optional): Log messages dropped because the output could not
+            keep up, see logs.dropped_events()
+    Returns:
+        str: The metrics, in Prometheus text format
+    """
+    out = _Exposition()
+
+    for label, entry in sorted(client.stats.snapshot().items()):
+        out.histogram(
+            "scrobbler_http_request_duration_seconds",
+            "Duration of Spinitron and Last.fm requests, by endpoint",
+            entry["histogram"],
+            endpoint=label,
+        )
+        out.sample(
+            "scrobbler_http_request_errors_total",
+            "counter",
+            "Requests that failed at the transport level, by endpoint",
+            entry["errors"],
+            endpoint=label,
+        )
+        out.sample(
+            "scrobbler_http_response_bytes_total",
+            "counter",
+            "Response body bytes transferred, by endpoint",
+            entry["wire_bytes"],
+            endpoint=label,
+        )
+    out.sample(
+        "scrobbler_http_retries_total",
+        "counter",
+        "Requests retried after a temporary error",
+        client.retry_policy.retries,
+    )
+    for scope, limiter in (("host", client.host_limiter), ("key", client.key_limiter)):
+        out.sample(
+            "scrobbler_rate_limit_wait_seconds_total",
+            "counter",
+            "Time spent waiting for the client-side rate limits",
+            limiter.waited,
+            scope=scope,
+        )
+
+    out.sample(
+        "scrobbler_metadata_cache_hits_total",
+        "counter",
+        "Playlist and persona lookups served from the cache",
+        metadata_cache.hits,
+    )
+    out.sample(
+        "scrobbler_metadata_cache_misses_total",
+        "counter",
+        "Playlist and persona lookups fetched from Spinitron",
+        metadata_cache.misses,
+    )
+    out.sample(
+        "scrobbler_metadata_cache_hit_ratio",
+        "gauge",
+        "Fraction of metadata lookups served from the cache",
+        metadata_cache.hit_ratio(),
+    )
+
+    for queue in scrobble_worker.queues:
+        out.sample(
+            "scrobbler_scrobble_queue_depth",
+            "gauge",
+            "Scrobbles waiting to be accepted by their sink",
+            len(queue.journal),
+            queue=queue.name,
+        )
+        for outcome, count in sorted(queue.outcomes.items()):
+            out.sample(
+                "scrobbler_scrobbles_total",
+                "counter",
+                "Scrobbles submitted to their sink, by outcome",
+                count,
+                queue=queue.name,
+                outcome=outcome,
+            )
+        out.sample(
+            "scrobbler_scrobble_submission_failures_total",
+            "counter",
+            "Scrobble submissions that have to be retried later",
+            queue.failed_submissions,
+            queue=queue.name,
+        )
+        out.histogram(
+            "scrobbler_scrobble_lag_seconds",
+            "Time from the end of a spin until its sink accepted its scrobble",
+            queue.lag,
+            queue=queue.name,
+        )
+        for operation, histogram in (
+            ("scrobble", queue.submit_latency),
+            ("now_playing", queue.now_playing_latency),
+        ):
+            out.histogram(
+                "scrobbler_sink_request_duration_seconds",
+                "Time taken by each submission or Now Playing update of a sink",
+                histogram,
+                queue=queue.name,
+                operation=operation,
+            )
+
+    for station in stations:
+        for account in station.accounts:
+            if not account.sends_now_playing:
+                continue
+            for outcome, count in sorted(account.now_playing_outcomes.items()):
+                out.sample(
+                    "scrobbler_now_playing_total",
+                    "counter",
+                    "Now Playing updates sent to each sink, by outcome",
+                    count,
+                    station=station.name,
+                    account=account.name,
+                    outcome=outcome,
+                )
+        if station.last_successful_poll is not None:
+            out.sample(
+                "scrobbler_last_successful_poll_timestamp_seconds",
+                "gauge",
+                "UNIX time of the last successful poll of Spinitron",
+                station.last_successful_poll,
+                station=station.name,
+            )
+        strategy = station.poll_strategy
+        out.sample(
+            "scrobbler_poll_interval_seconds",
+            "gauge",
+            "Seconds until the next poll of Spinitron",
+            strategy.current_interval,
+            station=station.name,
+        )
+        for kind, count in (
+            (
+                "on_time",
+                strategy.detections - strategy.late_detections - strategy.missed_spins,
+            ),
+            ("late", strategy.late_detections),
+            ("missed", strategy.missed_spins),
+        ):
+            out.sample(
+                "scrobbler_spin_detections_total",
+                "counter",
+                "New spins detected, by whether fixed-interval polling would have found them sooner",
+                count,
+                station=station.name,
+                timing=kind,
+            )
+        for change, count in sorted(station.changes.items()):
+            out.sample(
+                "scrobbler_spin_changes_total",
+                "counter",
+                "Handled spins that were edited or deleted in Spinitron afterwards; too_late counts those whose scrobbles had already been submitted",
+                count,
+                station=station.name,
+                change=change,
+            )
+
+    if push_receiver is not None:
+        for outcome, count in sorted(push_receiver.outcomes.items()):
+            out.sample(
+                "scrobbler_pushes_total",
+                "counter",
+                "Spins pushed by Spinitron, by outcome",
+                count,
+                outcome=outcome,
+            )
+
+    if normalizer is not None:
+        out.histogram(
+            "scrobbler_normalize_duration_seconds",
+            "Time spent cleaning up the metadata of each spin, including correction lookups",
+            normalizer.latency,
+        )
+        out.sample(
+            "scrobbler_normalized_spins_total",
+            "counter",
+            "Spins whose metadata was cleaned up before being sent to Last.fm",
+            normalizer.spins,
+        )
+        for source, count in (
+            ("text_rules", normalizer.cleaned),
+            ("correction", normalizer.corrected),
+        ):
+            out.sample(
+                "scrobbler_normalize_changes_total",
+                "counter",
+                "Spins whose metadata was changed, by the text rules or by a Last.fm correction",
+                count,
+                source=source,
+            )
+        if normalizer.correct is not None:
+            out.sample(
+                "scrobbler_correction_cache_hits_total",
+                "counter",
+                "Track corrections served from the cache",
+                normalizer.cache.hits,
+            )
+            out.sample(
+                "scrobbler_correction_cache_misses_total",
+                "counter",
+                "Track corrections looked up on Last.fm",
+                normalizer.cache.misses,
+            )
+            out.sample(
+                "scrobbler_correction_lookup_errors_total",
+                "counter",
+                "Track correction lookups that failed",
+                normalizer.correction_errors,
+            )
+
+    if config_watcher is not None:
+        out.sample(
+            "scrobbler_config_version",
+            "gauge",
+            "Version of the configuration in use, incremented by each reload",
+            config_watcher.snapshot.version,
+        )
+        for outcome, count in sorted(config_watcher.reloads.items()):
+            out.sample(
+                "scrobbler_config_reloads_total",
+                "counter",
+                "Configuration changes, by whether they were applied or rejected",
+                count,
+                outcome=outcome,
+            )
+
+    out.sample(
+        "scrobbler_log_events_dropped_total",
+        "counter",
+        "Log messages dropped because the output could not keep up",
+        log_events_dropped,
+    )
+
+    return out.render()
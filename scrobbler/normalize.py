@@ -0,0 +1,142 @@
+"""
+Clean-up of spin metadata before it is sent to Last.fm.
+
+Spins arrive exactly as DJs type them, and every spelling of an artist or track becomes its own
+entry in the station's Last.fm library. Each spin therefore goes through:
+
+1. Text rules, which are deterministic and cost nothing: Unicode normalization, whitespace
+   (including non-breaking and zero-width spaces), curly apostrophes and quotes, the "ft",
+   "feat" and "featuring" variants, and empty or placeholder album names.
+2. Optionally, Last.fm's track.getCorrection, which maps misspellings and odd casing to Last.fm's
+   canonical names. Corrections are cached on disk (see cache.DiskCache) under the casefolded
+   names, so repeat plays of a track, however they are cased, cost no further requests.
+"""
+
+import logging
+import re
+import time
+import unicodedata
+
+import requests as r
+
+from metrics import NORMALIZE_BUCKETS, Histogram
+
+log = logging.getLogger(__name__)
+
+_INVISIBLE = re.compile("[\u200b\u200c\u200d\u2060\ufeff]")
+_WHITESPACE = re.compile(r"\s+")
+_QUOTES = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"'})
+
+# "ft", "ft.", "feat", "Feat.", "featuring", ... between two names, or opening a parenthesis
+_FEATURING = re.compile(r"(?<=[\s(\[])(?:feat(?:uring)?|ft)\b\.?(?=\s)", re.IGNORECASE)
+
+# Album names DJs enter when there is no album
+_NO_RELEASE = frozenset(("", "-", "n/a", "na", "none", "unknown", "?"))
+
+
+def clean_text(value):
+    """
+    Applies the text rules to a name
+
+    Args:
+        value (str): An artist, track or album name, as typed into Spinitron
+    Returns:
+        str: The cleaned up name
+    """
+    text = unicodedata.normalize("NFC", value or "")
+    text = _INVISIBLE.sub("", text).translate(_QUOTES)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _FEATURING.sub("feat.", text)
+
+
+class Normalizer:
+    """
+    Cleans up the artist, track and album of each spin, counting how many it changed and
+    timing how long that took
+    """
+
+    def __init__(self, correct=None, cache=None, clock=time.perf_counter):
+        """
+        Args:
+            correct (callable, optional): Function taking an artist and track name and returning
+                the corrected pair, or None if there is no correction, such as
+                lastfm.LastfmAccount.get_correction. Corrections are not looked up if omitted
+            cache (cache.TTLCache, optional): Cache for the corrections, e.g. a cache.DiskCache.
+                Required when correct is given
+            clock (callable, optional): Function returning a time in seconds, for timing
+        """
+        self.correct = correct
+        self.cache = cache
+        self.clock = clock
+
+        self.spins = 0
+        self.cleaned = 0
+        self.corrected = 0
+        self.correction_errors = 0
+        # Seconds added to the handling of each spin
+        self.latency = Histogram(NORMALIZE_BUCKETS)
+
+    def _correction(self, artist, track):
+        """
+        Returns:
+            tuple: The corrected artist and track, or None if there is no correction or it
+                could not be looked up
+        """
+        try:
+            correction = self.cache.get_or_fetch(
+                ("track.getCorrection", artist.casefold(), track.casefold()),
+                lambda: self.correct(artist, track),
+            )
+        except r.RequestException as e:
+            self.correction_errors += 1
+            log.warning(
+                "Could not look up a correction for %s - %s: %s", artist, track, e
+            )
+            return None
+        return tuple(correction) if correction else None
+
+    def normalize(self, spin):
+        """
+        Cleans up a spin
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+        Returns:
+            dict: A copy of the spin with its artist, song and release cleaned up
+        """
+        started = self.clock()
+        artist = clean_text(spin["artist"])
+        song = clean_text(spin["song"])
+        release = clean_text(spin.get("release"))
+        if release.casefold() in _NO_RELEASE:
+            release = ""
+        if (artist, song, release) != (
+            spin["artist"],
+            spin["song"],
+            spin.get("release") or "",
+        ):
+            self.cleaned += 1
+
+        if self.correct is not None and artist and song:
+            correction = self._correction(artist, song)
+            if correction and correction != (artist, song):
+                artist, song = correction
+                self.corrected += 1
+
+        self.spins += 1
+        self.latency.observe(self.clock() - started)
+        return {**spin, "artist": artist, "song": song, "release": release}
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of the normalizer's counters
+        """
+        _, total = self.latency.snapshot()
+        text = (
+            f"{self.spins} spins, {self.cleaned} cleaned up, {self.corrected} corrected by Last.fm"
+            f", {1000 * total / self.spins if self.spins else 0:.1f} ms added per spin"
+        )
+        if self.correct is not None:
+            text += f"; corrections cache: {self.cache.summary()}, {self.correction_errors} lookups failed"
+        return text
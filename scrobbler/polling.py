@@ -0,0 +1,238 @@
+"""
+Poll interval strategies. A strategy decides how long a station waits before its next poll of
+Spinitron, based on when the spin on air is expected to end and how many polls in a row have
+found nothing new.
+
+The adaptive strategy polls quickly around the expected end of a spin, when the next spin is
+most likely to appear, and backs off exponentially (up to a cap) while a long track plays and
+while the station is overdue. Both strategies keep track of how often a spin was detected later than
+fixed-interval polling would have detected it, so the cost of backing off can be measured.
+"""
+
+import inspect
+from datetime import datetime, timezone
+
+
+class PollStrategy:
+    """
+    Base class for poll interval strategies. Subclasses implement interval().
+    """
+
+    name = "base"
+
+    def __init__(self, base_interval=15):
+        """
+        Args:
+            base_interval (float, optional): Interval of plain fixed-interval polling. Used after
+                errors, and as the reference that late detections are measured against
+        """
+        self.base_interval = base_interval
+        self.current_interval = base_interval
+        self.last_poll = None
+        self.previous_poll = None
+        self.detections = 0
+        self.late_detections = 0
+        self.missed_spins = 0
+
+    def interval(self, now, expected_end, miss_count):
+        """
+        Works out the next poll interval
+
+        Args:
+            now (datetime): The current time (UTC)
+            expected_end (datetime or None): When the most recent spin is expected to end
+            miss_count (int): Number of polls in a row that found no new spin
+        Returns:
+            float: Seconds to wait before polling again
+        """
+        raise NotImplementedError
+
+    def next_interval(self, expected_end, miss_count, now=None):
+        """
+        Records that a poll happened and returns the interval to wait before the next one
+
+        Args:
+            expected_end (datetime or None): When the most recent spin is expected to end
+            miss_count (int): Number of polls in a row that found no new spin
+            now (datetime, optional): The current time (UTC), defaults to now
+        Returns:
+            float: Seconds to wait before polling again
+        """
+        now = now or datetime.now(timezone.utc)
+        self.previous_poll, self.last_poll = self.last_poll, now
+        self.current_interval = self.interval(now, expected_end, miss_count)
+        return self.current_interval
+
+    def error_interval(self):
+        """
+        Returns:
+            float: Seconds to wait before polling again after a failed poll
+        """
+        self.current_interval = self.base_interval
+        return self.current_interval
+
+    def observe_spin(self, start, end, now=None):
+        """
+        Records the detection of a new spin, counting it as late if fixed-interval polling would
+        have noticed it sooner. These counts are estimates: the time a DJ entered a spin is not
+        known, so a spin is assumed to have been visible from the moment it started.
+
+        Args:
+            start (datetime): When the spin started
+            end (datetime): When the spin ends
+            now (datetime, optional): The current time (UTC), defaults to now
+        """
+        now = now or datetime.now(timezone.utc)
+        self.detections += 1
+        if self.previous_poll is None:
+            return
+        # The poll that fixed-interval polling would have made after the previous one
+        fixed_poll = self.previous_poll.timestamp() + self.base_interval
+        if now.timestamp() <= fixed_poll or start.timestamp() > fixed_poll:
+            return
+        if end <= now and end.timestamp() > fixed_poll:
+            # Fixed polling would have caught the spin while it was still playing
+            self.missed_spins += 1
+        elif end > now:
+            self.late_detections += 1
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of the strategy's state and counters
+        """
+        return (
+            f"{self.name} polling, current interval {self.current_interval:.0f}s, "
+            f"{self.detections} spins detected, {self.late_detections} detected late and "
+            f"{self.missed_spins} missed while backed off"
+        )
+
+
+class FixedInterval(PollStrategy):
+    """
+    Always polls at the base interval (the original behavior)
+    """
+
+    name = "fixed"
+
+    def interval(self, now, expected_end, miss_count):
+        return self.base_interval
+
+
+class AdaptiveInterval(PollStrategy):
+    """
+    Polls at min_interval around the expected end of the spin on air, when the next spin is most
+    likely to be entered, and backs off exponentially (by backoff_factor per poll) away from it:
+    during a long track from base_interval up to max_interval, but never past the start of the
+    end window, and once the spin is overdue from min_interval up to base_interval, so that a DJ
+    entering spins after the fact is noticed no later than with fixed polling. Each backoff starts
+    over when a new spin is seen, so polls that found nothing before a spin's end never count
+    towards the backoff after it.
+    """
+
+    name = "adaptive"
+
+    def __init__(
+        self,
+        base_interval=15,
+        min_interval=5,
+        max_interval=120,
+        end_window=10,
+        overdue_grace=30,
+        backoff_factor=2,
+    ):
+        """
+        Args:
+            base_interval (float, optional): Interval the backoff during a track starts from, and
+                the cap of the backoff once a spin is overdue
+            min_interval (float, optional): Interval used around the expected end of a spin, and
+                that the backoff once it is overdue starts from
+            max_interval (float, optional): Cap of the backoff during a track, and while no spin
+                has been seen at all
+            end_window (float, optional): Seconds before the expected end of a spin from which
+                polling is fast
+            overdue_grace (float, optional): Seconds after the expected end of a spin during which
+                polling stays fast
+            backoff_factor (float, optional): Factor the interval grows by with each poll
+        """
+        super().__init__(base_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.end_window = end_window
+        self.overdue_grace = overdue_grace
+        self.backoff_factor = backoff_factor
+        # The expected end and phase ("track" or "overdue") the current backoff belongs to, and
+        # the number of polls made in it so far
+        self._streak = None
+        self._streak_polls = 0
+
+    def _backoff(self, start, cap, polls):
+        return min(cap, start * self.backoff_factor**polls)
+
+    def _next_in_streak(self, key):
+        """
+        Returns:
+            int: The number of polls already made in the backoff identified by key
+        """
+        if key != self._streak:
+            self._streak = key
+            self._streak_polls = 0
+        polls = self._streak_polls
+        self._streak_polls += 1
+        return polls
+
+    def interval(self, now, expected_end, miss_count):
+        if expected_end is None:
+            # Nothing seen yet, so there is no end to aim for
+            return self._backoff(
+                self.base_interval, self.max_interval, max(0, miss_count - 1)
+            )
+
+        until_end = (expected_end - now).total_seconds()
+        if until_end > self.end_window:
+            # The next spin is rarely entered this early, but wake up for the end
+            polls = self._next_in_streak((expected_end, "track"))
+            return max(
+                self.min_interval,
+                min(
+                    self._backoff(self.base_interval, self.max_interval, polls),
+                    until_end - self.end_window,
+                ),
+            )
+        if until_end >= -self.overdue_grace:
+            # The next spin is most likely to show up now
+            return self.min_interval
+        # Overdue: the DJ may be entering spins after the fact, whenever that is
+        polls = self._next_in_streak((expected_end, "overdue"))
+        return self._backoff(self.min_interval, self.base_interval, polls)
+
+
+STRATEGIES = {
+    FixedInterval.name: FixedInterval,
+    AdaptiveInterval.name: AdaptiveInterval,
+}
+
+
+def make_strategy(name, **kwargs):
+    """
+    Creates a poll strategy by name
+
+    Args:
+        name (str): Name of the strategy, a key of STRATEGIES
+        **kwargs: Passed to the strategy's constructor. Arguments it does not take are ignored,
+            so the same settings can be passed to any strategy
+    Returns:
+        PollStrategy: The strategy
+    Raises:
+        ValueError: If there is no strategy with that name
+    """
+    try:
+        strategy_class = STRATEGIES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown poll strategy {name!r}, expected one of {', '.join(STRATEGIES)}"
+        ) from None
+    accepted = inspect.signature(strategy_class.__init__).parameters
+    return strategy_class(
+        **{key: value for key, value in kwargs.items() if key in accepted}
+    )
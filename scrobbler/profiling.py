@@ -0,0 +1,172 @@
+"""
+Per-stage timings of the scrobbler's hot path, recorded when it runs with --profile.
+
+The stages are:
+
+    poll    a whole check of Spinitron, from the request to the last Now Playing update
+    fetch   Spinitron requests, up to the response body being received
+    parse   JSON decoding of Spinitron responses, timestamp parsing and XML parsing of
+            Last.fm responses
+    filter  the schedule, rules and show filters applied to each new spin
+    sign    signing of Last.fm requests
+    submit  Last.fm requests (Now Playing updates and scrobbles)
+
+Stages other than poll do not overlap, so their totals show where the time of a poll goes. When
+profiling is off, timing a stage costs one attribute lookup.
+"""
+
+import threading
+import time
+from collections import deque
+
+STAGES = ("poll", "fetch", "parse", "filter", "sign", "submit")
+
+
+def _percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer:
+    __slots__ = ("profiler", "name", "started")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.started = self.profiler.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.profiler.clock() - self.started)
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Profiler:
+    """
+    Thread-safe collection of stage timings. Keeps the count, total and maximum of every stage,
+    and the most recent durations for percentiles.
+    """
+
+    def __init__(self, clock=time.perf_counter, samples=10000):
+        """
+        Args:
+            clock (callable, optional): Function returning a time in seconds
+            samples (int, optional): Number of recent durations kept per stage
+        """
+        self.clock = clock
+        self.samples = samples
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def enable(self):
+        """
+        Starts recording stage timings
+        """
+        self.enabled = True
+
+    def stage(self, name):
+        """
+        Times a stage, as a context manager:
+
+            with profiler.stage("fetch"):
+                response = client.get(url)
+
+        Args:
+            name (str): One of STAGES
+        Returns:
+            A context manager timing its block, which does nothing if profiling is off
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        """
+        Records one duration of a stage
+
+        Args:
+            name (str): One of STAGES
+            seconds (float): How long the stage took
+        """
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "recent": deque(maxlen=self.samples),
+                }
+            stage["count"] += 1
+            stage["total"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            stage["recent"].append(seconds)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: For every stage that ran, in the order of STAGES: its count, total, mean, p50,
+                p95 and max duration in seconds
+        """
+        with self._lock:
+            stages = {
+                name: (
+                    stage["count"],
+                    stage["total"],
+                    stage["max"],
+                    list(stage["recent"]),
+                )
+                for name, stage in self._stages.items()
+            }
+        order = {name: index for index, name in enumerate(STAGES)}
+        result = {}
+        for name in sorted(stages, key=lambda name: order.get(name, len(STAGES))):
+            count, total, maximum, recent = stages[name]
+            recent.sort()
+            result[name] = {
+                "count": count,
+                "total": total,
+                "mean": total / count,
+                "p50": _percentile(recent, 50),
+                "p95": _percentile(recent, 95),
+                "max": maximum,
+            }
+        return result
+
+    def summary(self):
+        """
+        Returns:
+            str: A table of the stage timings, in milliseconds
+        """
+        stages = self.snapshot()
+        if not stages:
+            return "No stages were timed"
+        lines = [
+            f"{'stage':<8}{'count':>9}{'total ms':>12}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}"
+        ]
+        for name, stage in stages.items():
+            lines.append(
+                f"{name:<8}{stage['count']:>9}{1000 * stage['total']:>12.1f}"
+                + "".join(
+                    f"{1000 * stage[key]:>9.3f}"
+                    for key in ("mean", "p50", "p95", "max")
+                )
+            )
+        return "\n".join(lines)
+
+
+# The profiler the scrobbler's modules time their stages with, off unless --profile is given
+profiler = Profiler()
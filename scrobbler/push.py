@@ -0,0 +1,176 @@
+"""
+Receiver for Spinitron's metadata push. Instead of waiting for the next poll, Spinitron calls
+the scrobbler as soon as a DJ logs a spin, and the spin is handled right away. Polling carries on
+at a slow interval to reconcile any push that was lost.
+
+Spinitron is configured to call http://<host>:4000/push (or /push/<station name> when several
+stations are configured) with the shared secret and the spin's fields as query or form
+parameters, for example:
+
+    http://example.org:4000/push?secret=...&id={{spin.id}}&playlist_id={{spin.playlist_id}}
+        &artist={{spin.artist|url_encode}}&song={{spin.song|url_encode}}
+        &release={{spin.release|url_encode}}&start={{spin.start}}&duration={{spin.duration}}
+
+A JSON body with the same keys is accepted too. The secret may also be sent in an X-Push-Secret
+header instead of the URL.
+"""
+
+import hmac
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs
+
+from dateutil import parser
+
+# Fields a push has to include
+REQUIRED_FIELDS = ("id", "playlist_id", "artist", "song", "start")
+
+_SPINITRON_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+class PushError(Exception):
+    """
+    Raised when a push is missing fields or has malformed ones
+    """
+
+
+def _parse_time(value):
+    """
+    Returns:
+        datetime: A push timestamp, given either as UNIX time or as an ISO 8601 string, in UTC
+    """
+    value = str(value).strip()
+    if value.replace(".", "", 1).isdigit():
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    parsed = parser.parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def parse_push(params):
+    """
+    Converts the fields of a push into a spin, in the same format the Spinitron API returns
+
+    Args:
+        params (dict): The pushed fields
+    Returns:
+        dict: The spin
+    Raises:
+        PushError: If a field is missing or malformed
+    """
+    missing = [field for field in REQUIRED_FIELDS if not params.get(field)]
+    if missing or not (params.get("duration") or params.get("end")):
+        raise PushError(
+            f"missing field(s): {', '.join(missing or ['duration or end'])}"
+        )
+    try:
+        start = _parse_time(params["start"])
+        if params.get("end"):
+            end = _parse_time(params["end"])
+            duration = int(params.get("duration") or (end - start).total_seconds())
+        else:
+            duration = int(float(params["duration"]))
+            end = start + timedelta(seconds=duration)
+        return {
+            "id": int(params["id"]),
+            "playlist_id": int(params["playlist_id"]),
+            "start": start.strftime(_SPINITRON_TIME_FORMAT),
+            "end": end.strftime(_SPINITRON_TIME_FORMAT),
+            "duration": duration,
+            "artist": params["artist"],
+            "song": params["song"],
+            "release": params.get("release") or "",
+        }
+    except (TypeError, ValueError, OverflowError) as e:
+        raise PushError(f"malformed field: {e}") from e
+
+
+def decode_body(body, content_type):
+    """
+    Decodes the body of a push request
+
+    Args:
+        body (bytes): The request body
+        content_type (str): The request's Content-Type header
+    Returns:
+        dict: The fields in the body
+    Raises:
+        PushError: If the body cannot be decoded
+    """
+    if not body:
+        return {}
+    try:
+        if "json" in (content_type or ""):
+            fields = json.loads(body)
+            if not isinstance(fields, dict):
+                raise PushError("JSON body is not an object")
+            return fields
+        return {
+            key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()
+        }
+    except (UnicodeDecodeError, ValueError) as e:
+        raise PushError(f"could not decode body: {e}") from e
+
+
+class PushReceiver:
+    """
+    Authenticates pushes and hands them to their station's scheduler
+    """
+
+    def __init__(self, secret, stations, scheduler):
+        """
+        Args:
+            secret (str): Shared secret every push has to carry
+            stations (list): The station.Station objects pushes can be addressed to
+            scheduler (scheduler.Scheduler): Scheduler the stations run on. Pushed spins are
+                handled there, like every other station task
+        """
+        self.secret = secret
+        self.stations = {station.name: station for station in stations}
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        # Number of pushes by outcome, for metrics
+        self.outcomes = {"accepted": 0, "unauthorized": 0, "invalid": 0}
+
+    def _count(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def handle(self, path, params, headers):
+        """
+        Handles one push request
+
+        Args:
+            path (str): Request path, /push or /push/<station name>
+            params (dict): Fields of the push, from the query string and body combined
+            headers (mapping): Request headers
+        Returns:
+            tuple: HTTP status code and response message
+        """
+        secret = headers.get("X-Push-Secret") or params.pop("secret", "")
+        if not hmac.compare_digest(str(secret).encode(), self.secret.encode()):
+            self._count("unauthorized")
+            return 401, "Invalid secret"
+
+        name = path[len("/push") :].strip("/")
+        if not name and len(self.stations) == 1:
+            station = next(iter(self.stations.values()))
+        else:
+            station = self.stations.get(name)
+        if station is None:
+            self._count("invalid")
+            return 404, f"Unknown station {name!r}"
+
+        try:
+            spin = parse_push(params)
+        except PushError as e:
+            self._count("invalid")
+            return 400, str(e)
+
+        self.scheduler.call_later(
+            0, station.receive_push, spin, name=f"push-{station.name}-{spin['id']}"
+        )
+        self._count("accepted")
+        return 202, "Accepted"
@@ -0,0 +1,109 @@
+"""
+Client-side rate limiting. Every request waits for a token from the bucket of the host it goes to
+and, where the caller names one, the bucket of the API key it is made with, so that running many
+stations and accounts in one process stays under the Last.fm and Spinitron quotas instead of
+running into their rate limit errors.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate. Tokens are reserved up front, so concurrent callers
+    queue up behind each other instead of all waking up at once.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        """
+        Args:
+            rate (float): Tokens added per second, i.e. the sustained request rate
+            capacity (float): Maximum number of tokens, i.e. the largest burst allowed
+            clock (callable, optional): Function returning the current time in seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Takes tokens from the bucket, going into debt if there are not enough
+
+        Args:
+            tokens (float, optional): Number of tokens to take
+        Returns:
+            float: Seconds the caller has to wait before its tokens are actually available
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    A TokenBucket per key (e.g. per host or per API key), created on first use
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            rate (float): Sustained requests per second allowed for each key. A rate of 0 or less
+                disables limiting
+            burst (int): Number of requests each key may make at once before being slowed down
+            clock (callable, optional): Function returning the current time in seconds
+            sleep (callable, optional): Function used to wait
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.waits = 0
+        self.waited = 0.0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Blocks until a request for a key is allowed
+
+        Args:
+            key (hashable): The key to charge the request to
+        Returns:
+            float: Seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.burst, self.clock
+                )
+        delay = bucket.reserve()
+        if delay > 0:
+            with self._lock:
+                self.waits += 1
+                self.waited += delay
+            self.sleep(delay)
+        return delay
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of the limiter and how often it waited
+        """
+        if self.rate <= 0:
+            return "disabled"
+        return (
+            f"{self.rate:g} requests/s (burst {self.burst}), "
+            f"{self.waits} requests delayed for {self.waited:.1f} s in total"
+        )
@@ -0,0 +1,142 @@
+"""
+Detection of spins that DJs edit or delete in Spinitron after they were first seen.
+
+DJs often fix a typo in the artist or title of a spin after it aired, and sometimes delete a spin
+that was entered by mistake. Each poll returns the most recent spins anyway, so a SpinIndex keeps
+a digest of every spin the station handled, whether or not it passed the rules, and compares the
+polled window against it: a known spin with a new digest was edited, and a known spin that should
+be in the window but is not was deleted (or moved outside the window by an edit of its start time, which the station checks with
+one request for the spin). Polls that Spinitron answers with 304 Not Modified cannot contain an
+edit, so they are not compared at all.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from dateutil import parser
+
+# The spin fields an edit is detected in, besides the start time. The end is left out: it follows
+# from the start and duration, and pushed spins (see push.py) may only have had it worked out
+# locally.
+DIGEST_FIELDS = ("playlist_id", "duration", "artist", "song", "release")
+
+# Format of Spinitron's timestamps, which is parsed much faster than by dateutil
+_SPINITRON_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def _timestamp(value):
+    """
+    Returns:
+        float: The UNIX time of a Spinitron timestamp, in whatever format it was written
+    """
+    try:
+        return datetime.strptime(value, _SPINITRON_TIME_FORMAT).timestamp()
+    except ValueError:
+        return parser.parse(value).timestamp()
+
+
+def spin_digest(spin):
+    """
+    Returns:
+        str: A short hash of the fields of a spin the scrobbler uses, the same however the spin
+            was received: times are compared as UNIX times, and a missing value and an empty one
+            are the same
+    """
+    values = [_timestamp(spin["start"])]
+    values.extend(spin.get(key) or "" for key in DIGEST_FIELDS)
+    content = json.dumps(values, ensure_ascii=False)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class SpinIndex:
+    """
+    The digests, start times (as UNIX times, which compare much faster than timezone-aware
+    datetimes) and rule outcomes of the most recently added spins, keyed by spin id and bounded
+    to a fixed size
+    """
+
+    def __init__(self, maxlen=200):
+        """
+        Args:
+            maxlen (int, optional): Number of spins remembered. The oldest spin is forgotten once
+                this is exceeded
+        """
+        self.maxlen = maxlen
+        self._spins = OrderedDict()
+
+    def __contains__(self, spin_id):
+        return spin_id in self._spins
+
+    def __len__(self):
+        return len(self._spins)
+
+    def add(self, spin, allowed=True):
+        """
+        Remembers a spin as it is now, replacing what was remembered of it before
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            allowed (bool, optional): Whether the spin passed the station's rules
+        """
+        self._spins[spin["id"]] = (
+            spin_digest(spin),
+            _timestamp(spin["start"]),
+            allowed,
+        )
+        self._spins.move_to_end(spin["id"])
+        while len(self._spins) > self.maxlen:
+            self._spins.popitem(last=False)
+
+    def has_changed(self, spin):
+        """
+        Returns:
+            bool: True if the spin is remembered with different content
+        """
+        known = self._spins.get(spin["id"])
+        return known is not None and known[0] != spin_digest(spin)
+
+    def was_allowed(self, spin_id):
+        """
+        Returns:
+            bool: Whether the spin passed the station's rules when it was last added
+        """
+        known = self._spins.get(spin_id)
+        return known is not None and known[2]
+
+    def discard(self, spin_id):
+        """
+        Forgets a spin
+        """
+        self._spins.pop(spin_id, None)
+
+    def compare(self, spins, complete=False):
+        """
+        Compares a poll's window of the most recent spins against the remembered spins
+
+        Args:
+            spins (list): The polled spins, newest first
+            complete (bool, optional): Whether the window holds every spin of the station, i.e.
+                Spinitron returned fewer spins than were asked for
+        Returns:
+            tuple: The remembered spins that were edited, as they are now, and the ids of the
+                remembered spins missing from the window although they started within it
+        """
+        if not spins:
+            return [], []
+        edited = []
+        polled = set()
+        for spin in spins:
+            polled.add(spin["id"])
+            if self.has_changed(spin):
+                edited.append(spin)
+        # Spins that started at the same time as the oldest polled spin may have been cut off by
+        # the count, so only later ones are known to be missing
+        oldest = _timestamp(spins[-1]["start"])
+        missing = [
+            spin_id
+            for spin_id, (_, start, _) in self._spins.items()
+            if spin_id not in polled and (complete or start > oldest)
+        ]
+        return edited, missing
@@ -0,0 +1,390 @@
+"""
+Offline benchmark of the polling loop: replays a recorded (or synthesized) broadcast day against
+the local stand-in server (standin.py) on a clock running many times faster than real time, and
+reports how well the scrobbler kept up:
+
+    requests per spin    Spinitron requests made, divided by the number of spins in the day
+    detection latency    Time from a spin being entered to the scrobbler first fetching it
+    missed spins         Spins that should have been scrobbled but were not
+    duplicate scrobbles  Scrobbles submitted more than once
+
+Usage:
+
+    python replay.py [recording.json] [--speed 1000] [--strategy adaptive]
+
+Without a recording, a broadcast day is synthesized (see synthesize_day()). Every request still
+goes over a real local socket, so at 1000x each millisecond a request takes shows up as a second
+of detection latency; compare runs made at the same speed.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from cache import TTLCache
+from clock import WarpedClock
+from http_client import HttpClient
+from lastfm import LastfmAccount
+from logs import setup_logging
+from polling import STRATEGIES, make_strategy
+from profiling import profiler
+from retry import RetryPolicy
+from scheduler import Scheduler
+from scrobble_queue import ScrobbleJournal, ScrobbleWorker
+from spinitron import SpinitronAPI
+from standin import STANDIN_SESSION_KEY, StandInServer, load_recording
+from station import Station
+
+STANDIN_API_KEY = "standin-key"
+STANDIN_SECRET = "standin-secret"
+
+_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def synthesize_day(date, seed=0):
+    """
+    Generates a plausible broadcast day: automation overnight, then two-hour shows whose DJs
+    either log spins as they play them or enter them in batches after the fact, with occasional
+    short station IDs and tracks cut short
+
+    Args:
+        date (datetime.date): The day to generate
+        seed (int, optional): Seed of the random generator, so that a day can be regenerated
+    Returns:
+        dict: A recording, see standin.py
+    """
+    rng = random.Random(seed)
+    day_start = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+    playlists, personas, spins = [], [], []
+    # A show starts once the previous show's last track has finished
+    start = day_start
+
+    for index, show_start_hour in enumerate([0] + list(range(6, 24, 2))):
+        automation = show_start_hour == 0
+        show_end_hour = 6 if automation else show_start_hour + 2
+        playlist_id, persona_id = 1000 + index, 2000 + index
+        playlists.append(
+            {
+                "id": playlist_id,
+                "title": "Automation" if automation else f"Show {index}",
+                "category": "Automation" if automation else "Music",
+                "persona_id": persona_id,
+            }
+        )
+        personas.append({"id": persona_id, "name": f"DJ {index}"})
+        batch_entry = not automation and rng.random() < 0.3
+
+        start = max(start, day_start + timedelta(hours=show_start_hour))
+        show_end = day_start + timedelta(hours=show_end_hour)
+        batch = []
+        while start < show_end:
+            duration = rng.choice([rng.randint(10, 25)] + [rng.randint(120, 420)] * 9)
+            played = duration
+            if duration > 60 and rng.random() < 0.05:
+                # Faded out early
+                played = rng.randint(20, duration - 30)
+            end = start + timedelta(seconds=duration)
+            spin = {
+                "playlist_id": playlist_id,
+                "start": start,
+                "end": end,
+                "duration": duration,
+                "artist": f"Artist {rng.randint(1, 500)}",
+                "song": f"Song {len(spins) + 1}",
+                "release": f"Album {rng.randint(1, 300)}",
+                "entered": start + timedelta(seconds=rng.randint(0, 20)),
+            }
+            spins.append(spin)
+            batch.append(spin)
+            if batch_entry and (len(batch) >= rng.randint(3, 6) or end >= show_end):
+                # Entered all at once, after the last of them finished
+                entered = end + timedelta(seconds=rng.randint(0, 120))
+                for batched in batch:
+                    batched["entered"] = entered
+                batch = []
+            elif not batch_entry:
+                batch = []
+            start += timedelta(seconds=played + rng.randint(0, 10))
+
+    # Spinitron numbers spins in the order they are entered
+    spins.sort(key=lambda spin: (spin["entered"], spin["start"]))
+    for spin_id, spin in enumerate(spins, start=1):
+        spin["id"] = spin_id
+        for key in ("start", "end", "entered"):
+            spin[key] = spin[key].strftime(_TIME_FORMAT)
+    return {"spins": spins, "playlists": playlists, "personas": personas}
+
+
+def expected_scrobbles(recording):
+    """
+    Works out which spins of a recording should end up scrobbled: those over 30 seconds long, in
+    shows that are not automation, and not cut short before half their length (or 4 minutes).
+    A spin cut short later than that, by a spin entered before it was due to end, is
+    timestamped when the next spin started
+
+    Args:
+        recording (dict): The recording
+    Returns:
+        set: (artist, track, timestamp) of every expected scrobble
+    """
+    playlists = {playlist["id"]: playlist for playlist in recording["playlists"]}
+    spins = sorted(recording["spins"], key=lambda spin: (spin["start"], spin["id"]))
+    expected = set()
+    for spin, next_spin in zip(spins, spins[1:] + [None]):
+        category = playlists[spin["playlist_id"]]["category"]
+        if not category or category == "Automation" or spin["duration"] <= 30:
+            continue
+        start, end = parser.parse(spin["start"]), parser.parse(spin["end"])
+        if next_spin is not None:
+            next_start = parser.parse(next_spin["start"])
+            played = (next_start - start).total_seconds()
+            if next_start < end:
+                if played < min(spin["duration"] / 2, 240):
+                    continue
+                if parser.parse(next_spin.get("entered") or next_spin["start"]) < end:
+                    # Seen while the spin was on air, so scrobbled when it was cut short
+                    end = next_start
+        expected.add((spin["artist"], spin["song"], int(end.timestamp())))
+    return expected
+
+
+@contextlib.contextmanager
+def _quiet():
+    """
+    Silences the scrobbler's log messages while the replay runs
+    """
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def replay(
+    recording, speed=1000, strategy="adaptive", poll_spin_count=5, verbose=False
+):
+    """
+    Replays a recording against the stand-in server and measures the result
+
+    Args:
+        recording (dict): The recording
+        speed (float, optional): How many times faster than real time to run
+        strategy (str, optional): Name of the poll strategy to use, see polling.STRATEGIES
+        poll_spin_count (int, optional): Number of spins fetched per poll
+        verbose (bool, optional): Whether to show the scrobbler's own output
+    Returns:
+        dict: The measurements, see print_report()
+    """
+    first_entered = min(
+        parser.parse(spin.get("entered") or spin["start"]).timestamp()
+        for spin in recording["spins"]
+    )
+    last_end = max(parser.parse(spin["end"]).timestamp() for spin in recording["spins"])
+    clock = WarpedClock(start=first_entered + 1, speed=speed)
+
+    server = StandInServer(("127.0.0.1", 0), recording, STANDIN_SECRET, clock)
+    server.start()
+    # Rate limits and retries are real-time waits, which would distort the warped clock
+    client = HttpClient(
+        host_rate_limit=0,
+        key_rate_limit=0,
+        retry_policy=RetryPolicy(max_attempts=1),
+    )
+    scheduler = Scheduler(clock)
+    scrobble_worker = ScrobbleWorker(clock=clock)
+    real_start = time.perf_counter()
+
+    output = contextlib.nullcontext() if verbose else _quiet()
+    with tempfile.TemporaryDirectory() as journal_dir, output:
+        account = LastfmAccount(
+            "replay",
+            STANDIN_API_KEY,
+            STANDIN_SECRET,
+            client,
+            session_key=STANDIN_SESSION_KEY,
+            api_url=f"{server.url}/2.0/",
+        )
+        account.scrobble_journal = ScrobbleJournal(
+            os.path.join(journal_dir, "scrobble_queue.jsonl")
+        )
+        account.scrobble_queue = scrobble_worker.add_queue(
+            "replay",
+            account.scrobble_journal,
+            account.submit,
+            now_playing=account.now_playing,
+        )
+        station = Station(
+            name="replay",
+            spinitron=SpinitronAPI(
+                client,
+                STANDIN_API_KEY,
+                TTLCache(clock=clock.monotonic),
+                base_url=f"{server.url}/api",
+            ),
+            accounts=[account],
+            scheduler=scheduler,
+            scrobble_worker=scrobble_worker,
+            poll_strategy=make_strategy(strategy),
+            poll_spin_count=poll_spin_count,
+            clock=clock,
+        )
+
+        scrobble_worker.start()
+        station.start()
+        scheduler.call_at(
+            clock.monotonic() + last_end + 300 - clock.time(),
+            scheduler.stop,
+            name="end-of-replay",
+        )
+        scheduler.run_forever()
+
+        # Give the worker a moment to submit what is left
+        deadline = time.monotonic() + 10
+        scrobble_worker.notify()
+        while scrobble_worker.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        scrobble_worker.stop()
+        scrobble_worker.join(timeout=5)
+        account.scrobble_journal.close()
+    real_seconds = time.perf_counter() - real_start
+    server.shutdown()
+    server.server_close()
+    client.close()
+
+    latencies = [
+        served - server.entered[spin_id]
+        for spin_id, served in server.first_served.items()
+    ]
+    submitted = [
+        (scrobble["artist"], scrobble["track"], scrobble["timestamp"])
+        for scrobble in server.scrobbles
+    ]
+    expected = expected_scrobbles(recording)
+    spin_count = len(recording["spins"])
+    return {
+        "spins": spin_count,
+        "replayed_hours": (last_end - first_entered) / 3600,
+        "real_seconds": real_seconds,
+        "spinitron_requests": server.spinitron_requests,
+        "not_modified": server.not_modified,
+        "requests_per_spin": server.spinitron_requests / spin_count,
+        "lastfm_requests": server.lastfm_requests,
+        "now_playing": len(server.now_playing),
+        "undetected": spin_count - len(server.first_served),
+        "latency_mean": statistics.mean(latencies) if latencies else 0.0,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p95": _percentile(latencies, 95),
+        "latency_max": max(latencies, default=0.0),
+        "expected_scrobbles": len(expected),
+        "scrobbles": len(submitted),
+        "missed": len(expected - set(submitted)),
+        "unexpected": len(set(submitted) - expected),
+        "duplicates": len(submitted) - len(set(submitted)),
+        "bad_signatures": server.bad_signatures,
+        "poll_strategy": station.poll_strategy.summary(),
+    }
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def print_report(report):
+    """
+    Prints the measurements returned by replay()
+    """
+    print(
+        f"Replayed {report['replayed_hours']:.1f} hours ({report['spins']} spins) in "
+        f"{report['real_seconds']:.1f} s"
+    )
+    print(
+        f"Spinitron requests : {report['spinitron_requests']} "
+        f"({report['requests_per_spin']:.2f} per spin, {report['not_modified']} not modified)"
+    )
+    print(
+        f"Last.fm requests   : {report['lastfm_requests']} "
+        f"({report['now_playing']} Now Playing updates)"
+    )
+    print(
+        f"Detection latency  : mean {report['latency_mean']:.1f} s, "
+        f"p50 {report['latency_p50']:.1f} s, p95 {report['latency_p95']:.1f} s, "
+        f"max {report['latency_max']:.1f} s ({report['undetected']} spins never fetched)"
+    )
+    print(
+        f"Scrobbles          : {report['scrobbles']} submitted, "
+        f"{report['expected_scrobbles']} expected"
+    )
+    print(f"Missed spins       : {report['missed']}")
+    print(f"Unexpected         : {report['unexpected']}")
+    print(f"Duplicate scrobbles: {report['duplicates']}")
+    if report["bad_signatures"]:
+        print(f"Bad signatures     : {report['bad_signatures']}")
+    print(f"Poll strategy      : {report['poll_strategy']}")
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Replay a broadcast day against the local stand-in server"
+    )
+    cli_parser.add_argument(
+        "recording", nargs="?", help="Recording to replay (synthesized if omitted)"
+    )
+    cli_parser.add_argument("--speed", type=float, default=1000)
+    cli_parser.add_argument(
+        "--strategy", choices=sorted(STRATEGIES), default="adaptive"
+    )
+    cli_parser.add_argument("--poll-spin-count", type=int, default=5)
+    cli_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the synthesized day"
+    )
+    cli_parser.add_argument(
+        "--save", metavar="PATH", help="Also write the synthesized day to PATH"
+    )
+    cli_parser.add_argument(
+        "--verbose", action="store_true", help="Show the scrobbler's own output"
+    )
+    cli_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also print how long each stage of polling and scrobbling took",
+    )
+    args = cli_parser.parse_args()
+    if args.verbose:
+        setup_logging()
+    if args.profile:
+        profiler.enable()
+
+    if args.recording:
+        day = load_recording(args.recording)
+    else:
+        day = synthesize_day(
+            (datetime.now(timezone.utc) - timedelta(days=1)).date(), args.seed
+        )
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as save_file:
+                json.dump(day, save_file, indent=2)
+
+    print_report(
+        replay(
+            day,
+            speed=args.speed,
+            strategy=args.strategy,
+            poll_spin_count=args.poll_spin_count,
+            verbose=args.verbose,
+        )
+    )
+    if args.profile:
+        print("Stage timings (ms):")
+        print(profiler.summary())
@@ -0,0 +1,152 @@
+"""
+Retry policy for API requests. A classifier decides whether a response succeeded, failed for
+good, or failed in a way that may go away on its own; only the last kind is retried, after a
+jittered exponential backoff, so that errors such as an invalid session key fail immediately and
+many clients recovering from the same outage do not retry in lockstep.
+"""
+
+import random
+import threading
+import time
+
+import requests as r
+
+# Outcomes of a request, as returned by a classifier
+SUCCESS = "success"
+RETRYABLE = "retryable"
+FATAL = "fatal"
+
+# Rate limited, or the server (or a proxy in front of it) is temporarily unavailable
+RETRYABLE_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+# Methods that can be repeated without changing the result. Other requests (track.scrobble and
+# ListenBrainz submissions are POSTs) may have been carried out even if no response arrived in
+# time, so they are only retried when the connection could not be made
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+
+def classify_http(response):
+    """
+    Classifies a response by its HTTP status code alone
+
+    Args:
+        response (requests.Response): The response
+    Returns:
+        str: SUCCESS, RETRYABLE or FATAL
+    """
+    if response.ok:
+        return SUCCESS
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        return RETRYABLE
+    return FATAL
+
+
+def retry_after(response):
+    """
+    Returns:
+        float or None: Seconds the server asked the client to wait in its Retry-After header, if
+            it sent one as a number of seconds
+    """
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retries retryable failures with "full jitter" exponential backoff: the wait before retry n is
+    drawn uniformly between 0 and min(max_delay, base_delay * 2 ** n).
+    """
+
+    def __init__(
+        self,
+        max_attempts=3,
+        base_delay=1.0,
+        max_delay=10.0,
+        sleep=time.sleep,
+        random=random.random,
+    ):
+        """
+        Args:
+            max_attempts (int, optional): Total number of attempts, including the first
+            base_delay (float, optional): Upper bound of the wait before the first retry
+            max_delay (float, optional): Upper bound of any wait. A server asking for a longer
+                wait (Retry-After) is not retried, and the failure is left to the caller
+            sleep (callable, optional): Function used to wait
+            random (callable, optional): Function returning a float in [0, 1)
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.random = random
+        self.retries = 0
+        self.gave_up = 0
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt):
+        """
+        Args:
+            attempt (int): Number of attempts made so far (1 after the first failure)
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+        return self.random() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+    def call(self, send, classify=classify_http, idempotent=True):
+        """
+        Sends a request, retrying it while it fails in a retryable way
+
+        Args:
+            send (callable): Function making one attempt and returning a requests.Response
+            classify (callable, optional): Function returning SUCCESS, RETRYABLE or FATAL for a
+                response
+            idempotent (bool, optional): Whether the request can safely be repeated after it
+                timed out waiting for a response, which the server may have acted on
+        Returns:
+            requests.Response: The response of the last attempt
+        Raises:
+            requests.RequestException: If the last attempt failed at the transport level.
+                Connection errors are retried, and so are read timeouts of idempotent requests;
+                other transport errors are not
+        """
+        transient = (r.ConnectionError, r.Timeout) if idempotent else r.ConnectionError
+        attempt = 0
+        while True:
+            attempt += 1
+            last_attempt = attempt >= self.max_attempts
+            try:
+                response = send()
+            except transient:
+                if last_attempt:
+                    self._count(gave_up=True)
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if classify(response) != RETRYABLE:
+                    return response
+                requested = retry_after(response)
+                if last_attempt or (requested or 0) > self.max_delay:
+                    self._count(gave_up=True)
+                    return response
+                delay = max(self.backoff(attempt), requested or 0)
+            self._count()
+            self.sleep(delay)
+
+    def _count(self, gave_up=False):
+        with self._lock:
+            if gave_up:
+                self.gave_up += 1
+            else:
+                self.retries += 1
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of how often requests were retried
+        """
+        return (
+            f"up to {self.max_attempts} attempts per request, {self.retries} retries, "
+            f"{self.gave_up} requests given up on"
+        )
@@ -0,0 +1,362 @@
+"""
+Rules deciding which spins are sent to Last.fm: when scrobbling is on, and which categories,
+shows, personas and artists are allowed or denied.
+
+Without a rule file, scrobbling runs between the start_hour and end_hour of schedule.json (UTC,
+every day) and spins from playlists in the "Automation" category or without a category are
+skipped, as before. A rule file (/env/rules.json by default) replaces this:
+
+    {
+      "timezone": "America/New_York",
+      "windows": [
+        {"days": ["mon", "tue", "wed", "thu", "fri"], "start": "06:00", "end": "24:00"},
+        {"days": ["sat", "sun"], "start": "10:00", "end": "02:00"}
+      ],
+      "allow": {"categories": [], "shows": [], "personas": [], "artists": []},
+      "deny": {"categories": ["Automation", ""], "shows": ["Test Show"]},
+      "min_duration": 60
+    }
+
+Window times are in "timezone" ("UTC" if left out) and a window whose end is before its start
+runs past midnight into the next day. "days" defaults to every day and "windows" to all week.
+Names are matched case-insensitively and an empty string stands for a missing value. A spin is
+skipped if any of its values is denied, or if an allow list is not empty and does not contain it.
+
+The file is compiled when it is loaded: the windows into a table with one entry per minute of the
+week, and the lists into sets, so checking a spin is a handful of lookups however long the lists
+are. To see why a spin was or was not scrobbled, run the scrobbler with --explain SPIN_ID.
+"""
+
+import json
+import os
+from datetime import timedelta, timezone
+
+from dateutil import parser, tz
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+FIELDS = ("categories", "shows", "personas", "artists")
+
+_MINUTES_PER_DAY = 24 * 60
+_MINUTES_PER_WEEK = 7 * _MINUTES_PER_DAY
+
+
+class RuleError(Exception):
+    """
+    Raised when a rule file is malformed
+    """
+
+
+def _key(value):
+    return str(value or "").strip().casefold()
+
+
+def _parse_minute(value, name):
+    """
+    Returns:
+        int: Minutes after midnight of a "HH:MM" time, up to 24:00
+    """
+    try:
+        hours, minutes = (int(part) for part in str(value).split(":"))
+    except ValueError as e:
+        raise RuleError(f"{name} must be a time such as 06:30, not {value!r}") from e
+    if not (0 <= minutes < 60 and 0 <= hours * 60 + minutes <= _MINUTES_PER_DAY):
+        raise RuleError(f"{name} {value!r} is not a time of day")
+    return hours * 60 + minutes
+
+
+class RuleSet:
+    """
+    A compiled rule file
+    """
+
+    def __init__(
+        self,
+        windows=None,
+        timezone_name="UTC",
+        allow=None,
+        deny=None,
+        min_duration=0,
+        source="defaults",
+    ):
+        """
+        Args:
+            windows (list, optional): Windows of the week scrobbling is on during, as dicts with
+                "days", "start" and "end" keys. All week if left out
+            timezone_name (str, optional): Time zone the windows are in
+            allow (dict, optional): Lists of allowed values, keyed by one of FIELDS
+            deny (dict, optional): Lists of denied values, keyed by one of FIELDS
+            min_duration (int, optional): Shortest spin, in seconds, that is scrobbled
+            source (str, optional): Where the rules came from, for messages
+        Raises:
+            RuleError: If a value is malformed
+        """
+        self.source = source
+        self.timezone_name = timezone_name
+        self.timezone = tz.gettz(timezone_name)
+        if self.timezone is None:
+            raise RuleError(f"Unknown timezone {timezone_name!r} in {source}")
+        try:
+            self.min_duration = int(min_duration)
+        except (TypeError, ValueError) as e:
+            raise RuleError(f"min_duration in {source} must be a number") from e
+
+        self.windows = (
+            windows
+            if windows is not None
+            else [{"days": list(DAYS), "start": "00:00", "end": "24:00"}]
+        )
+        self._open = self._compile_windows(self.windows)
+        self._until_open = self._compile_until_open(self._open)
+        self.allow = self._compile_lists(allow or {}, "allow")
+        self.deny = self._compile_lists(deny or {}, "deny")
+
+    @classmethod
+    def from_hours(cls, start_hour, end_hour):
+        """
+        Builds the rules used when there is no rule file
+
+        Args:
+            start_hour (int): Hour (UTC) to start scrobbling at
+            end_hour (int): Hour (UTC) to stop scrobbling at
+        Returns:
+            RuleSet: The rules
+        """
+        return cls(
+            windows=[
+                {
+                    "days": list(DAYS),
+                    "start": f"{start_hour:02d}:00",
+                    "end": f"{end_hour:02d}:00",
+                }
+            ],
+            deny={"categories": ["Automation", ""]},
+            source="schedule.json",
+        )
+
+    def _compile_windows(self, windows):
+        """
+        Returns:
+            bytearray: 1 for every minute of the week (Monday 00:00 first) scrobbling is on
+        """
+        minutes = bytearray(_MINUTES_PER_WEEK)
+        for window in windows:
+            try:
+                days = window.get("days") or DAYS
+                start = _parse_minute(window["start"], f"Window start in {self.source}")
+                end = _parse_minute(window["end"], f"Window end in {self.source}")
+            except (AttributeError, KeyError) as e:
+                raise RuleError(
+                    f"Every window in {self.source} needs a start and an end"
+                ) from e
+            if start == end:
+                raise RuleError(
+                    f"Window {window['start']}-{window['end']} in {self.source} is empty"
+                )
+            length = end - start if end > start else _MINUTES_PER_DAY - start + end
+            for day in days:
+                if _key(day)[:3] not in DAYS:
+                    raise RuleError(f"Unknown day {day!r} in {self.source}")
+                first = DAYS.index(_key(day)[:3]) * _MINUTES_PER_DAY + start
+                for minute in range(first, first + length):
+                    minutes[minute % _MINUTES_PER_WEEK] = 1
+        if not any(minutes):
+            raise RuleError(f"{self.source} does not allow scrobbling at any time")
+        return minutes
+
+    @staticmethod
+    def _compile_until_open(open_minutes):
+        """
+        Returns:
+            list: For every minute of the week, the number of minutes until scrobbling is on
+        """
+        until_open = [0] * _MINUTES_PER_WEEK
+        distance = _MINUTES_PER_WEEK
+        # Two passes backwards around the week, so that waits wrap from Sunday into Monday
+        for minute in reversed(range(2 * _MINUTES_PER_WEEK)):
+            index = minute % _MINUTES_PER_WEEK
+            distance = 0 if open_minutes[index] else distance + 1
+            until_open[index] = distance
+        return until_open
+
+    def _compile_lists(self, lists, name):
+        """
+        Returns:
+            dict: A frozenset of normalized values for each of FIELDS
+        """
+        if not isinstance(lists, dict) or set(lists) - set(FIELDS):
+            raise RuleError(
+                f'"{name}" in {self.source} may only list {", ".join(FIELDS)}'
+            )
+        for field in FIELDS:
+            values = lists.get(field)
+            # A bare string would otherwise be taken as a list of its characters
+            if values is not None and not (
+                isinstance(values, list)
+                and all(isinstance(value, str) for value in values)
+            ):
+                raise RuleError(
+                    f'"{name}" {field} in {self.source} must be a list of names, not {values!r}'
+                )
+        return {field: frozenset(map(_key, lists.get(field) or ())) for field in FIELDS}
+
+    def _minute_of_week(self, when):
+        local = when.astimezone(self.timezone)
+        return local.weekday() * _MINUTES_PER_DAY + local.hour * 60 + local.minute
+
+    def in_schedule(self, when):
+        """
+        Args:
+            when (datetime): A timezone-aware time
+        Returns:
+            bool: True if scrobbling is on at that time
+        """
+        return bool(self._open[self._minute_of_week(when)])
+
+    def seconds_until_open(self, when):
+        """
+        Args:
+            when (datetime): A timezone-aware time
+        Returns:
+            float: Seconds from that time until scrobbling is next on, 0 if it is on
+        """
+        minutes = self._until_open[self._minute_of_week(when)]
+        if not minutes:
+            return 0
+        # The windows are in wall-clock time, so the opening is worked out on the wall clock and
+        # only then converted, which keeps it right across a daylight saving time change
+        local = when.astimezone(self.timezone).replace(
+            tzinfo=None, second=0, microsecond=0
+        )
+        start = tz.resolve_imaginary(
+            (local + timedelta(minutes=minutes)).replace(tzinfo=self.timezone)
+        )
+        # Converted to UTC, as aware times in the same timezone subtract by wall clock
+        return max(0.0, (start.astimezone(timezone.utc) - when).total_seconds())
+
+    def _values(self, spin, playlist, persona):
+        return {
+            "categories": playlist.get("category"),
+            "shows": playlist.get("title"),
+            "personas": (persona or {}).get("name"),
+            "artists": spin.get("artist"),
+        }
+
+    def _check_list(self, field, value):
+        """
+        Returns:
+            str: Why the value is not allowed, or None if it is
+        """
+        key = _key(value)
+        label = field[:-1] if field != "categories" else "category"
+        if key in self.deny[field]:
+            return f"{label} `{value}` is denied"
+        if self.allow[field] and key not in self.allow[field]:
+            return f"{label} `{value}` is not in the allow list"
+        return None
+
+    def evaluate(self, spin, playlist, persona):
+        """
+        Checks a spin against the rules, stopping at the first one it breaks
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            persona (dict): The persona hosting the playlist
+        Returns:
+            tuple: The name of the rule the spin breaks ("schedule", one of FIELDS or
+                "duration") and the reason, or None if the spin is allowed
+        """
+        return next(
+            (
+                (rule, reason)
+                for rule, passed, reason in self.explain(spin, playlist, persona)
+                if not passed
+            ),
+            None,
+        )
+
+    def explain(self, spin, playlist, persona):
+        """
+        Checks a spin against every rule. Rules are checked lazily, in the same order as
+        evaluate()
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            persona (dict): The persona hosting the playlist
+        Yields:
+            tuple: The name of each rule, whether the spin passes it, and why
+        """
+        start = parser.parse(spin["start"])
+        local = start.astimezone(self.timezone)
+        yield (
+            "schedule",
+            self.in_schedule(start),
+            f"began {local.strftime('%a %H:%M')} {self.timezone_name}",
+        )
+        for field, value in self._values(spin, playlist, persona).items():
+            reason = self._check_list(field, value)
+            yield field, reason is None, reason or f"`{value}` is allowed"
+        yield (
+            "duration",
+            spin["duration"] >= self.min_duration,
+            f"{spin['duration']}s, minimum {self.min_duration}s",
+        )
+
+    def describe(self):
+        """
+        Returns:
+            list: Lines summarizing the rules, for the startup banner
+        """
+        lines = [f"Rules from {self.source}:"]
+        for window in self.windows:
+            days = window.get("days") or DAYS
+            days = "every day" if len(days) == 7 else ", ".join(days)
+            lines.append(
+                f"Scrobbling {window['start']}-{window['end']} {self.timezone_name}, {days}"
+            )
+        for name, lists in (("Allowing only", self.allow), ("Denying", self.deny)):
+            for field, values in lists.items():
+                if values:
+                    shown = ", ".join(
+                        sorted(f"`{value}`" if value else "(none)" for value in values)
+                    )
+                    lines.append(f"{name} {field}: {shown}")
+        if self.min_duration:
+            lines.append(f"Skipping spins shorter than {self.min_duration}s")
+        return lines
+
+
+def load_rules(path, start_hour, end_hour):
+    """
+    Loads and compiles a rule file, or the defaults built from schedule.json if there is none
+
+    Args:
+        path (str): Location of the optional rule file
+        start_hour (int): Hour (UTC) to start scrobbling at without a rule file
+        end_hour (int): Hour (UTC) to stop scrobbling at without a rule file
+    Returns:
+        RuleSet: The compiled rules
+    Raises:
+        RuleError: If the file is malformed
+    """
+    if not path or not os.path.exists(path):
+        return RuleSet.from_hours(start_hour, end_hour)
+    try:
+        with open(path, "r") as rules_file:
+            data = json.load(rules_file)
+    except (OSError, ValueError) as e:
+        raise RuleError(f"Could not read {path}: {e}") from e
+    if not isinstance(data, dict):
+        raise RuleError(f"{path} must contain a JSON object")
+    unknown = set(data) - {"timezone", "windows", "allow", "deny", "min_duration"}
+    if unknown:
+        raise RuleError(f"Unknown setting(s) in {path}: {', '.join(sorted(unknown))}")
+    return RuleSet(
+        windows=data.get("windows"),
+        timezone_name=data.get("timezone", "UTC"),
+        allow=data.get("allow"),
+        deny=data.get("deny"),
+        min_duration=data.get("min_duration", 0),
+        source=path,
+    )
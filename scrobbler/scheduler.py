@@ -0,0 +1,150 @@
+"""
+Heap-based timer queue that runs scheduled tasks one at a time.
+
+Polling Spinitron, sending Now Playing updates and submitting end-of-track scrobbles are all
+scheduled as independent tasks, so waiting for a long track to finish never stops polling, and a
+pending task can be cancelled or moved when a spin turns out to have ended early.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+
+from clock import SYSTEM_CLOCK
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    """
+    Handle for a scheduled task, returned by Scheduler.call_at() and Scheduler.call_later()
+    """
+
+    def __init__(self, when, callback, args, name):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the task from running, if it has not run yet
+        """
+        self.cancelled = True
+
+    def __repr__(self):
+        return f"<Timer {self.name} at {self.when:.1f}{' cancelled' if self.cancelled else ''}>"
+
+
+class Scheduler:
+    """
+    Runs callbacks at (monotonic) points in time. Tasks may be scheduled from any thread, but
+    are all run on the thread that calls run_forever(), one after another.
+    """
+
+    def __init__(self, clock=SYSTEM_CLOCK):
+        """
+        Args:
+            clock (clock.Clock, optional): Source of time that tasks are scheduled by
+        """
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for _, _, timer in self._heap if not timer.cancelled)
+
+    def call_at(self, when, callback, *args, name=None):
+        """
+        Schedules callback(*args) to run at a point in time
+
+        Args:
+            when (float): Time to run at, as returned by the clock's monotonic()
+            callback (callable): The task
+            *args: Arguments to call the task with
+            name (str, optional): Name of the task, for logging
+        Returns:
+            Timer: Handle that can be used to cancel the task
+        """
+        timer = Timer(
+            when, callback, args, name or getattr(callback, "__name__", "task")
+        )
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), timer))
+            self._condition.notify()
+        return timer
+
+    def call_later(self, delay, callback, *args, name=None):
+        """
+        Schedules callback(*args) to run after a delay, see call_at()
+
+        Args:
+            delay (float): Seconds from now to run the task. Negative delays run it immediately
+        Returns:
+            Timer: Handle that can be used to cancel the task
+        """
+        return self.call_at(
+            self.clock.monotonic() + max(0, delay), callback, *args, name=name
+        )
+
+    def reschedule(self, timer, delay):
+        """
+        Moves a pending task to a new time
+
+        Args:
+            timer (Timer): Handle of the task to move
+            delay (float): Seconds from now to run the task at instead
+        Returns:
+            Timer: Handle of the rescheduled task
+        """
+        timer.cancel()
+        return self.call_later(delay, timer.callback, *timer.args, name=timer.name)
+
+    def stop(self):
+        """
+        Makes run_forever() return once the task that is currently running (if any) finishes
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def _next_due(self):
+        """
+        Blocks until a task is due or the scheduler is stopped
+
+        Returns:
+            Timer or None: The due task, or None if the scheduler was stopped
+        """
+        with self._condition:
+            while not self._stopping:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - self.clock.monotonic()
+                if delay <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(timeout=self.clock.real_seconds(delay))
+            return None
+
+    def run_forever(self):
+        """
+        Runs due tasks until stop() is called. An exception raised by a task is printed and
+        does not stop the scheduler.
+        """
+        while True:
+            timer = self._next_due()
+            if timer is None:
+                return
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception(
+                    "Scheduled task %s failed", timer.name, extra={"task": timer.name}
+                )
@@ -0,0 +1,617 @@
+"""
+Durable queues of scrobbles waiting to be submitted to Last.fm and the other sinks (see
+sinks.py).
+
+Scrobbles are appended to an on-disk journal (one JSON record per line) as soon as a track
+finishes, and a background worker drains the journal in batches, e.g. of up to 50 tracks per
+track.scrobble call. Because the journal is replayed on startup, scrobbles that could not be
+submitted during a Last.fm outage, or before the container restarted, are not lost.
+
+Each sink has its own journal, and the worker drains the journals and sends Now Playing updates
+on a small pool of threads, one task per sink at a time. A sink that is slow or failing backs off
+on its own and holds up at most one thread, so the other sinks carry on.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from queue import SimpleQueue
+
+from clock import SYSTEM_CLOCK
+from colors import Colors
+from metrics import LAG_BUCKETS, LATENCY_BUCKETS, Histogram
+
+log = logging.getLogger(__name__)
+
+# Last.fm accepts at most 50 tracks per track.scrobble request
+MAX_BATCH_SIZE = 50
+
+# Per-item outcomes of a batch submission
+ACCEPTED = "accepted"
+REJECTED = "rejected"
+RETRY = "retry"
+# Outcome of a scrobble the sink refused as an invalid request, even on its own
+DROPPED = "dropped"
+
+
+class RetryLater(Exception):
+    """
+    Raised by a submit function when the whole batch should be retried later, e.g. because of a
+    network error or a temporary error of Last.fm or another sink
+    """
+
+
+class AuthenticationFailed(RetryLater):
+    """
+    Raised by a submit function when the sink refused the account's credentials (e.g. an invalid
+    Last.fm session key). Retrying soon will not help, so the worker waits as long as it can while the
+    scrobbles stay in the journal until the account is fixed.
+    """
+
+
+class BatchRejected(Exception):
+    """
+    Raised by a submit function when the sink refused the request itself (e.g. invalid
+    parameters). The worker then retries the batch one track at a time, so that only the track
+    that is actually invalid gets dropped.
+    """
+
+
+class ScrobbleJournal:
+    """
+    Append-only journal of pending scrobbles. Each line is either an "add" record holding a
+    scrobble or a "done" record listing ids that no longer need submitting. An "add" record for an
+    id that is already pending replaces its scrobble, e.g. after its spin was edited. The file is
+    rewritten with only the pending scrobbles once enough "done" records have accumulated.
+    """
+
+    def __init__(self, path, compact_after=500):
+        """
+        Args:
+            path (str): Location of the journal file. It is created if it does not exist
+            compact_after (int, optional): Number of completed scrobbles after which the journal
+                is compacted
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        # Ids handed out by checkout() and not released yet, which revise() leaves alone
+        self._sending = set()
+        self._completed_since_compact = 0
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _load(self):
+        """
+        Replays the journal file into the pending scrobbles
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partially written last line, left by a crash mid-write
+                    continue
+                if record.get("op") == "add":
+                    self._pending[record["id"]] = record["scrobble"]
+                elif record.get("op") == "done":
+                    for scrobble_id in record["ids"]:
+                        self._pending.pop(scrobble_id, None)
+                        self._completed_since_compact += 1
+
+    def _append(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, scrobble):
+        """
+        Durably records a scrobble as pending
+
+        Args:
+            scrobble (dict): The scrobble, with "artist", "track" and "timestamp" keys and
+                optional "album" and "duration" keys
+        Returns:
+            str: The id the scrobble was journaled under
+        """
+        scrobble_id = uuid.uuid4().hex
+        with self._lock:
+            self._append({"op": "add", "id": scrobble_id, "scrobble": scrobble})
+            self._pending[scrobble_id] = scrobble
+        return scrobble_id
+
+    def peek(self, limit=MAX_BATCH_SIZE):
+        """
+        Returns:
+            list: Up to limit (id, scrobble) pairs, oldest first
+        """
+        with self._lock:
+            batch = []
+            for scrobble_id, scrobble in self._pending.items():
+                if len(batch) >= limit:
+                    break
+                batch.append((scrobble_id, scrobble))
+            return batch
+
+    def checkout(self, limit=MAX_BATCH_SIZE):
+        """
+        Like peek(), but also keeps revise() from changing the scrobbles until they are
+        completed or released, since they are about to be submitted
+
+        Returns:
+            list: Up to limit (id, scrobble) pairs, oldest first
+        """
+        batch = self.peek(limit)
+        with self._lock:
+            self._sending.update(scrobble_id for scrobble_id, _ in batch)
+        return batch
+
+    def release(self, scrobble_ids):
+        """
+        Ends the submission of scrobbles handed out by checkout(). Those that were not completed
+        stay pending.
+
+        Args:
+            scrobble_ids (list): Ids of the scrobbles
+        """
+        with self._lock:
+            self._sending.difference_update(scrobble_ids)
+
+    def revise(self, spin_id, scrobble=None):
+        """
+        Replaces or removes the pending scrobble of a spin that was edited or deleted
+
+        Args:
+            spin_id (int): The spin
+            scrobble (dict, optional): The corrected scrobble. The pending scrobble is removed if
+                omitted
+        Returns:
+            bool: True if the pending scrobble was replaced or removed, False if the spin has no
+                pending scrobble or it is being submitted
+        """
+        with self._lock:
+            for scrobble_id, pending in self._pending.items():
+                if pending.get("spin_id") == spin_id:
+                    break
+            else:
+                return False
+            if scrobble_id in self._sending:
+                return False
+            if scrobble is not None:
+                self._append({"op": "add", "id": scrobble_id, "scrobble": scrobble})
+                self._pending[scrobble_id] = scrobble
+                return True
+            self._append({"op": "done", "ids": [scrobble_id]})
+            del self._pending[scrobble_id]
+            self._completed_since_compact += 1
+            if self._completed_since_compact >= self.compact_after:
+                self._compact()
+            return True
+
+    def complete(self, scrobble_ids):
+        """
+        Marks scrobbles as no longer pending (submitted or permanently rejected)
+
+        Args:
+            scrobble_ids (list): Ids of the scrobbles, as returned by add()
+        """
+        if not scrobble_ids:
+            return
+        with self._lock:
+            self._append({"op": "done", "ids": list(scrobble_ids)})
+            for scrobble_id in scrobble_ids:
+                self._pending.pop(scrobble_id, None)
+                self._sending.discard(scrobble_id)
+            self._completed_since_compact += len(scrobble_ids)
+            if self._completed_since_compact >= self.compact_after:
+                self._compact()
+
+    def _compact(self):
+        """
+        Atomically rewrites the journal with only the pending scrobbles. Must be called with the
+        lock held.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as temp_file:
+            for scrobble_id, scrobble in self._pending.items():
+                record = {"op": "add", "id": scrobble_id, "scrobble": scrobble}
+                temp_file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._completed_since_compact = 0
+
+    def close(self):
+        """
+        Closes the journal file
+        """
+        with self._lock:
+            self._file.close()
+
+
+class ScrobbleQueue:
+    """
+    A journal registered with a ScrobbleWorker, along with the functions that submit its
+    scrobbles and Now Playing updates, its retry state and its statistics
+    """
+
+    def __init__(
+        self,
+        name,
+        journal,
+        submit,
+        on_outcome=None,
+        now_playing=None,
+        batch_size=MAX_BATCH_SIZE,
+    ):
+        """
+        Args:
+            name (str): Name of the queue (normally station/sink), for logging
+            journal (ScrobbleJournal): The journal to drain
+            submit (callable): Function taking a list of scrobbles and returning a list of the
+                same length holding ACCEPTED, REJECTED or RETRY for each. May raise RetryLater or
+                BatchRejected
+            on_outcome (callable, optional): Function called with each submitted scrobble and
+                its outcome, e.g. to record it in the state store
+            now_playing (callable, optional): Function taking a track and returning True if the
+                sink accepted it as Now Playing, if the sink has Now Playing
+            batch_size (int, optional): Maximum number of scrobbles per submission
+        """
+        self.name = name
+        self.journal = journal
+        self.submit = submit
+        self.on_outcome = on_outcome
+        self.now_playing = now_playing
+        self.batch_size = batch_size
+        self.failures = 0
+        self.not_before = 0.0
+        # Whether a thread is draining the journal or sending a Now Playing update
+        self.draining = False
+        self.sending_now_playing = False
+        # The newest Now Playing update not yet sent, with its callback
+        self.pending_now_playing = None
+
+        # Number of scrobbles by outcome ("dropped" ones were refused as invalid requests)
+        self.outcomes = {ACCEPTED: 0, REJECTED: 0, RETRY: 0, DROPPED: 0}
+        self.failed_submissions = 0
+        # Seconds from the end of each accepted track until the sink accepted it
+        self.lag = Histogram(LAG_BUCKETS)
+        # Seconds taken by each submission and Now Playing update, retries included
+        self.submit_latency = Histogram(LATENCY_BUCKETS)
+        self.now_playing_latency = Histogram(LATENCY_BUCKETS)
+
+    def summary(self):
+        """
+        Returns:
+            str: A one-line, human-readable description of the queue's counters and latency
+        """
+        text = (
+            f"{len(self.journal)} pending, {self.outcomes[ACCEPTED]} accepted, "
+            f"{self.outcomes[REJECTED]} ignored, {self.outcomes['dropped']} dropped, "
+            f"{self.failed_submissions} failed submissions"
+        )
+        for label, histogram in (
+            ("submission", self.submit_latency),
+            ("Now Playing", self.now_playing_latency),
+        ):
+            counts, total = histogram.snapshot()
+            if counts[-1]:
+                text += f", avg {1000 * total / counts[-1]:.0f} ms per {label}"
+        return text
+
+
+class ScrobbleWorker(threading.Thread):
+    """
+    Background thread that hands the pending work of any number of ScrobbleQueues to a pool of
+    threads: draining their journals in batches, backing off exponentially (per queue) while a
+    sink is unavailable, and sending their Now Playing updates. One worker serves every sink in
+    the process.
+    """
+
+    def __init__(
+        self,
+        batch_size=MAX_BATCH_SIZE,
+        min_backoff=15,
+        max_backoff=900,
+        clock=SYSTEM_CLOCK,
+        threads=4,
+    ):
+        """
+        Args:
+            batch_size (int, optional): Default maximum number of scrobbles per submission
+            min_backoff (float, optional): Seconds to wait after the first failed submission
+            max_backoff (float, optional): Maximum seconds to wait between failed submissions
+            clock (clock.Clock, optional): Source of time for backoff and scrobble lag
+            threads (int, optional): Number of submissions and Now Playing updates in progress
+                at once, across all queues
+        """
+        super().__init__(name="scrobble-worker", daemon=True)
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.queues = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._tasks = SimpleQueue()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"sink-{i + 1}", daemon=True)
+            for i in range(max(1, threads))
+        ]
+
+    def add_queue(
+        self, name, journal, submit, on_outcome=None, now_playing=None, batch_size=None
+    ):
+        """
+        Registers a journal to be drained, see ScrobbleQueue
+
+        Returns:
+            ScrobbleQueue: The registered queue
+        """
+        queue = ScrobbleQueue(
+            name,
+            journal,
+            submit,
+            on_outcome,
+            now_playing,
+            min(batch_size or self.batch_size, self.batch_size),
+        )
+        self.queues.append(queue)
+        self._wakeup.set()
+        return queue
+
+    def send_now_playing(self, queue, track, on_done=None):
+        """
+        Hands a Now Playing update to a queue's sink without waiting for it. An update still
+        waiting to be sent for the same queue is replaced, since only the newest one matters.
+
+        Args:
+            queue (ScrobbleQueue): The queue of the sink
+            track (dict): The track, see sinks.Sink.now_playing()
+            on_done (callable, optional): Function called with True or False once the sink
+                accepted or refused the update
+        """
+        with self._lock:
+            queue.pending_now_playing = (track, on_done)
+        self._wakeup.set()
+
+    def pending(self):
+        """
+        Returns:
+            int: Total number of scrobbles waiting to be submitted, across all journals
+        """
+        return sum(len(queue.journal) for queue in self.queues)
+
+    def notify(self):
+        """
+        Wakes the worker up to submit newly journaled scrobbles
+        """
+        self._wakeup.set()
+
+    def stop(self):
+        """
+        Asks the worker to exit after its current submission
+        """
+        self._stopping.set()
+        self._wakeup.set()
+
+    def _backoff(self, queue):
+        """
+        Returns:
+            float: Seconds to wait after the queue's current streak of failures, with jitter
+        """
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (queue.failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def run(self):
+        for thread in self._threads:
+            thread.start()
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            timeout = None
+            for queue in list(self.queues):
+                with self._lock:
+                    pending = queue.pending_now_playing
+                    if pending is not None and not queue.sending_now_playing:
+                        queue.pending_now_playing = None
+                        queue.sending_now_playing = True
+                        self._tasks.put((self._send_now_playing, queue, *pending))
+
+                if queue.draining or not len(queue.journal):
+                    continue
+                wait = queue.not_before - self.clock.monotonic()
+                if wait <= 0:
+                    queue.draining = True
+                    self._tasks.put((self._drain_task, queue))
+                    continue
+                timeout = wait if timeout is None else min(timeout, wait)
+            self._wakeup.wait(
+                timeout=(
+                    None
+                    if timeout is None
+                    else self.clock.real_seconds(max(0, timeout))
+                )
+            )
+        for _ in self._threads:
+            self._tasks.put(None)
+
+    def _work(self):
+        """
+        Runs the tasks handed out by run() on one of the pool's threads
+        """
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            function, *args = task
+            try:
+                function(*args)
+            except Exception:
+                # Never let a task take the thread down with it, or tasks would pile up unserved
+                log.exception("A scrobble worker task failed")
+
+    def _drain_task(self, queue):
+        """
+        Drains a queue on a pool thread, then schedules its next attempt
+        """
+        try:
+            delay = self.drain(queue)
+        except Exception:
+            # Keep the other queues going; the queue is retried after a backoff
+            log.exception("Submitting scrobbles failed", extra={"queue": queue.name})
+            queue.failures += 1
+            delay = self._backoff(queue)
+        if delay is not None:
+            queue.not_before = self.clock.monotonic() + delay
+        queue.draining = False
+        self._wakeup.set()
+
+    def _send_now_playing(self, queue, track, on_done):
+        """
+        Sends a Now Playing update on a pool thread
+        """
+        started = time.perf_counter()
+        try:
+            updated = bool(queue.now_playing(track))
+        except Exception:
+            log.exception("Sending Now Playing failed", extra={"queue": queue.name})
+            updated = False
+        queue.now_playing_latency.observe(time.perf_counter() - started)
+        try:
+            if on_done is not None:
+                on_done(updated)
+        except Exception:
+            log.exception(
+                "Recording a Now Playing update failed", extra={"queue": queue.name}
+            )
+        finally:
+            with self._lock:
+                queue.sending_now_playing = False
+            self._wakeup.set()
+
+    @staticmethod
+    def _submit(queue, scrobbles):
+        """
+        Submits a batch, recording how long the submission took
+        """
+        started = time.perf_counter()
+        try:
+            return queue.submit(scrobbles)
+        finally:
+            queue.submit_latency.observe(time.perf_counter() - started)
+
+    def drain(self, queue):
+        """
+        Submits a queue's pending scrobbles until its journal is empty or a submission fails
+
+        Args:
+            queue (ScrobbleQueue): The queue to drain
+        Returns:
+            float or None: Seconds to wait before trying again, or None if the journal was emptied
+        """
+        journal = queue.journal
+        # Number of scrobbles left to submit one at a time after a batch was refused
+        isolating = 0
+        while not self._stopping.is_set():
+            batch = journal.checkout(1 if isolating else queue.batch_size)
+            if not batch:
+                return None
+            ids = [scrobble_id for scrobble_id, _ in batch]
+            scrobbles = [scrobble for _, scrobble in batch]
+
+            try:
+                outcomes = self._submit(queue, scrobbles)
+            except RetryLater as e:
+                queue.failures += 1
+                queue.failed_submissions += 1
+                if isinstance(e, AuthenticationFailed):
+                    delay = self.max_backoff
+                else:
+                    delay = self._backoff(queue)
+                log.error(
+                    "Could not submit %d scrobble(s): %s. %d pending, retrying in %.0f seconds...",
+                    len(batch),
+                    e,
+                    len(journal),
+                    delay,
+                    extra={"queue": queue.name, "pending": len(journal)},
+                )
+                journal.release(ids)
+                return delay
+            except BatchRejected as e:
+                if len(batch) > 1:
+                    # Find the offending track by submitting one at a time
+                    isolating = len(batch)
+                    journal.release(ids)
+                    continue
+                log.error(
+                    "SCROBBLE DROPPED: %s - %s was refused: %s",
+                    scrobbles[0]["artist"],
+                    scrobbles[0]["track"],
+                    e,
+                    extra={
+                        "queue": queue.name,
+                        "spin_id": scrobbles[0].get("spin_id"),
+                    },
+                )
+                journal.complete(ids)
+                queue.outcomes[DROPPED] += 1
+                if queue.on_outcome:
+                    queue.on_outcome(scrobbles[0], DROPPED)
+                isolating = max(0, isolating - 1)
+                continue
+
+            queue.failures = 0
+            isolating = max(0, isolating - 1)
+            done = [
+                scrobble_id
+                for scrobble_id, outcome in zip(ids, outcomes)
+                if outcome != RETRY
+            ]
+            journal.complete(done)
+            journal.release(ids)
+            now = self.clock.time()
+            for scrobble, outcome in zip(scrobbles, outcomes):
+                queue.outcomes[outcome] += 1
+                if outcome == ACCEPTED:
+                    queue.lag.observe(max(0, now - scrobble["timestamp"]))
+                if queue.on_outcome:
+                    queue.on_outcome(scrobble, outcome)
+            accepted = outcomes.count(ACCEPTED)
+            rejected = outcomes.count(REJECTED)
+            if accepted:
+                log.info(
+                    "✓ Scrobbled %d track(s)",
+                    accepted,
+                    extra={
+                        "queue": queue.name,
+                        "accepted": accepted,
+                        "color": Colors.GREEN,
+                    },
+                )
+            if rejected:
+                log.warning(
+                    "%d scrobble(s) were ignored",
+                    rejected,
+                    extra={"queue": queue.name, "rejected": rejected},
+                )
+            if len(done) < len(ids):
+                # Some tracks were deferred by the sink (e.g. Last.fm's daily scrobble limit)
+                queue.failures += 1
+                return self._backoff(queue)
+        return None
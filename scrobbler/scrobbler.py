@@ -14,486 +14,845 @@ LASTFM_SESSION_KEY.
 """
 
 import argparse
-import hashlib
+import logging
 import os
 import signal
+import sqlite3
 import sys
-import time
-import json
-import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
+
 import requests as r
-from dateutil import parser, tz
+from dateutil import parser
 from dotenv import load_dotenv, set_key
 
-LASTFM_API_URL = "https://ws.audioscrobbler.com/2.0/"
-SPINITRON_API_URL = "https://spinitron.com/api"
+from backfill import MAX_SCROBBLE_AGE, Backfill, BackfillAborted
+from cache import DiskCache, TTLCache
+from colors import Colors
+from config import (
+    ARCHIVE,
+    DEFAULT_NAME,
+    LASTFM,
+    LISTENBRAINZ,
+    ConfigError,
+    ConfigWatcher,
+    journal_path,
+    load_config,
+)
+from http_client import HttpClient
+from lastfm import LASTFM_API_URL, LastfmAccount, LastfmCredentials
+from logs import dropped_events, setup_logging
+from metrics import render_metrics
+from normalize import Normalizer
+from polling import STRATEGIES, make_strategy
+from profiling import profiler
+from push import PushReceiver
+from scheduler import Scheduler
+from scrobble_queue import ScrobbleJournal, ScrobbleWorker
+from sinks import LISTENBRAINZ_API_URL, ArchiveSink, ListenBrainzSink
+from spinitron import SPINITRON_API_URL, SpinitronAPI, compare_poll_modes
+from state import SCROBBLE, StateStore
+from station import Station
+from status import Health, StatusServer, Watchdog
+
+# Named explicitly, as this module runs as __main__
+log = logging.getLogger("scrobbler")
+
+# Settings made in the environment itself take precedence over .env, also when it is reloaded
+PROCESS_ENV = dict(os.environ)
+
+# Pull .env variables
+ENV_PATH = "/env/.env"
+load_dotenv(dotenv_path=ENV_PATH)
+
+# Default scrobbling hours
+SCHEDULE_PATH = "schedule.json"
+
+# Optional list of stations, Last.fm accounts and other sinks, used instead of the single station
+# in .env
+STATIONS_PATH = os.getenv("STATIONS_PATH", "/env/stations.json")
+
+# Optional rules for when to scrobble and which spins to skip, used instead of schedule.json
+RULES_PATH = os.getenv("RULES_PATH", "/env/rules.json")
+
+# The APIs can be pointed elsewhere, e.g. at the local stand-in server in standin.py
+SPINITRON_API_URL = os.getenv("SPINITRON_API_URL", SPINITRON_API_URL)
+LASTFM_API_URL = os.getenv("LASTFM_API_URL", LASTFM_API_URL)
+LISTENBRAINZ_API_URL = os.getenv("LISTENBRAINZ_API_URL", LISTENBRAINZ_API_URL)
+
+# Every Spinitron and Last.fm request goes through this client, so connections are reused
+client = HttpClient.from_env()
+
+# Playlist and persona lookups only change when a show changes, so they are cached between polls.
+# The cache is shared by every station.
+metadata_cache = TTLCache(
+    maxsize=int(os.getenv("METADATA_CACHE_SIZE", "128")),
+    ttl=int(os.getenv("METADATA_CACHE_TTL", "1800")),
+)
+
+# How long to wait between polls of Spinitron. "fixed" always waits POLL_INTERVAL seconds;
+# "adaptive" polls quickly around the end of each track and backs off during long tracks and
+# while the DJ is overdue.
+POLL_STRATEGY = os.getenv("POLL_STRATEGY", "adaptive")
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "15"))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "5"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "120"))
+
+# Number of spins fetched per poll. Spins entered since the previous poll are usually all within
+# this window, so catching up on batch-entered spins rarely needs another request.
+POLL_SPIN_COUNT = int(os.getenv("POLL_SPIN_COUNT", "5"))
+
+# Push mode: with a shared secret set, Spinitron's metadata push is received on /push of the status
+# port and spins are handled as soon as they are logged. Polling then only reconciles pushes that
+# were lost, every PUSH_RECONCILE_INTERVAL seconds.
+PUSH_SECRET = os.getenv("PUSH_SECRET", "")
+PUSH_RECONCILE_INTERVAL = float(os.getenv("PUSH_RECONCILE_INTERVAL", "300"))
+
+# Finished tracks are journaled here and submitted in batches by a background worker
+SCROBBLE_QUEUE_PATH = os.getenv("SCROBBLE_QUEUE_PATH", "/env/scrobble_queue.jsonl")
+
+# Number of submissions and Now Playing updates sent to the sinks at once. Each sink uses at most
+# one of these threads at a time, so a slow sink cannot hold up the others.
+SINK_THREADS = int(os.getenv("SINK_THREADS", "4"))
+
+# Spin metadata is cleaned up before being sent to Last.fm (NORMALIZE). With TRACK_CORRECTIONS,
+# Last.fm's canonical artist and track names are also looked up, and cached on disk.
+NORMALIZE = os.getenv("NORMALIZE", "true").lower() in ("1", "true", "yes")
+TRACK_CORRECTIONS = os.getenv("TRACK_CORRECTIONS", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+CORRECTION_CACHE_PATH = os.getenv("CORRECTION_CACHE_PATH", "/env/corrections.db")
+CORRECTION_CACHE_SIZE = int(os.getenv("CORRECTION_CACHE_SIZE", "5000"))
+CORRECTION_CACHE_TTL = int(os.getenv("CORRECTION_CACHE_TTL", str(30 * 86400)))
+
+# What each station has processed and sent to Last.fm is kept here, so that a restart carries on
+# where the scrobbler left off (empty to turn it off). Entries older than STATE_RETENTION_DAYS are
+# deleted once a day.
+STATE_PATH = os.getenv("STATE_PATH", "/env/state.db")
+STATE_RETENTION_DAYS = float(os.getenv("STATE_RETENTION_DAYS", "7"))
+
+# How often (in seconds) to print the per-endpoint request latency summary
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "3600"))
+
+# Port of the /metrics, /healthz and /readyz endpoint (0 to turn it off), and the health checks'
+# thresholds in seconds. The watchdog restarts the process when the liveness check fails.
+STATUS_PORT = int(os.getenv("STATUS_PORT", "80"))
+HEALTH_MAX_POLL_AGE = int(os.getenv("HEALTH_MAX_POLL_AGE", "300"))
+HEALTH_MAX_HEARTBEAT_AGE = int(os.getenv("HEALTH_MAX_HEARTBEAT_AGE", "120"))
+WATCHDOG = os.getenv("WATCHDOG", "true").lower() in ("1", "true", "yes")
+
+# How often (in seconds) to check .env, schedule.json, stations.json and the rule files for
+# changes. Stations and accounts pick up changes without a restart (0 to turn this off).
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))
+
+# Lowest level of log messages written (DEBUG, INFO, WARNING or ERROR; --verbose sets DEBUG)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# How log messages are written: "text" for people, "logfmt" or "json" for log collectors
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
 
 
-class Colors:
+def signal_handler(sig, frame):
     """
-    Pretty terminal colors for logging
+    Ctrl+C and docker stop handler. It only records the signal and stops the scheduler, and
+    run() shuts down once the scheduler has returned: the handler runs on the main thread in
+    between any two instructions, possibly while a task holds a lock that shutting down needs,
+    such as the state store's. Without a scheduler (a backfill, say), the main thread is made to
+    exit instead, releasing its locks on the way, with the status of a process killed by the
+    signal so that an interrupted backfill does not look finished
     """
+    global stop_signal
+    stop_signal = sig
+    if running_scheduler is not None:
+        running_scheduler.stop()
+    else:
+        raise SystemExit(128 + sig)
 
-    RED = "\033[91m"
-    GREEN = "\033[92m"
-    YELLOW = "\033[93m"
-    BLUE = "\033[94m"
-    MAGENTA = "\033[95m"
-    CYAN = "\033[96m"
-    WHITE = "\033[97m"
-    RESET = "\033[0m"
 
+def log_stop():
+    """
+    Logs that the scrobbler was stopped by a signal
+    """
+    if stop_signal == signal.SIGINT:
+        log.warning("Ctrl+C pressed, aborting application. Goodbye!")
+    elif stop_signal is not None:
+        log.warning("Stopped, aborting application. Goodbye!")
 
-ERROR_CODES = [16, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 16, 26, 29]
-"""
-According to the Last.fm documentation:
-16 : The service is temporarily unavailable, please try again.
-2  : Invalid service - This service does not exist
-3  : Invalid Method - No method with that name in this package
-4  : Authentication Failed - You do not have permissions to access the service
-5  : Invalid format - This service doesn't exist in that format
-6  : Invalid parameters - Your request is missing a required parameter
-7  : Invalid resource specified
-8  : Operation failed - Something else went wrong
-9  : Invalid session key - Please re-authenticate
-10 : Invalid API key - You must be granted a valid key by last.fm
-11 : Service Offline - This service is temporarily offline. Try again later.
-13 : Invalid method signature supplied
-16 : There was a temporary error processing your request. Please try again
-26 : Suspended API key - Access for your account has been suspended, please contact Last.fm
-29 : Rate limit exceeded - Your IP has made too many requests in a short period
-"""
 
-# Pull .env variables and set headers
-load_dotenv(dotenv_path="/env/.env")
-lastfm_api_key = os.getenv("LASTFM_API_KEY")
-lastfm_api_secret = os.getenv("LASTFM_API_SECRET")
-lastfm_session_key = os.getenv("LASTFM_SESSION_KEY")
-spinitron_api_key = os.getenv("SPINITRON_API_KEY")
-spinitron_headers = {"Authorization": f"Bearer {spinitron_api_key}"}
+# The stations being run, for the stats summary
+stations = []
 
-# Parse schedule
-with open("schedule.json", "r") as f:
-    config = json.load(f)
+# Every Last.fm account created, by station and account name, see make_account()
+accounts_by_key = {}
 
-start_hour = config.get("start_hour")
-end_hour = config.get("end_hour")
+# The state store and the metadata normalizer, once run() has set them up
+state_store = None
+normalizer = None
 
+# The scheduler run() is running, and the signal that asked it to stop, see signal_handler()
+running_scheduler = None
+stop_signal = None
 
-def signal_handler(sig, frame):
+
+def print_request_stats():
     """
-    Ctrl+C handler
+    Logs the request count, latency and transfer size recorded for each API endpoint, along
+    with the rate limiting, retry, cache and poll strategy statistics
     """
-    print(
-        Colors.RED + "\nCtrl+C pressed, aborting application. Goodbye!" + Colors.RESET
-    )
-    sys.exit(0)
+    lines = [
+        "Request latency by endpoint:",
+        client.stats.summary(),
+        client.limits_summary(),
+        f"Metadata cache: {metadata_cache.summary()}",
+    ]
+    for station in stations:
+        lines.append(f"Station {station.name}: {station.poll_strategy.summary()}")
+        changes = station.changes
+        if changes["edited"] or changes["deleted"]:
+            lines.append(
+                f"Station {station.name}: {changes['edited']} spins edited and {changes['deleted']} deleted after they were handled, "
+                f"{changes['too_late']} of them too late to correct"
+            )
+    if normalizer is not None:
+        lines.append(f"Normalization: {normalizer.summary()}")
+    if state_store is not None:
+        lines.append(f"State store: {state_store.summary()}")
+    for station in stations:
+        for account in station.accounts:
+            lines.append(
+                f"Sink {account.scrobble_queue.name}: {account.scrobble_queue.summary()}"
+            )
+    if dropped_events():
+        lines.append(f"Log events dropped: {dropped_events()}")
+    if profiler.enabled:
+        lines.append("Stage timings (ms):")
+        lines.append(profiler.summary())
+    log.info("\n".join(lines), extra={"color": Colors.CYAN})
 
 
-def generate_signature(params):
+def setup(account):
     """
-    Takes parameters for a request and generates an md5 hash signature as specified in the Last.fm
-    authentication specs
+    Execution to run when the user has not established a web service session
 
     Args:
-        params (library): Library of stringe representing the parameters for the request
+        account (LastfmAccount): The account to establish a session for
     Returns:
-        str: The generated signature, as a string
+        str: Established session key
     """
-    signature = ""
-    for key in sorted(params):
-        signature += key + str(params[key])
-    signature += lastfm_api_secret
-    return hashlib.md5(signature.encode("utf-8")).hexdigest()
+
+    token = account.get_token()
+
+    # Prompt user to authorize for their account
+    link = f"http://www.last.fm/api/auth/?api_key={account.api_key}&token={token}"
+    print(
+        f'\nYou need to authorize this application with your Last.fm account. To do so, visit the following link. Click "yes, allow access." \n\n{link}\n'
+    )
+
+    # Wait for user to confirm that they have authorized before proceeding
+    confirmation = ""
+    print(
+        "Please enter 'y' and then press \"Enter\" after you have authorized this application with your Last.fm account:"
+    )
+    while confirmation != "y":
+        confirmation = input()
+        if confirmation.lower() != "y":
+            print(Colors.RED + "Did not receive 'y' - aborting setup..." + Colors.RESET)
+            sys.exit(0)
+
+    session_key = account.get_session_key(token)
+    if session_key is None:
+        print(
+            '\nSession key not returned from Last.fm. Did you open the link above and press "yes, allow access?" Aborting setup.'
+        )
+        sys.exit(0)
+    print(Colors.GREEN + "\nSuccess!" + Colors.RESET)
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open("/env/setup_done", "w") as setup_done_file:
+        setup_done_file.write(f"Setup completed at {current_time}\n")
+
+    return session_key
 
 
-def get_token():
+def explain_spin(station_config, spin_id):
     """
-    Performs API call auth.getToken to fetch a request token
+    Prints why a spin would or would not be scrobbled by a station
 
-    Returns:
-        str: Returned token, as a string
+    Args:
+        station_config (config.StationConfig): The station
+        spin_id (int): The ID of the spin
     """
-    params = {"method": "auth.getToken", "api_key": lastfm_api_key}
-    params["api_sig"] = generate_signature(params)
+    spinitron = SpinitronAPI(
+        client,
+        station_config.spinitron_api_key,
+        metadata_cache,
+        base_url=SPINITRON_API_URL,
+    )
+    print(f"Station {station_config.name}, rules from {station_config.rules.source}:")
+    try:
+        spin = spinitron.get_spin(spin_id)
+        playlist = spinitron.get_playlist(spin["playlist_id"])
+        persona = spinitron.get_persona(playlist["persona_id"])
+    except (r.RequestException, ValueError, KeyError) as e:
+        print(Colors.RED + f"Could not fetch spin {spin_id}: {e}" + Colors.RESET)
+        print()
+        return
 
-    response = r.post(LASTFM_API_URL, params=params)
-    root = ET.fromstring(response.content)
-    return root.find("./token").text
+    print(
+        f"Spin {spin['id']}: {spin['artist']} - {spin['song']}, in {playlist['title']} "
+        f"({playlist.get('category')}) hosted by {persona.get('name')}"
+    )
+    accepted = True
+    for rule, passed, reason in station_config.rules.explain(spin, playlist, persona):
+        accepted = accepted and passed
+        mark = Colors.GREEN + "pass" if passed else Colors.RED + "FAIL"
+        print(f"  {mark}{Colors.RESET}  {rule:<10} {reason}")
+    if accepted:
+        wanted_by = [
+            account.name
+            for account in station_config.accounts
+            if account.shows is None or playlist.get("title") in account.shows
+        ]
+        print(
+            Colors.GREEN
+            + f"ACCEPTED, for account(s): {', '.join(wanted_by) or 'none'}"
+            + Colors.RESET
+        )
+    else:
+        print(Colors.RED + "REJECTED" + Colors.RESET)
+    print()
 
 
-def get_session_key(token):
+def scrobble_recorder(station_name, account_name):
     """
-    Performs API call to auth.getSession to create a web service session and fetch the associated
-    session key
+    Builds the function the scrobble worker reports an account's scrobble outcomes to
 
     Args:
-        token (str): A request token, retrived from auth.getToken
+        station_name (str): Name of the station
+        account_name (str): Name of the Last.fm account
     Returns:
-        str: Returned session key, as a string
+        callable: Function recording a scrobble's outcome in the state store
     """
-    params = {"method": "auth.getSession", "api_key": lastfm_api_key, "token": token}
-    params["api_sig"] = generate_signature(params)
 
-    response = r.post(LASTFM_API_URL, params=params)
-    root = ET.fromstring(response.content)
-    session_key_element = root.find("./session/key")
-    if session_key_element is None:
-        print(
-            '\nSession key not returned from Last.fm. Did you open the link above and press "yes, allow access?" Aborting setup.'
-        )
-        sys.exit(0)
+    def record(scrobble, outcome):
+        if scrobble.get("spin_id") is None:
+            # Journaled by a version that did not record spin ids
+            return
+        try:
+            state_store.record_outcome(
+                station_name, account_name, scrobble["spin_id"], SCROBBLE, outcome
+            )
+        except sqlite3.Error as e:
+            log.warning(
+                "Could not record scrobble outcome in %s: %s",
+                STATE_PATH,
+                e,
+                extra={"station": station_name, "account": account_name},
+            )
 
-    session_key = session_key_element.text
-    return session_key
+    return record
 
 
-def get_sleep_duration(start_hour):
+def first_lastfm_account(station_configs):
     """
-    Gets the remaining time in seconds until start_hour to sleep until
+    Returns:
+        config.AccountConfig: The first Last.fm account of the first station that has one, or
+            None if every account is another kind of sink
     """
-    current_datetime = datetime.now(timezone.utc)
-    desired_time = current_datetime.replace(
-        hour=start_hour, minute=0, second=0, microsecond=0
-    )
-    if desired_time < current_datetime:
-        # If the desired start time is already passed for today,
-        # set it for the next day
-        desired_time += datetime.timedelta(days=1)
-    return (desired_time - current_datetime).total_seconds()
+    for station_config in station_configs:
+        for account_config in station_config.accounts:
+            if account_config.kind == LASTFM:
+                return account_config
+    return None
 
 
-def update_np(session_key, artist, track, album=None, duration=None):
+# Class of the sink created for each type of account
+SINK_CLASSES = {
+    LASTFM: LastfmAccount,
+    LISTENBRAINZ: ListenBrainzSink,
+    ARCHIVE: ArchiveSink,
+}
+
+
+def make_sink(account_config):
     """
-    Performs API call to track.updateNowPlaying to indicate to Last.fm that the user has started
-    listening to a new track
+    Creates the Last.fm account or other sink an account of the configuration describes
 
     Args:
-        session_key (str): A session key for an associated web service session generated by
-            auth.getSession
-        artist (str): The artist name
-        track (str): The track name
-        album (str, optional): The album name
-        duration (int, optional): The length of the track in seconds
+        account_config (config.AccountConfig): The account
     Returns:
-        int: Status code of the response
+        sinks.Sink: The sink, sending its requests through the shared HTTP client
     """
+    if account_config.kind == LISTENBRAINZ:
+        return ListenBrainzSink(
+            account_config.name,
+            account_config.token,
+            client,
+            shows=account_config.shows,
+            api_url=LISTENBRAINZ_API_URL,
+        )
+    if account_config.kind == ARCHIVE:
+        return ArchiveSink(
+            account_config.name, account_config.path, shows=account_config.shows
+        )
+    return LastfmAccount(
+        name=account_config.name,
+        api_key=account_config.api_key,
+        api_secret=account_config.api_secret,
+        client=client,
+        session_key=account_config.session_key,
+        shows=account_config.shows,
+        api_url=LASTFM_API_URL,
+    )
 
-    params = {
-        "method": "track.updateNowPlaying",
-        "artist": artist,
-        "track": track,
-        "api_key": lastfm_api_key,
-        "sk": session_key,
-    }
-    if album:
-        params["album"] = album
-    if duration:
-        params["duration"] = duration
-    params["api_sig"] = generate_signature(params)
-
-    response = r.post(LASTFM_API_URL, params=params)
 
-    # Handle http error if necessary
-    if not response.ok:
-        handle_lastfm_http_error(response=response, request_type="NP")
+def make_normalizer(station_configs):
+    """
+    Sets up the spin metadata normalizer according to the NORMALIZE and TRACK_CORRECTIONS settings
 
-    return response.status_code
+    Args:
+        station_configs (list): The config.StationConfig of every station
+    Returns:
+        normalize.Normalizer: The normalizer, or None if normalization is turned off
+    """
+    if not NORMALIZE:
+        return None
+    # Corrections do not depend on the account, so the first Last.fm account's API key is used to
+    # look them up for every station
+    account_config = first_lastfm_account(station_configs)
+    if not TRACK_CORRECTIONS or account_config is None:
+        return Normalizer()
+    return Normalizer(
+        correct=LastfmAccount(
+            "corrections",
+            account_config.api_key,
+            account_config.api_secret,
+            client,
+            api_url=LASTFM_API_URL,
+        ).get_correction,
+        cache=DiskCache(
+            CORRECTION_CACHE_PATH,
+            maxsize=CORRECTION_CACHE_SIZE,
+            ttl=CORRECTION_CACHE_TTL,
+        ),
+    )
 
 
-def request_scrobble(session_key, artist, track, timestamp, album=None, duration=None):
+def run_backfill(station_configs, start, end, workers):
     """
-    Performs API call to track.scrobble to indicate to Last.fm that the user has listened to a song
+    Scrobbles the past spins of every station to each of its accounts, see backfill.py
 
     Args:
-        session_key (str): A session key for an associated web service session generated by
-            auth.getSession
-        artist (str): The artist name
-        track (str): The track name
-        timestamp (float): The time the track started playing (UTC), in UNIX timestamp format
-        album (str, optional): The album name
-        duration (int, optional): The length of the track in seconds
+        station_configs (list): The config.StationConfig of every station
+        start (datetime): Start of the range, timezone-aware
+        end (datetime): End of the range, timezone-aware
+        workers (int): Number of batches submitted at once
     Returns:
-        int: Status code of the response
-    """
-    params = {
-        "method": "track.scrobble",
-        "artist": artist,
-        "track": track,
-        "timestamp": timestamp,
-        "api_key": lastfm_api_key,
-        "sk": session_key,
-    }
-    if album:
-        params["album"] = album
-    if duration:
-        params["duration"] = duration
-    params["api_sig"] = generate_signature(params)
+        bool: True if every backfill ran to completion
+    """
+    global state_store, normalizer
+    if not STATE_PATH:
+        log.error(
+            "A backfill needs STATE_PATH to save its progress and to avoid scrobbling spins twice"
+        )
+        return False
+    if start < datetime.now(timezone.utc) - MAX_SCROBBLE_AGE:
+        log.warning(
+            "Last.fm ignores scrobbles more than %d days old, so earlier spins will be skipped",
+            MAX_SCROBBLE_AGE.days,
+        )
+
+    state_store = StateStore(STATE_PATH, retention=STATE_RETENTION_DAYS * 86400)
+    normalizer = make_normalizer(station_configs)
+    try:
+        completed = backfill_stations(station_configs, start, end, workers)
+    finally:
+        # Also reached when signal_handler() makes the backfill exit
+        log_stop()
+        print_request_stats()
+        state_store.close()
+        state_store = None
+    return completed
 
-    response = r.post(LASTFM_API_URL, params=params)
 
-    # Handle http error if necessary
-    if not response.ok:
-        handle_lastfm_http_error(response=response, request_type="scrobble")
+def backfill_stations(station_configs, start, end, workers):
+    """
+    Runs the backfill of every account of every station, see run_backfill()
 
-    return response.status_code
+    Returns:
+        bool: True if every backfill ran to completion
+    """
+    completed = True
+    for station_config in station_configs:
+        spinitron = SpinitronAPI(
+            client,
+            station_config.spinitron_api_key,
+            metadata_cache,
+            base_url=SPINITRON_API_URL,
+        )
+        for account_config in station_config.accounts:
+            log.info(
+                "Backfilling %s -> %s, %s to %s UTC",
+                station_config.name,
+                account_config.name,
+                f"{start:%Y-%m-%d %H:%M}",
+                f"{end:%Y-%m-%d %H:%M}",
+                extra={"color": Colors.CYAN},
+            )
+            account = make_sink(account_config)
+            try:
+                Backfill(
+                    station_config.name,
+                    spinitron,
+                    account,
+                    station_config.rules,
+                    state_store,
+                    normalizer=normalizer,
+                    workers=workers,
+                ).run(start, end)
+            except (BackfillAborted, r.RequestException) as e:
+                log.error(
+                    "Backfill stopped: %s. Run the same command again to resume it.",
+                    e,
+                    extra={
+                        "station": station_config.name,
+                        "account": account_config.name,
+                    },
+                )
+                completed = False
+    return completed
 
 
-def handle_lastfm_http_error(response, request_type):
+def make_account(station_config, account_config, scrobble_worker):
     """
-    Helper function for update_np and request_scrobble, which takes the returned response from an
-    HTTP error, parses, and logs the information.
+    Creates a Last.fm account or other sink with its own scrobble journal, submitted by the
+    scrobble worker. Each account is only created once: a later call returns the same account
+    with its credentials and shows updated, so that its journal is never opened twice.
 
     Args:
-        response (requests.Response): Response object that is returned by an HTTP request.
-            Should only be responses where response.ok is false (status code >= 400)
-        request_type (str): A string indicating the source of the HTTP error ('NP' if it comes
-            from an NP request, 'scrobble' if it comes from a scrobble request)
-    """
-    http_error_str = (
-        Colors.RED
-        + f"An HTTP error occured while making a {request_type} request.\nHTTP error code {response.status_code}: {response.reason}"
-        + Colors.RESET
-    )
-    try:
-        # Get error info sent from last.fm if available
-        root = ET.fromstring(response.content)
-        data = root.find("./error")
-        http_error_str += f"\nLast.fm error code {data.get('code')}: {data.text}"
-    except ET.ParseError:
-        http_error_str += "\nCould not parse response data for more information."
+        station_config (config.StationConfig): The station the account belongs to
+        account_config (config.AccountConfig): The account
+        scrobble_worker (ScrobbleWorker): Worker submitting every account's scrobbles
+    Returns:
+        sinks.Sink: The account
+    """
+    key = (station_config.name, account_config.name)
+    account = accounts_by_key.get(key)
+    if account is not None:
+        if isinstance(account, LastfmAccount):
+            # Swapped in one assignment, as requests are being signed on the sink threads
+            account.credentials = LastfmCredentials(
+                account_config.api_key,
+                account_config.api_secret,
+                account_config.session_key,
+            )
+        elif isinstance(account, ListenBrainzSink):
+            account.token = account_config.token
+        elif isinstance(account, ArchiveSink):
+            account.path = account_config.path
+        account.shows = (
+            frozenset(account_config.shows) if account_config.shows else None
+        )
+        if not isinstance(account, SINK_CLASSES[account_config.kind]):
+            log.warning(
+                "The type of account %s of station %s changed; restart the scrobbler to use it",
+                account_config.name,
+                station_config.name,
+            )
+        return account
 
-    print(http_error_str)
+    account = make_sink(account_config)
+    account.scrobble_journal = ScrobbleJournal(
+        journal_path(SCROBBLE_QUEUE_PATH, station_config, account_config)
+    )
+    account.scrobble_queue = scrobble_worker.add_queue(
+        f"{station_config.name}/{account.name}",
+        account.scrobble_journal,
+        account.submit,
+        on_outcome=(
+            scrobble_recorder(station_config.name, account.name)
+            if state_store is not None
+            else None
+        ),
+        now_playing=account.now_playing if account.sends_now_playing else None,
+        batch_size=account.batch_size,
+    )
+    accounts_by_key[key] = account
+    return account
 
 
-def setup():
+def build_stations(station_configs, scheduler, scrobble_worker):
     """
-    Execution to run when the user has not established a web service session
+    Creates the Station objects to run, along with a Spinitron client per station and a Last.fm
+    account or other sink with its own scrobble journal per configured account. Every station shares the HTTP
+    client, the metadata cache, the scheduler and the scrobble worker.
 
+    Args:
+        station_configs (list): The config.StationConfig of every station
+        scheduler (Scheduler): Scheduler to run the stations' tasks on
+        scrobble_worker (ScrobbleWorker): Worker submitting every account's scrobbles
     Returns:
-        str: Established session key
+        list: The Station objects
     """
+    stations = []
+    for station_config in station_configs:
+        stations.append(
+            Station(
+                name=station_config.name,
+                spinitron=SpinitronAPI(
+                    client,
+                    station_config.spinitron_api_key,
+                    metadata_cache,
+                    base_url=SPINITRON_API_URL,
+                ),
+                accounts=[
+                    make_account(station_config, account_config, scrobble_worker)
+                    for account_config in station_config.accounts
+                ],
+                scheduler=scheduler,
+                scrobble_worker=scrobble_worker,
+                poll_strategy=(
+                    make_strategy("fixed", base_interval=PUSH_RECONCILE_INTERVAL)
+                    if PUSH_SECRET
+                    else make_strategy(
+                        POLL_STRATEGY,
+                        base_interval=POLL_INTERVAL,
+                        min_interval=POLL_MIN_INTERVAL,
+                        max_interval=POLL_MAX_INTERVAL,
+                    )
+                ),
+                rules=station_config.rules,
+                poll_spin_count=POLL_SPIN_COUNT,
+                store=state_store,
+                normalizer=normalizer,
+            )
+        )
+    return stations
 
-    token = get_token()
-
-    # Prompt user to authorize for their account
-    link = f"http://www.last.fm/api/auth/?api_key={lastfm_api_key}&token={token}"
-    print(
-        f'\nYou need to authorize this application with your Last.fm account. To do so, visit the following link. Click "yes, allow access." \n\n{link}\n'
-    )
 
-    # Wait for user to confirm that they have authorized before proceeding
-    confirmation = ""
-    print(
-        "Please enter 'y' and then press \"Enter\" after you have authorized this application with your Last.fm account:"
+def describe_station(station_config):
+    """
+    Returns:
+        str: The station's accounts and rules, for the startup banner and reloads
+    """
+    accounts = ", ".join(
+        account.name if account.kind == LASTFM else f"{account.name} ({account.kind})"
+        for account in station_config.accounts
     )
-    while confirmation != "y":
-        confirmation = input()
-        if confirmation.lower() != "y":
-            print(Colors.RED + "Did not receive 'y' - aborting setup..." + Colors.RESET)
-            sys.exit(0)
+    lines = [f"Station {station_config.name} -> account(s): {accounts}"]
+    return "\n".join(lines + station_config.rules.describe())
 
-    session_key = get_session_key(token)
-    print(Colors.GREEN + "\nSuccess!" + Colors.RESET)
 
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open("/env/setup_done", "w") as setup_done_file:
-        setup_done_file.write(f"Setup completed at {current_time}\n")
+def apply_config(old, new, scrobble_worker):
+    """
+    Switches the running stations to a reloaded configuration. Runs on the scheduler, between
+    the stations' polls.
 
-    return session_key
+    Args:
+        old (config.ConfigSnapshot): The configuration that was in use
+        new (config.ConfigSnapshot): The configuration to use from now on
+        scrobble_worker (ScrobbleWorker): Worker submitting every account's scrobbles
+    """
+    log.info(
+        "Configuration changed, now using version %d",
+        new.version,
+        extra={"version": new.version, "color": Colors.CYAN},
+    )
+    old_configs = {
+        station_config.name: station_config for station_config in old.stations
+    }
+    running = {station.name: station for station in stations}
+    for station_config in new.stations:
+        station = running.get(station_config.name)
+        if station is None:
+            log.warning(
+                "Station %s was added; restart the scrobbler to start it",
+                station_config.name,
+            )
+            continue
+        previous = old_configs[station_config.name]
+        # Accounts that were removed keep submitting the scrobbles already in their journals,
+        # but receive no new spins
+        station.reconfigure(
+            station_config.rules,
+            [
+                make_account(station_config, account_config, scrobble_worker)
+                for account_config in station_config.accounts
+            ],
+            spinitron=(
+                SpinitronAPI(
+                    client,
+                    station_config.spinitron_api_key,
+                    metadata_cache,
+                    base_url=SPINITRON_API_URL,
+                )
+                if station_config.spinitron_api_key != previous.spinitron_api_key
+                else None
+            ),
+        )
+        log.info(describe_station(station_config))
+    for name in running.keys() - {
+        station_config.name for station_config in new.stations
+    }:
+        log.warning(
+            "Station %s was removed; it keeps running until the scrobbler is restarted",
+            name,
+        )
 
 
-def run():
+def run(config_snapshot):
     """
     Execution to run when the user has already established a web service session
+
+    Args:
+        config_snapshot (config.ConfigSnapshot): The configuration to scrobble with
     """
+    station_configs = config_snapshot.stations
     timestamp_string = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    print("-------------------------------------")
-    print("|                                   |")
-    print("|     #   #  ###    ###   ####      |")
-    print("|     #   #  #  #  #   #  #   #     |")
-    print("|     #   #  ###   #   #  ####      |")
-    print("|     # # #  #  #  #   #  #  #      |")
-    print("|      # #   ###    ###   #   #     |")
-    print("|                                   |")
-    print("|              91.1 FM              |")
-    print("|             wbor.org              |")
-    print("-------------------------------------")
-    print(Colors.GREEN + f"STARTUP @ {timestamp_string}" + Colors.RESET)
-    print("\nSchedule:")
-    print(f"START scrobbling at : {start_hour}:00 UTC")
-    print(f"STOP scrobbling at  : {end_hour}:00 UTC\n")
-    print("-------------------------------------")
-
-    # Loop - each iteration is a check to Spinitron for new song data. All paths have
-    # blocking of at least 5 seconds to avoid sending too many requests
-    miss_count = 0
-    last_spin_id = None
-    while True:
-        timestamp_string = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Get most recent spin info from Spinitron
-        current_spin = r.get(
-            f"{SPINITRON_API_URL}/spins?count=1", headers=spinitron_headers
-        ).json()["items"][0]
-        current_playlist = r.get(
-            f"{SPINITRON_API_URL}/playlists/{current_spin['playlist_id']}",
-            headers=spinitron_headers,
-        ).json()
-        current_playlist_title = current_playlist["title"]
-        current_playlist_category = current_playlist["category"]
-
-        current_persona = r.get(
-            f"{SPINITRON_API_URL}/personas/{current_playlist['persona_id']}",
-            headers=spinitron_headers,
-        ).json()
-        current_persona_name = current_persona["name"]
-
-        # Parse song data, get time difference between song end and current time
-        spin_id = current_spin["id"]
-        spin_song_title = current_spin["song"]
-        spin_artist = current_spin["artist"]
-        spin_duration = current_spin["duration"]
-
-        song_start_datetime = parser.parse(current_spin["start"])
-        song_end_datetime = parser.parse(current_spin["end"])
-        song_start_hour = song_start_datetime.hour
-        current_datetime = datetime.now(timezone.utc)
-        current_hour = current_datetime.hour
-        time_difference = (song_end_datetime - current_datetime).total_seconds()
-
-        # If the current hour is outside of the defined schedule, sleep until the schedule starts
-        if not (
-            (start_hour <= current_hour < end_hour)
-            or (
-                start_hour > end_hour
-                and (current_hour >= start_hour or current_hour < end_hour)
-            )
-        ):
-            sleep_duration = get_sleep_duration(start_hour)
-            print(
-                Colors.YELLOW
-                + f"\n---------{timestamp_string}---------\nOUTSIDE SCHEDULED SCROBBLING HOURS ({start_hour}:00-{end_hour}:00 UTC). Sleeping for next {sleep_duration} seconds until {start_hour}:00 UTC...\n"
-                + Colors.RESET
+    if LOG_FORMAT == "text":
+        log.info(
+            "\n-------------------------------------"
+            "\n|                                   |"
+            "\n|     #   #  ###    ###   ####      |"
+            "\n|     #   #  #  #  #   #  #   #     |"
+            "\n|     #   #  ###   #   #  ####      |"
+            "\n|     # # #  #  #  #   #  #  #      |"
+            "\n|      # #   ###    ###   #   #     |"
+            "\n|                                   |"
+            "\n|              91.1 FM              |"
+            "\n|             wbor.org              |"
+            "\n-------------------------------------"
+        )
+    log.info("STARTUP @ %s", timestamp_string, extra={"color": Colors.GREEN})
+    for station_config in station_configs:
+        log.info(describe_station(station_config))
+
+    # Polls, end-of-track scrobbles and the periodic stats summary of every station all run as
+    # tasks on one scheduler. Finished tracks are journaled so that they survive Last.fm outages
+    # and restarts, and one worker submits the journals of every account.
+    global state_store, normalizer, running_scheduler
+    if STATE_PATH:
+        state_store = StateStore(STATE_PATH, retention=STATE_RETENTION_DAYS * 86400)
+
+    scheduler = Scheduler()
+    running_scheduler = scheduler
+    scrobble_worker = ScrobbleWorker(threads=SINK_THREADS)
+    normalizer = make_normalizer(station_configs)
+    stations[:] = build_stations(station_configs, scheduler, scrobble_worker)
+    scrobble_worker.start()
+    if scrobble_worker.pending():
+        log.warning(
+            "%d scrobble(s) left over from a previous run will be submitted",
+            scrobble_worker.pending(),
+        )
+
+    # Spread the stations' polls out over the poll interval
+    for i, station in enumerate(stations):
+        station.start(delay=i * POLL_INTERVAL / len(stations))
+
+    def print_stats_task():
+        print_request_stats()
+        scheduler.call_later(STATS_INTERVAL, print_stats_task)
+
+    scheduler.call_later(STATS_INTERVAL, print_stats_task)
+
+    if state_store is not None:
+
+        def compact_state_task():
+            deleted = state_store.compact()
+            if deleted:
+                log.info("Deleted %d old entries from %s", deleted, STATE_PATH)
+            scheduler.call_later(86400, compact_state_task)
+
+        compact_state_task()
+
+    config_watcher = None
+    if CONFIG_RELOAD_INTERVAL > 0:
+        config_watcher = ConfigWatcher(
+            config_snapshot,
+            lambda version: load_config(
+                ENV_PATH,
+                SCHEDULE_PATH,
+                STATIONS_PATH,
+                RULES_PATH,
+                base_env=PROCESS_ENV,
+                version=version,
+            ),
+            lambda old, new: apply_config(old, new, scrobble_worker),
+            scheduler,
+            interval=CONFIG_RELOAD_INTERVAL,
+        )
+        config_watcher.start()
+
+    push_receiver = None
+    if PUSH_SECRET:
+        push_receiver = PushReceiver(PUSH_SECRET, stations, scheduler)
+        if STATUS_PORT:
+            log.info(
+                "Receiving Spinitron pushes on port %d, reconciling every %.0fs",
+                STATUS_PORT,
+                PUSH_RECONCILE_INTERVAL,
             )
-            time.sleep(sleep_duration)
         else:
-            # If the current spin started playing at a time outside of the allowed scrobbling
-            # schedule, pass
-            if not (
-                (start_hour <= song_start_hour < end_hour)
-                or (
-                    start_hour > end_hour
-                    and (song_start_hour >= start_hour or song_start_hour < end_hour)
-                )
-            ):
-                print(
-                    Colors.YELLOW
-                    + f"\n---------{timestamp_string}---------\nCURRENT SPIN BEGAN OUTSIDE SCHEDULED SCROBBLING HOURS. Disregarding...\n"
-                    + Colors.RESET
-                )
-                time.sleep(15)
-            else:
-                # Check if a new song is playing
-                if (time_difference > 0) and (spin_id != last_spin_id):
-
-                    # TODO: make this user-definable in a new file
-                    if (
-                        current_playlist_category
-                        and current_playlist_category != "Automation"
-                    ):
-                        print(f"\n---------{timestamp_string}---------")
-                        print(
-                            Colors.GREEN
-                            + "NEW SONG: "
-                            + Colors.RESET
-                            + f"{spin_artist} - {spin_song_title}"
-                        )
-                        print(f"Spin ID: {spin_id}")
-                        print(f"Spin Playlist: {current_playlist_title}")
-                        print(f"Playlist Host: {current_persona_name}")
-
-                        miss_count = 0
-
-                        # Update now playing
-                        np_code = update_np(
-                            session_key=lastfm_session_key,
-                            artist=current_spin["artist"],
-                            track=current_spin["song"],
-                            album=current_spin["release"],
-                            duration=spin_duration,
-                        )
-                        if np_code in ERROR_CODES:
-                            print(
-                                Colors.RED
-                                + f"ERROR: Now Playing request returned {np_code}"
-                                + Colors.RESET
-                            )
-                        else:
-                            timestamp_string = datetime.now().strftime("%H:%M:%S:%f")
-                            print(
-                                f"Now Playing updated successfully at {timestamp_string}\nWaiting for the end of song to submit scrobble..."
-                            )
-
-                        # Idle until end of song
-                        time.sleep(time_difference)
-
-                        # Last.fm asks that we only scrobbly songs longer than 30 seconds
-                        if spin_duration > 30:
-                            scrobble_code = request_scrobble(
-                                session_key=lastfm_session_key,
-                                artist=current_spin["artist"],
-                                track=current_spin["song"],
-                                timestamp=parser.parse(current_spin["end"]).timestamp(),
-                                album=current_spin["release"],
-                                duration=current_spin["duration"],
-                            )
-                            if scrobble_code in ERROR_CODES:
-                                print(
-                                    Colors.RED
-                                    + f"ERROR: playback finished but the scrobble request returned {scrobble_code}"
-                                    + Colors.RESET
-                                )
-                            else:
-                                timestamp_string = datetime.now().strftime(
-                                    "%H:%M:%S:%f"
-                                )
-                                print(f"✓ Scrobbled successfully at {timestamp_string}")
-                        else:
-                            print(
-                                f"SCROBBLE SKIPPED: {spin_song_title} has a length of {spin_duration}, which is too short to scrobble."
-                            )
-
-                        time.sleep(5)
-                    else:
-                        print(
-                            Colors.RED
-                            + f"\n---------{timestamp_string}---------\nSPIN SKIPPED - belongs to playlist ({current_playlist_title}) with category `{current_playlist_category}`."
-                            + Colors.RESET
-                        )
-
-                # The spin ID is the same as the ID returned in the most recent request
-                else:
-                    miss_count += 1
-                    # print(Colors.YELLOW + f"\n{timestamp_string}\nMISS #{miss_count}" + Colors.RESET)
-
-                    # In a perfect world, people spin in realtime, but in actuality, people get distracted and then batch-submit spins, which can lead to them being missed during this idle period.
-                    #
-                    # # If a miss occurs > 10 times in a row, idle for 3 minutes before next loop
-                    # if miss_count > 10:
-                    #     miss_str = Colors.YELLOW + f"\n---------{{timestamp_string}---------{\n{miss_count} requests since last spin. Currently {-1*int(time_difference)} seconds overdue according to last spin's end time value. Waiting 3 minutes before next request..." + Colors.RESET
-                    #     print(miss_str)
-                    #     time.sleep(180)
-
-                    time.sleep(15)
-
-                last_spin_id = spin_id
+            log.warning(
+                "PUSH_SECRET is set but STATUS_PORT is 0, so pushes cannot be received. Polling every %.0fs only.",
+                PUSH_RECONCILE_INTERVAL,
+            )
+
+    health = Health(
+        scheduler,
+        scrobble_worker,
+        stations,
+        max_heartbeat_age=HEALTH_MAX_HEARTBEAT_AGE,
+        # A station that only polls to reconcile pushes is not failing between polls
+        max_poll_age=(
+            max(HEALTH_MAX_POLL_AGE, 2 * PUSH_RECONCILE_INTERVAL)
+            if PUSH_SECRET
+            else HEALTH_MAX_POLL_AGE
+        ),
+    )
+    health.start()
+    if STATUS_PORT:
+        try:
+            StatusServer(
+                ("", STATUS_PORT),
+                health,
+                lambda: render_metrics(
+                    client,
+                    metadata_cache,
+                    scrobble_worker,
+                    stations,
+                    push_receiver,
+                    normalizer,
+                    config_watcher,
+                    dropped_events(),
+                ),
+                push_receiver,
+            ).start()
+        except OSError as e:
+            log.warning(
+                "Could not serve metrics and health checks on port %d: %s",
+                STATUS_PORT,
+                e,
+            )
+    if WATCHDOG:
+        Watchdog(health).start()
+
+    scheduler.run_forever()
+
+    # Stopped by signal_handler(), which leaves shutting down to the main loop
+    scrobble_worker.stop()
+    log_stop()
+    print_request_stats()
+    if state_store is not None:
+        state_store.close()
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C handler
+    signal.signal(signal.SIGTERM, signal_handler)  # docker stop
 
     # Parse for --setup flag
     cli_parser = argparse.ArgumentParser()
@@ -502,48 +861,151 @@ if __name__ == "__main__":
         action="store_true",
         help="Run script in setup mode (when a web service session has not been established)",
     )
+    cli_parser.add_argument(
+        "--compare-polls",
+        type=int,
+        metavar="N",
+        help="Make N polls with the original three-request method and N with the conditional "
+        "single-request method for each station, print the bytes and latency of each, then exit",
+    )
+    cli_parser.add_argument(
+        "--backfill",
+        nargs=2,
+        metavar=("FROM", "TO"),
+        help="Scrobble the spins that started between two dates or times, e.g. 2024-03-01 or "
+        "2024-03-01T18:00 (UTC unless an offset is given), then exit. An interrupted backfill "
+        "resumes when run again with the same range",
+    )
+    cli_parser.add_argument(
+        "--backfill-workers",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Number of scrobble batches a backfill submits at once (default 4)",
+    )
+    cli_parser.add_argument(
+        "--explain",
+        type=int,
+        metavar="SPIN_ID",
+        help="Fetch a spin from Spinitron, print which of each station's rules it passes or "
+        "breaks, then exit",
+    )
+    cli_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also log debug messages, such as spins that were not scrobbled and why",
+    )
+    cli_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time each stage of polling and scrobbling (fetch, parse, filter, sign, submit) and "
+        "add the timings to the stats summary, which is also logged on shutdown",
+    )
     args = cli_parser.parse_args()
+    if args.profile:
+        profiler.enable()
+
+    try:
+        setup_logging("DEBUG" if args.verbose else LOG_LEVEL, LOG_FORMAT)
+    except ValueError as e:
+        setup_logging()
+        log.error("Invalid logging settings: %s", e)
+        sys.exit(0)
 
-    # Check if necessary env vars are either not present or left as example value
-    if (not (lastfm_api_key and lastfm_api_secret and spinitron_api_key)) or (
-        any(
-            all(char == "x" for char in string.lower())
-            for string in [lastfm_api_key, lastfm_api_secret, spinitron_api_key]
+    # Check if necessary values are either not present or left as example value
+    try:
+        config_snapshot = load_config(
+            ENV_PATH,
+            SCHEDULE_PATH,
+            STATIONS_PATH,
+            RULES_PATH,
+            require_session=not args.setup,
+            base_env=PROCESS_ENV,
         )
-    ):
-        print(
-            Colors.RED
-            + 'Please make sure you have set your LASTFM_API_KEY, LASTFM_API_SECRET, and SPINITRON_API_KEY values in the ".env" file.'
-            + Colors.RESET
+    except ConfigError as e:
+        log.error("%s", e)
+        sys.exit(0)
+    station_configs = config_snapshot.stations
+    if POLL_STRATEGY not in STRATEGIES:
+        log.error(
+            "Unknown POLL_STRATEGY %r, expected one of %s",
+            POLL_STRATEGY,
+            ", ".join(STRATEGIES),
         )
-    else:
-        if args.setup:
-            # If setup flag was used, run setup, then set the obtained session key in the
-            # .env file and run()
-            if not os.path.exists("/scrobbler/setup_done"):
-                new_session_key = setup()
-                set_key("/env/.env", "LASTFM_SESSION_KEY", new_session_key)
-                load_dotenv(dotenv_path="/env/.env")
-                lastfm_session_key = os.getenv("LASTFM_SESSION_KEY")
-                print("LASTFM_SESSION_KEY automatically set in /env/.env\n")
-                sys.exit(0)
-            else:
+        sys.exit(0)
+
+    if args.backfill:
+        try:
+            backfill_start, backfill_end = (
+                parser.parse(value, default=datetime(2000, 1, 1, tzinfo=timezone.utc))
+                for value in args.backfill
+            )
+        except (ValueError, OverflowError) as e:
+            log.error("Invalid backfill range: %s", e)
+            sys.exit(0)
+        if backfill_end <= backfill_start:
+            log.error("The backfill range ends before it starts")
+            sys.exit(0)
+        completed = run_backfill(
+            station_configs,
+            backfill_start,
+            backfill_end,
+            max(1, args.backfill_workers),
+        )
+        sys.exit(0 if completed else 1)
+    elif args.explain:
+        for station_config in station_configs:
+            explain_spin(station_config, args.explain)
+        sys.exit(0)
+    elif args.compare_polls:
+        for station_config in station_configs:
+            print(f"Station {station_config.name}:")
+            compare_poll_modes(
+                SpinitronAPI(
+                    client,
+                    station_config.spinitron_api_key,
+                    metadata_cache,
+                    base_url=SPINITRON_API_URL,
+                ),
+                samples=args.compare_polls,
+            )
+        sys.exit(0)
+    elif args.setup:
+        # If setup flag was used, run setup, then set the obtained session key in the
+        # .env file and exit. Setup only applies to the single account configured in .env;
+        # accounts in stations.json carry their own session keys.
+        if not os.path.exists("/scrobbler/setup_done"):
+            account_config = first_lastfm_account(station_configs)
+            if account_config is None:
                 print(
-                    Colors.YELLOW
-                    + "Setup was done previously. Aborting..."
+                    Colors.RED
+                    + f"None of the accounts in {STATIONS_PATH} is a Last.fm account."
                     + Colors.RESET
                 )
-                sys.exit(0)
-        else:
-            # Check if session key variable is not present or left as example value
-            if (not lastfm_session_key) or all(
-                char == "x" for char in lastfm_session_key.lower()
-            ):
+                sys.exit(1)
+            if station_configs[0].name != DEFAULT_NAME:
                 print(
                     Colors.YELLOW
-                    + 'Please make sure you have set your LASTFM_SESSION_KEY value in the ".env" file. If you have not yet established a web service session, please run the script in setup mode using the --setup argument.'
+                    + f"Note: establishing a session for the API key of {station_configs[0].name}/{account_config.name}; add the resulting key to {STATIONS_PATH}."
                     + Colors.RESET
                 )
-                sys.exit(0)
-            else:
-                run()
+            new_session_key = setup(
+                LastfmAccount(
+                    account_config.name,
+                    account_config.api_key,
+                    account_config.api_secret,
+                    client,
+                    api_url=LASTFM_API_URL,
+                )
+            )
+            set_key(ENV_PATH, "LASTFM_SESSION_KEY", new_session_key)
+            print("LASTFM_SESSION_KEY automatically set in /env/.env\n")
+            sys.exit(0)
+        else:
+            print(
+                Colors.YELLOW + "Setup was done previously. Aborting..." + Colors.RESET
+            )
+            sys.exit(0)
+    else:
+        run(config_snapshot)
@@ -0,0 +1,272 @@
+"""
+Destinations for the spins a station accepts. Besides Last.fm accounts (lastfm.LastfmAccount),
+spins can be sent to a ListenBrainz-compatible server and written to a local archive for
+analytics.
+
+Every sink of every station has its own scrobble journal, retry state and statistics in the
+scrobble worker (see scrobble_queue.ScrobbleWorker), which submits the journals and sends Now
+Playing updates on a pool of threads. A slow or failing sink therefore only delays itself, never
+the other sinks or the stations' polling.
+
+A sink implements:
+
+    wants(playlist)        whether spins from a show are sent to it
+    now_playing(track)     (if sends_now_playing) announces a track that started playing
+    submit(scrobbles)      submits up to batch_size finished tracks, returning an outcome for each
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+
+import requests as r
+
+from retry import SUCCESS, classify_http
+from scrobble_queue import (
+    ACCEPTED,
+    MAX_BATCH_SIZE,
+    AuthenticationFailed,
+    BatchRejected,
+    RetryLater,
+)
+
+log = logging.getLogger(__name__)
+
+LISTENBRAINZ_API_URL = "https://api.listenbrainz.org"
+
+# Reported to ListenBrainz as the client that submitted each listen
+SUBMISSION_CLIENT = "wbor-scrobbler"
+
+
+class Sink:
+    """
+    Base class of the destinations spins are sent to
+    """
+
+    # Whether now_playing() does anything
+    sends_now_playing = False
+    # Maximum number of scrobbles per submit() call
+    batch_size = MAX_BATCH_SIZE
+
+    def __init__(self, name, shows=None):
+        """
+        Args:
+            name (str): Name of the sink, for logging and metrics
+            shows (list, optional): Playlist titles this sink should receive spins from. All
+                shows are received if omitted
+        """
+        self.name = name
+        self.shows = frozenset(shows) if shows else None
+
+        # Set up by the station this sink belongs to
+        self.scrobble_journal = None
+        self.scrobble_queue = None
+
+        # Number of Now Playing updates by outcome
+        self.now_playing_outcomes = {"success": 0, "failure": 0}
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+    def wants(self, playlist):
+        """
+        Checks whether spins from a playlist should be sent to this sink
+
+        Args:
+            playlist (dict): The playlist, as returned by the Spinitron API
+        Returns:
+            bool: True if the sink receives spins from the playlist's show
+        """
+        return self.shows is None or playlist.get("title") in self.shows
+
+    def now_playing(self, track):
+        """
+        Announces a track that started playing
+
+        Args:
+            track (dict): The track, with "artist" and "track" keys and optional "album" and
+                "duration" keys
+        Returns:
+            bool: True if the update was accepted
+        """
+        return True
+
+    def submit(self, scrobbles):
+        """
+        Submits finished tracks
+
+        Args:
+            scrobbles (list): Up to batch_size scrobbles, as built by station.spin_to_scrobble()
+        Returns:
+            list: scrobble_queue.ACCEPTED, REJECTED or RETRY for each scrobble
+        Raises:
+            scrobble_queue.RetryLater: If the whole batch should be submitted again later
+            scrobble_queue.BatchRejected: If the sink refused the batch as invalid
+        """
+        raise NotImplementedError
+
+
+class ListenBrainzSink(Sink):
+    """
+    A user of ListenBrainz, or of another server implementing its listen submission API
+    """
+
+    sends_now_playing = True
+    # ListenBrainz accepts up to 1000 listens per request, but a smaller batch keeps a refused
+    # batch cheap to isolate
+    batch_size = 100
+
+    def __init__(self, name, token, client, shows=None, api_url=LISTENBRAINZ_API_URL):
+        """
+        Args:
+            name (str): Name of the sink, for logging and metrics
+            token (str): The user's ListenBrainz user token
+            client (http_client.HttpClient): Shared HTTP client to send requests through
+            shows (list, optional): Playlist titles to receive spins from. All shows if omitted
+            api_url (str, optional): Base URL of the ListenBrainz API
+        """
+        super().__init__(name, shows)
+        self.token = token
+        self.client = client
+        self.api_url = api_url.rstrip("/")
+
+    @staticmethod
+    def track_metadata(track):
+        """
+        Returns:
+            dict: The track_metadata of a listen, from a track or scrobble
+        """
+        metadata = {
+            "artist_name": track["artist"],
+            "track_name": track["track"],
+            "additional_info": {"submission_client": SUBMISSION_CLIENT},
+        }
+        if track.get("album"):
+            metadata["release_name"] = track["album"]
+        if track.get("duration"):
+            metadata["additional_info"]["duration_ms"] = int(track["duration"]) * 1000
+        return metadata
+
+    def post_listens(self, listen_type, payload):
+        """
+        Submits listens to /1/submit-listens
+
+        Args:
+            listen_type (str): "playing_now", "single" or "import"
+            payload (list): The listens
+        Raises:
+            scrobble_queue.RetryLater: If the request failed or the server had a temporary error
+            scrobble_queue.AuthenticationFailed: If the token was refused
+            scrobble_queue.BatchRejected: If the listens were refused as invalid
+        """
+        try:
+            response = self.client.post(
+                f"{self.api_url}/1/submit-listens",
+                json={"listen_type": listen_type, "payload": payload},
+                headers={"Authorization": f"Token {self.token}"},
+                rate_key=self.token,
+            )
+        except r.RequestException as e:
+            raise RetryLater(e) from e
+        if classify_http(response) == SUCCESS:
+            return
+        try:
+            message = response.json().get("error")
+        except (ValueError, AttributeError):
+            message = None
+        message = (
+            f"HTTP error code {response.status_code}: {message or response.reason}"
+        )
+        if response.status_code == 401:
+            raise AuthenticationFailed(message)
+        if response.status_code == 400:
+            raise BatchRejected(message)
+        raise RetryLater(message)
+
+    def now_playing(self, track):
+        """
+        Sends a playing_now listen, see Sink.now_playing()
+        """
+        try:
+            self.post_listens(
+                "playing_now", [{"track_metadata": self.track_metadata(track)}]
+            )
+        except (RetryLater, BatchRejected) as e:
+            log.error(
+                "The Now Playing request could not be completed: %s",
+                e,
+                extra={"account": self.name},
+            )
+            self.now_playing_outcomes["failure"] += 1
+            return False
+        self.now_playing_outcomes["success"] += 1
+        return True
+
+    def submit(self, scrobbles):
+        """
+        Submits the scrobbles as listens, see Sink.submit()
+        """
+        self.post_listens(
+            "single" if len(scrobbles) == 1 else "import",
+            [
+                {
+                    "listened_at": int(scrobble["timestamp"]),
+                    "track_metadata": self.track_metadata(scrobble),
+                }
+                for scrobble in scrobbles
+            ],
+        )
+        return [ACCEPTED] * len(scrobbles)
+
+
+class ArchiveSink(Sink):
+    """
+    Appends every finished track to a local file, one JSON object per line, for analytics. A path
+    ending in .gz is gzip-compressed, one gzip member per batch, which gzip and zcat read as a
+    single stream. Several stations may share one archive.
+    """
+
+    # One lock per archive file, shared by every sink writing to it
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, name, path, shows=None):
+        """
+        Args:
+            name (str): Name of the sink, for logging and metrics
+            path (str): Location of the archive, created if it does not exist
+            shows (list, optional): Playlist titles to receive spins from. All shows if omitted
+        """
+        super().__init__(name, shows)
+        self.path = path
+
+    def _lock(self):
+        with ArchiveSink._locks_lock:
+            return ArchiveSink._locks.setdefault(
+                os.path.abspath(self.path), threading.Lock()
+            )
+
+    def submit(self, scrobbles):
+        """
+        Appends the scrobbles to the archive, see Sink.submit()
+        """
+        data = "".join(
+            json.dumps(scrobble, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for scrobble in scrobbles
+        ).encode("utf-8")
+        if self.path.endswith(".gz"):
+            data = gzip.compress(data)
+        try:
+            with self._lock():
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, "ab") as archive_file:
+                    archive_file.write(data)
+                    archive_file.flush()
+                    os.fsync(archive_file.fileno())
+        except OSError as e:
+            raise RetryLater(f"could not write to {self.path}: {e}") from e
+        return [ACCEPTED] * len(scrobbles)
@@ -0,0 +1,326 @@
+"""
+Spinitron API access: fetching spins and the playlist and persona behind them.
+
+The latest spins are fetched in a single request that asks only for the fields the scrobbler uses
+and has Spinitron expand each spin's playlist inline. Polls are conditional: an ETag is sent back
+with If-None-Match when Spinitron provides one, and otherwise the raw response body is hashed, so
+an unchanged response is never JSON-decoded.
+"""
+
+import hashlib
+import time
+from datetime import timezone
+
+import requests as r
+
+from profiling import profiler
+
+SPINITRON_API_URL = "https://spinitron.com/api"
+
+# Format of the start and end parameters of /spins
+_QUERY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# The only spin fields the scrobbler reads
+SPIN_FIELDS = (
+    "id",
+    "playlist_id",
+    "start",
+    "end",
+    "duration",
+    "artist",
+    "song",
+    "release",
+)
+
+
+class SpinitronAPI:
+    """
+    Client for a single station's Spinitron API key
+    """
+
+    def __init__(self, client, api_key, metadata_cache, base_url=SPINITRON_API_URL):
+        """
+        Args:
+            client (http_client.HttpClient): Shared HTTP client to send requests through
+            api_key (str): The station's Spinitron API key
+            metadata_cache (cache.TTLCache): Cache for playlist and persona lookups
+            base_url (str, optional): Base URL of the Spinitron API
+        """
+        self.client = client
+        self.base_url = base_url
+        self.api_key = api_key
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.metadata_cache = metadata_cache
+        self._etag = None
+        self._digest = None
+
+    def get(self, path, params=None):
+        """
+        Performs a GET request against the Spinitron API
+
+        Args:
+            path (str): Path of the resource, relative to the base URL (e.g. "/spins")
+            params (dict, optional): Query parameters
+        Returns:
+            dict: The decoded JSON response
+        Raises:
+            requests.RequestException: If the request failed or returned an HTTP error
+        """
+        with profiler.stage("fetch"):
+            response = self.client.get(
+                f"{self.base_url}{path}",
+                params=params,
+                headers=self.headers,
+                rate_key=self.api_key,
+            )
+        response.raise_for_status()
+        with profiler.stage("parse"):
+            return response.json()
+
+    def get_spin(self, spin_id):
+        """
+        Fetches a single spin
+
+        Args:
+            spin_id (int): The ID of the spin
+        Returns:
+            dict: The spin, as returned by the Spinitron API
+        """
+        return self.get(f"/spins/{spin_id}")
+
+    def get_playlist(self, playlist_id):
+        """
+        Fetches a playlist, using the metadata cache when possible
+
+        Args:
+            playlist_id (int): The ID of the playlist
+        Returns:
+            dict: The playlist, as returned by the Spinitron API
+        """
+        return self.metadata_cache.get_or_fetch(
+            ("playlist", playlist_id), lambda: self.get(f"/playlists/{playlist_id}")
+        )
+
+    def get_persona(self, persona_id):
+        """
+        Fetches a persona, using the metadata cache when possible
+
+        Args:
+            persona_id (int): The ID of the persona
+        Returns:
+            dict: The persona, as returned by the Spinitron API
+        """
+        return self.metadata_cache.get_or_fetch(
+            ("persona", persona_id), lambda: self.get(f"/personas/{persona_id}")
+        )
+
+    def invalidate_playlist(self, playlist_id):
+        """
+        Drops a playlist, and the persona hosting it, from the metadata cache so that they are
+        re-fetched the next time they are needed
+
+        Args:
+            playlist_id (int): The ID of the playlist
+        """
+        playlist = self.metadata_cache.peek(("playlist", playlist_id))
+        if playlist:
+            self.metadata_cache.invalidate(("persona", playlist.get("persona_id")))
+        self.metadata_cache.invalidate(("playlist", playlist_id))
+
+    def poll_spins(self, count=1):
+        """
+        Fetches the latest spins together with their playlists in one conditional request.
+        Expanded playlists are stored in the metadata cache so that get_playlist() does not need
+        another round-trip.
+
+        Args:
+            count (int, optional): Number of spins to fetch, newest first
+        Returns:
+            list or None: The spins (newest first), or None if nothing changed since the last
+                successful poll
+        Raises:
+            requests.RequestException: If the request failed or returned an HTTP error
+        """
+        headers = dict(self.headers)
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+
+        with profiler.stage("fetch"):
+            response = self.client.get(
+                f"{self.base_url}/spins",
+                params={
+                    "count": count,
+                    "fields": ",".join(SPIN_FIELDS),
+                    "expand": "playlist",
+                },
+                headers=headers,
+                rate_key=self.api_key,
+            )
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        # Fall back to hashing the body when Spinitron does not send an ETag
+        digest = hashlib.blake2b(response.content, digest_size=16).digest()
+        if digest == self._digest:
+            return None
+        self._etag = response.headers.get("ETag")
+        self._digest = digest
+
+        with profiler.stage("parse"):
+            spins = response.json()["items"]
+        for spin in spins:
+            playlist = spin.pop("playlist", None)
+            if isinstance(playlist, dict) and "id" in playlist:
+                self.metadata_cache.set(("playlist", playlist["id"]), playlist)
+        return spins
+
+    def spins_since(self, spin_id, latest, page_size=50, max_pages=10):
+        """
+        Collects every spin with an id greater than spin_id, paging further back through the
+        station's history only if the most recent poll does not already reach spin_id. This
+        catches spins that a DJ batch-entered between two polls.
+
+        Args:
+            spin_id (int): Id of the newest spin that has already been processed
+            latest (list): The spins returned by the most recent poll_spins() call, newest first
+            page_size (int, optional): Number of spins to request per page when paging back
+            max_pages (int, optional): Maximum number of pages to request
+        Returns:
+            list: The new spins, ordered by start time (oldest first)
+        Raises:
+            requests.RequestException: If a request failed or returned an HTTP error
+        """
+        spins = list(latest)
+        page = 1
+        while (
+            spins and min(spin["id"] for spin in spins) > spin_id and page <= max_pages
+        ):
+            items = self.get(
+                "/spins",
+                params={
+                    "count": page_size,
+                    "page": page,
+                    "fields": ",".join(SPIN_FIELDS),
+                },
+            )["items"]
+            spins.extend(items)
+            if len(items) < page_size:
+                break
+            page += 1
+
+        new_spins = {spin["id"]: spin for spin in spins if spin["id"] > spin_id}
+        return sorted(new_spins.values(), key=lambda spin: (spin["start"], spin["id"]))
+
+    def iter_spins(self, start, end, page_size=200):
+        """
+        Streams the spins that started within a time range, one page at a time, so that any
+        length of history can be read without holding it in memory. Expanded playlists are
+        stored in the metadata cache.
+
+        Args:
+            start (datetime): Start of the range, timezone-aware
+            end (datetime): End of the range, timezone-aware
+            page_size (int, optional): Number of spins per request (at most 200)
+        Yields:
+            tuple: The page number and its spins, newest first
+        Raises:
+            requests.RequestException: If a request failed or returned an HTTP error
+        """
+        page = 1
+        while True:
+            body = self.get(
+                "/spins",
+                params={
+                    "start": start.astimezone(timezone.utc).strftime(
+                        _QUERY_TIME_FORMAT
+                    ),
+                    "end": end.astimezone(timezone.utc).strftime(_QUERY_TIME_FORMAT),
+                    "count": page_size,
+                    "page": page,
+                    "fields": ",".join(SPIN_FIELDS),
+                    "expand": "playlist",
+                },
+            )
+            spins = body["items"]
+            for spin in spins:
+                playlist = spin.pop("playlist", None)
+                if isinstance(playlist, dict) and "id" in playlist:
+                    self.metadata_cache.set(("playlist", playlist["id"]), playlist)
+            if spins:
+                yield page, spins
+            page_count = body.get("_meta", {}).get("pageCount")
+            if len(spins) < page_size or (page_count and page >= page_count):
+                return
+            page += 1
+
+    def reset_poll(self):
+        """
+        Forgets the ETag and hash of the last poll, so that the next poll_spins() call returns
+        the spins even if they have not changed. Should be called when a polled response could
+        not be processed.
+        """
+        self._etag = None
+        self._digest = None
+
+
+def compare_poll_modes(api, samples=10, interval=1.0):
+    """
+    Measures the bytes transferred and latency of the original three-request poll (spin, playlist
+    and persona, each over a new connection) against the single conditional poll, and prints the
+    per-poll averages of both
+
+    Args:
+        api (SpinitronAPI): The station's Spinitron API client
+        samples (int, optional): Number of polls to make in each mode
+        interval (float, optional): Seconds to wait between polls
+    """
+
+    def legacy_poll():
+        size = 0
+        spin_response = r.get(f"{api.base_url}/spins?count=1", headers=api.headers)
+        spin = spin_response.json()["items"][0]
+        playlist_response = r.get(
+            f"{api.base_url}/playlists/{spin['playlist_id']}", headers=api.headers
+        )
+        persona_response = r.get(
+            f"{api.base_url}/personas/{playlist_response.json()['persona_id']}",
+            headers=api.headers,
+        )
+        for response in (spin_response, playlist_response, persona_response):
+            size += response.raw.tell()
+        return 3, size
+
+    def conditional_poll():
+        before = api.client.stats.snapshot()
+        spins = api.poll_spins()
+        if spins:
+            playlist = api.get_playlist(spins[0]["playlist_id"])
+            api.get_persona(playlist["persona_id"])
+        after = api.client.stats.snapshot()
+        requests_made = sum(entry["count"] for entry in after.values()) - sum(
+            entry["count"] for entry in before.values()
+        )
+        size = sum(entry["wire_bytes"] for entry in after.values()) - sum(
+            entry["wire_bytes"] for entry in before.values()
+        )
+        return requests_made, size
+
+    for name, poll in (
+        ("three-request poll", legacy_poll),
+        ("conditional poll", conditional_poll),
+    ):
+        total_requests = total_bytes = 0
+        total_seconds = 0.0
+        for _ in range(samples):
+            start = time.perf_counter()
+            requests_made, size = poll()
+            total_seconds += time.perf_counter() - start
+            total_requests += requests_made
+            total_bytes += size
+            time.sleep(interval)
+        print(
+            f"{name}: {total_requests / samples:.1f} requests, "
+            f"{total_bytes / samples:.0f} bytes and "
+            f"{1000 * total_seconds / samples:.0f} ms per poll"
+        )
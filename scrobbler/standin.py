@@ -0,0 +1,400 @@
+"""
+Local stand-in for the Spinitron and Last.fm APIs, for exercising the scrobbler offline.
+
+The server plays back a recorded broadcast day: a spin only appears in /api/spins once the
+server's clock has reached the moment it was entered, so polling behaves as it would against a
+live station. Last.fm calls are checked for a valid signature and recorded, so that the scrobbles
+a run produced can be compared against the recording afterwards (see replay.py). Listens
+submitted to /1/submit-listens, as to ListenBrainz, are recorded too.
+
+A recording is a JSON file of the form:
+
+    {
+      "spins": [{"id": 1, "playlist_id": 10, "start": "2024-03-01T14:00:00+0000",
+                 "end": "2024-03-01T14:03:30+0000", "duration": 210, "artist": "...",
+                 "song": "...", "release": "...", "entered": "2024-03-01T14:05:00+0000"}],
+      "playlists": [{"id": 10, "title": "...", "category": "Music", "persona_id": 20}],
+      "personas": [{"id": 20, "name": "..."}]
+    }
+
+"entered" is optional and defaults to the spin's start; it is later than the start for spins a
+DJ entered after the fact. To run the stand-in on its own, with the recording shifted so that it
+starts now:
+
+    python standin.py recording.json --port 8080
+
+and point the scrobbler at it with SPINITRON_API_URL=http://localhost:8080/api and
+LASTFM_API_URL=http://localhost:8080/2.0/, and LISTENBRAINZ_API_URL=http://localhost:8080 for
+a ListenBrainz sink (any LISTENBRAINZ_TOKEN is accepted).
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from dateutil import parser
+
+from clock import SYSTEM_CLOCK
+
+# Session key handed out by auth.getSession
+STANDIN_SESSION_KEY = "standin-session"
+
+_SPINITRON_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+_RESOURCE_PATH = re.compile(r"^/api/(spins|playlists|personas)/(\d+)$")
+_INDEXED_PARAM = re.compile(r"^(\w+)\[(\d+)\]$")
+
+
+def load_recording(path):
+    """
+    Reads a recording, see the module docstring
+
+    Args:
+        path (str): Location of the recording
+    Returns:
+        dict: The recording
+    """
+    with open(path, "r", encoding="utf-8") as recording_file:
+        return json.load(recording_file)
+
+
+def shift_recording(recording, offset):
+    """
+    Moves every spin of a recording in time
+
+    Args:
+        recording (dict): The recording
+        offset (timedelta): How far to move the spins
+    Returns:
+        dict: A copy of the recording with shifted spins
+    """
+    spins = []
+    for spin in recording["spins"]:
+        spin = dict(spin)
+        for key in ("start", "end", "entered"):
+            if spin.get(key):
+                spin[key] = (parser.parse(spin[key]) + offset).strftime(
+                    _SPINITRON_TIME_FORMAT
+                )
+        spins.append(spin)
+    return {**recording, "spins": spins}
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Serves a recording as the Spinitron API under /api, and a Last.fm API that records the calls
+    it receives under /2.0/
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, recording, lastfm_secret, clock=SYSTEM_CLOCK):
+        """
+        Args:
+            address (tuple): Host and port to listen on. Port 0 picks a free port
+            recording (dict): The broadcast to play back
+            lastfm_secret (str): Shared secret Last.fm requests must be signed with
+            clock (clock.Clock, optional): Clock deciding which spins have been entered yet
+        """
+        super().__init__(address, _StandInHandler)
+        self.lastfm_secret = lastfm_secret
+        self.clock = clock
+        self.playlists = {
+            playlist["id"]: playlist for playlist in recording["playlists"]
+        }
+        self.personas = {persona["id"]: persona for persona in recording["personas"]}
+
+        # Newest first, as Spinitron returns them, along with the time each becomes visible
+        self.spins = sorted(
+            recording["spins"],
+            key=lambda spin: (spin["start"], spin["id"]),
+            reverse=True,
+        )
+        self.entered = {
+            spin["id"]: parser.parse(spin.get("entered") or spin["start"]).timestamp()
+            for spin in self.spins
+        }
+
+        self._lock = threading.Lock()
+        self.spinitron_requests = 0
+        self.lastfm_requests = 0
+        self.not_modified = 0
+        self.bad_signatures = 0
+        # Clock time at which each spin was first returned by /api/spins
+        self.first_served = {}
+        self.now_playing = []
+        self.scrobbles = []
+        # ListenBrainz submissions, by listen type
+        self.listens = {"playing_now": [], "single": [], "import": []}
+
+    @property
+    def url(self):
+        """
+        Returns:
+            str: Base URL of the server
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Starts serving on a daemon thread
+        """
+        threading.Thread(
+            target=self.serve_forever, name="standin-server", daemon=True
+        ).start()
+
+    def visible_spins(self):
+        """
+        Returns:
+            list: The spins entered by now according to the server's clock, newest first
+        """
+        now = self.clock.time()
+        return [spin for spin in self.spins if self.entered[spin["id"]] <= now]
+
+    def spins_page(self, params):
+        """
+        Builds a /api/spins response, honoring count, page, start, end, fields and
+        expand=playlist
+
+        Returns:
+            dict: The response body
+        """
+        count = int(params.get("count", ["20"])[0])
+        page = int(params.get("page", ["1"])[0])
+        fields = params.get("fields", [""])[0].split(",")
+        expand = "playlist" in params.get("expand", [""])[0].split(",")
+
+        spins = self.visible_spins()
+        if "start" in params or "end" in params:
+            start = parser.parse(params.get("start", ["1970-01-01T00:00:00Z"])[0])
+            end = parser.parse(params.get("end", ["9999-12-31T00:00:00Z"])[0])
+            spins = [
+                spin for spin in spins if start <= parser.parse(spin["start"]) < end
+            ]
+        items = spins[(page - 1) * count : page * count]
+        now = self.clock.time()
+        with self._lock:
+            for spin in items:
+                self.first_served.setdefault(spin["id"], now)
+
+        body = []
+        for spin in items:
+            item = {
+                key: value
+                for key, value in spin.items()
+                if key != "entered" and (fields == [""] or key in fields)
+            }
+            if expand:
+                item["playlist"] = self.playlists.get(spin["playlist_id"])
+            body.append(item)
+        return {
+            "items": body,
+            "_meta": {
+                "totalCount": len(spins),
+                "pageCount": -(-len(spins) // count),
+                "currentPage": page,
+                "perPage": count,
+            },
+        }
+
+    def handle_lastfm(self, params):
+        """
+        Handles a Last.fm API call
+
+        Args:
+            params (dict): The call's parameters, from the query string and form body combined
+        Returns:
+            tuple: HTTP status code and XML response body
+        """
+        signature = params.pop("api_sig", "")
+        expected = hashlib.md5(
+            (
+                "".join(key + params[key] for key in sorted(params))
+                + self.lastfm_secret
+            ).encode("utf-8")
+        ).hexdigest()
+        if signature != expected:
+            with self._lock:
+                self.bad_signatures += 1
+            return 403, _lastfm_error(13, "Invalid method signature supplied")
+
+        method = params.get("method")
+        now = self.clock.time()
+        if method == "auth.getToken":
+            return 200, '<lfm status="ok"><token>standin-token</token></lfm>'
+        if method == "auth.getSession":
+            return (
+                200,
+                f'<lfm status="ok"><session><name>standin</name><key>{STANDIN_SESSION_KEY}</key></session></lfm>',
+            )
+        if method == "track.updateNowPlaying":
+            with self._lock:
+                self.now_playing.append(
+                    {
+                        "time": now,
+                        "sk": params.get("sk"),
+                        "artist": params.get("artist"),
+                        "track": params.get("track"),
+                    }
+                )
+            return 200, '<lfm status="ok"><nowplaying/></lfm>'
+        if method == "track.scrobble":
+            items = {}
+            for key, value in params.items():
+                match = _INDEXED_PARAM.match(key)
+                if match:
+                    items.setdefault(int(match.group(2)), {})[match.group(1)] = value
+            root = ET.Element("lfm", status="ok")
+            scrobbles = ET.SubElement(
+                root, "scrobbles", accepted=str(len(items)), ignored="0"
+            )
+            with self._lock:
+                for index in sorted(items):
+                    item = items[index]
+                    self.scrobbles.append(
+                        {
+                            "time": now,
+                            "sk": params.get("sk"),
+                            "artist": item.get("artist"),
+                            "track": item.get("track"),
+                            "timestamp": int(item.get("timestamp", 0)),
+                        }
+                    )
+                    element = ET.SubElement(scrobbles, "scrobble")
+                    ET.SubElement(element, "track").text = item.get("track")
+                    ET.SubElement(element, "artist").text = item.get("artist")
+                    ET.SubElement(element, "ignoredMessage", code="0")
+            return 200, ET.tostring(root, encoding="unicode")
+        return 400, _lastfm_error(3, "Invalid Method - No method with that name")
+
+
+def _lastfm_error(code, message):
+    return f'<lfm status="failed"><error code="{code}">{message}</error></lfm>'
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = parse_qs(parts.query)
+        server = self.server
+        with server._lock:
+            server.spinitron_requests += 1
+
+        if parts.path == "/api/spins":
+            self._respond_json(server.spins_page(params))
+            return
+        match = _RESOURCE_PATH.match(parts.path)
+        resources = {
+            "spins": {
+                spin["id"]: {
+                    key: value for key, value in spin.items() if key != "entered"
+                }
+                for spin in server.visible_spins()
+            },
+            "playlists": server.playlists,
+            "personas": server.personas,
+        }
+        if match and int(match.group(2)) in resources[match.group(1)]:
+            self._respond_json(resources[match.group(1)][int(match.group(2))])
+        else:
+            self._respond(404, b'{"message": "Not found"}', "application/json")
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        if parts.path == "/1/submit-listens":
+            self._submit_listens(self.rfile.read(length))
+            return
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        params = {
+            key: values[0] for key, values in {**parse_qs(parts.query), **form}.items()
+        }
+        with self.server._lock:
+            self.server.lastfm_requests += 1
+
+        if parts.path.rstrip("/") != "/2.0":
+            self._respond(404, b"", "text/plain")
+            return
+        status, body = self.server.handle_lastfm(params)
+        self._respond(
+            status,
+            ('<?xml version="1.0" encoding="utf-8"?>' + body).encode("utf-8"),
+            "text/xml",
+        )
+
+    def _submit_listens(self, body):
+        try:
+            submission = json.loads(body)
+            listens = self.server.listens[submission["listen_type"]]
+            payload = list(submission["payload"])
+        except (ValueError, KeyError, TypeError):
+            self._respond_json_error(400, "Invalid JSON document submitted.")
+            return
+        if not self.headers.get("Authorization", "").startswith("Token "):
+            self._respond_json_error(
+                401, "You need to provide an Authorization header."
+            )
+            return
+        with self.server._lock:
+            listens.extend(payload)
+        self._respond(200, b'{"status": "ok"}', "application/json")
+
+    def _respond_json_error(self, status, message):
+        payload = json.dumps({"code": status, "error": message}).encode("utf-8")
+        self._respond(status, payload, "application/json")
+
+    def _respond_json(self, body):
+        payload = json.dumps(body).encode("utf-8")
+        etag = '"' + hashlib.blake2b(payload, digest_size=16).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            with self.server._lock:
+                self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._respond(200, payload, "application/json", {"ETag": etag})
+
+    def _respond(self, status, payload, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    cli_parser = argparse.ArgumentParser(
+        description="Serve a recorded broadcast day as a local Spinitron and Last.fm API"
+    )
+    cli_parser.add_argument("recording", help="Recording to play back")
+    cli_parser.add_argument("--port", type=int, default=8080)
+    cli_parser.add_argument(
+        "--secret",
+        default="standin-secret",
+        help="Last.fm shared secret requests must be signed with; use it as LASTFM_API_SECRET",
+    )
+    args = cli_parser.parse_args()
+
+    recording = load_recording(args.recording)
+    first_start = min(parser.parse(spin["start"]) for spin in recording["spins"])
+    recording = shift_recording(
+        recording, datetime.now(first_start.tzinfo) - first_start + timedelta(seconds=5)
+    )
+    server = StandInServer(("127.0.0.1", args.port), recording, args.secret)
+    print(f"Serving {len(recording['spins'])} spins at {server.url}, starting now")
+    server.serve_forever()
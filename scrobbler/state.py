@@ -0,0 +1,299 @@
+"""
+Persistent state of the stations, kept in an SQLite database (/env/state.db by default) so that a
+restart, including Docker restarting a crashed container, does not forget what was already sent
+to Last.fm.
+
+For each station the store keeps the last processed spin, the spin on air and when its scrobble
+is due, and the ids of processed spins. For each account it records the outcome of every Now
+Playing update and scrobble. A restarted scrobbler therefore neither sends Now Playing for the
+current spin again nor scrobbles it twice, picks up the spins entered while it was down, and
+still scrobbles the spin that was on air when it stopped.
+
+The database runs in WAL mode, so the frequent small writes are cheap appends, and rows older
+than the retention period are deleted and their pages returned to the filesystem by compact().
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+from clock import SYSTEM_CLOCK
+
+# Kinds of outcome recorded per account
+NOW_PLAYING = "now_playing"
+SCROBBLE = "scrobble"
+
+# Outcome recorded when a scrobble is journaled for submission
+QUEUED = "queued"
+# Outcome recorded when a journaled scrobble is withdrawn, e.g. because its spin was deleted
+CANCELLED = "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stations (
+    station TEXT PRIMARY KEY,
+    last_spin_id INTEGER,
+    last_playlist_id INTEGER,
+    playing TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS spins (
+    station TEXT NOT NULL,
+    spin_id INTEGER NOT NULL,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (station, spin_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS spins_by_time ON spins (station, processed_at);
+CREATE TABLE IF NOT EXISTS outcomes (
+    station TEXT NOT NULL,
+    account TEXT NOT NULL,
+    spin_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outcomes_by_spin ON outcomes (station, spin_id, account, kind);
+CREATE INDEX IF NOT EXISTS outcomes_by_time ON outcomes (at);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class SavedState:
+    """
+    What a station had processed when the scrobbler last stopped
+    """
+
+    last_spin_id: int = None
+    last_playlist_id: int = None
+    # The spin that was on air and its playlist, if its scrobble was still due
+    playing: tuple = None
+    # Ids of the most recently processed spins, oldest first
+    recent_spin_ids: list = field(default_factory=list)
+
+
+class StateStore:
+    """
+    SQLite database holding the stations' state. Safe to use from several threads.
+    """
+
+    def __init__(self, path, retention=7 * 86400, clock=SYSTEM_CLOCK):
+        """
+        Args:
+            path (str): Location of the database, created if it does not exist
+            retention (float, optional): Seconds processed spins and outcomes are kept for
+            clock (clock.Clock, optional): Source of the timestamps stored
+        """
+        self.path = path
+        self.retention = retention
+        self.clock = clock
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            # auto_vacuum only takes effect when set before the first table is created
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._db.execute("PRAGMA journal_mode = WAL")
+            # In WAL mode a crash can lose the last commits, but never corrupts the database
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.execute("PRAGMA busy_timeout = 5000")
+            self._db.executescript(_SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def restore(self, station, limit=1000):
+        """
+        Reads what a station had processed
+
+        Args:
+            station (str): Name of the station
+            limit (int, optional): Maximum number of recently processed spin ids returned
+        Returns:
+            SavedState: The station's state, empty if it has none
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_spin_id, last_playlist_id, playing FROM stations WHERE station = ?",
+                (station,),
+            ).fetchone()
+            recent = self._db.execute(
+                "SELECT spin_id FROM spins WHERE station = ? ORDER BY processed_at DESC LIMIT ?",
+                (station, limit),
+            ).fetchall()
+        state = SavedState(recent_spin_ids=[spin_id for (spin_id,) in reversed(recent)])
+        if row:
+            state.last_spin_id, state.last_playlist_id, playing = row
+            if playing:
+                playing = json.loads(playing)
+                state.playing = (playing["spin"], playing["playlist"])
+        return state
+
+    def _save_station(self, station, **values):
+        columns = ", ".join(values)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in values)
+        self._db.execute(
+            f"INSERT INTO stations (station, {columns}, updated_at) "
+            f"VALUES (?, {', '.join('?' for _ in values)}, ?) "
+            f"ON CONFLICT (station) DO UPDATE SET {updates}, updated_at = excluded.updated_at",
+            (station, *values.values(), self.clock.time()),
+        )
+
+    def mark_processed(self, station, spin_id, last_spin_id, last_playlist_id):
+        """
+        Records that a spin has been processed, along with the station's position in the spin
+        history
+
+        Args:
+            station (str): Name of the station
+            spin_id (int): The processed spin
+            last_spin_id (int): The newest spin processed by polling
+            last_playlist_id (int): The playlist of the newest spin seen
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO spins (station, spin_id, processed_at) VALUES (?, ?, ?)",
+                    (station, spin_id, self.clock.time()),
+                )
+                self._save_station(
+                    station,
+                    last_spin_id=last_spin_id,
+                    last_playlist_id=last_playlist_id,
+                )
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def was_processed(self, station, spin_id):
+        """
+        Returns:
+            bool: True if the spin was processed within the retention period
+        """
+        return bool(
+            self._execute(
+                "SELECT 1 FROM spins WHERE station = ? AND spin_id = ?",
+                (station, spin_id),
+            )
+        )
+
+    def set_playing(self, station, spin=None, playlist=None):
+        """
+        Records the spin on air, whose scrobble is due when it ends
+
+        Args:
+            station (str): Name of the station
+            spin (dict, optional): The spin, or None once it has been scrobbled or cancelled
+            playlist (dict, optional): The playlist the spin belongs to
+        """
+        playing = json.dumps({"spin": spin, "playlist": playlist}) if spin else None
+        with self._lock:
+            self._save_station(station, playing=playing)
+
+    def record_outcome(self, station, account, spin_id, kind, outcome):
+        """
+        Records the outcome of a Now Playing update or scrobble
+
+        Args:
+            station (str): Name of the station
+            account (str): Name of the Last.fm account
+            spin_id (int): The spin
+            kind (str): NOW_PLAYING or SCROBBLE
+            outcome (str): E.g. "success", QUEUED or "accepted"
+        """
+        self._execute(
+            "INSERT INTO outcomes (station, account, spin_id, kind, outcome, at) VALUES (?, ?, ?, ?, ?, ?)",
+            (station, account, spin_id, kind, outcome, self.clock.time()),
+        )
+
+    def has_outcome(self, station, account, spin_id, kind, outcomes):
+        """
+        Returns:
+            bool: True if one of the given outcomes was recorded for the spin and account
+        """
+        return bool(
+            self._execute(
+                "SELECT 1 FROM outcomes WHERE station = ? AND spin_id = ? AND account = ? "
+                f"AND kind = ? AND outcome IN ({', '.join('?' for _ in outcomes)}) LIMIT 1",
+                (station, spin_id, account, kind, *outcomes),
+            )
+        )
+
+    def get_checkpoint(self, name, default=None):
+        """
+        Reads the progress saved by a long-running job, such as a backfill
+
+        Args:
+            name (str): Name of the job
+            default (optional): Value returned if no progress was saved
+        Returns:
+            The saved progress, or default
+        """
+        rows = self._execute("SELECT value FROM checkpoints WHERE name = ?", (name,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_checkpoint(self, name, value):
+        """
+        Saves the progress of a long-running job
+
+        Args:
+            name (str): Name of the job
+            value: The progress, which must be JSON serializable
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO checkpoints (name, value, updated_at) VALUES (?, ?, ?)",
+            (name, json.dumps(value), self.clock.time()),
+        )
+
+    def compact(self):
+        """
+        Deletes processed spins and outcomes older than the retention period, returns the freed
+        pages to the filesystem and truncates the write-ahead log
+
+        Returns:
+            int: Number of rows deleted
+        """
+        cutoff = self.clock.time() - self.retention
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM spins WHERE processed_at < ?", (cutoff,)
+            ).rowcount
+            deleted += self._db.execute(
+                "DELETE FROM outcomes WHERE at < ?", (cutoff,)
+            ).rowcount
+            self._db.execute("PRAGMA incremental_vacuum")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._db.execute("PRAGMA optimize")
+        return deleted
+
+    def summary(self):
+        """
+        Returns:
+            str: The number of rows and the size of the database, for the stats summary
+        """
+        [(spins,)] = self._execute("SELECT COUNT(*) FROM spins")
+        [(outcomes,)] = self._execute("SELECT COUNT(*) FROM outcomes")
+        size = sum(
+            os.path.getsize(path)
+            for path in (self.path, self.path + "-wal")
+            if os.path.exists(path)
+        )
+        return f"{spins} spins, {outcomes} outcomes, {size / 1024:.0f} KB"
+
+    def close(self):
+        """
+        Checkpoints the write-ahead log and closes the database
+        """
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._db.close()
@@ -0,0 +1,922 @@
+"""
+Per-station polling. A Station polls its Spinitron API key for new spins and fans each accepted
+spin out to the Last.fm accounts configured for it. Any number of stations can share one HTTP
+client, one metadata cache, one scheduler and one scrobble worker.
+
+Spins that DJs edit or delete after they were handled are found in the window of recent spins
+each poll returns (see reconcile.py). The scrobble of the spin on air and scrobbles still waiting
+in the journals are corrected or cancelled; scrobbles already submitted are left as they are.
+"""
+
+import functools
+import logging
+from datetime import timedelta
+
+import requests as r
+from dateutil import parser
+
+from cache import RecentIds
+from clock import SYSTEM_CLOCK
+from colors import Colors
+from profiling import profiler
+from reconcile import SpinIndex
+from rules import RuleSet
+from state import CANCELLED, NOW_PLAYING, QUEUED, SCROBBLE
+
+log = logging.getLogger(__name__)
+
+# Last.fm asks that only tracks longer than 30 seconds are scrobbled
+MIN_SCROBBLE_DURATION = 30
+
+
+def parse_time(value):
+    """
+    Parses a Spinitron timestamp, timed as the "parse" stage when profiling
+
+    Args:
+        value (str): The timestamp, e.g. "2024-03-01T14:03:30+0000"
+    Returns:
+        datetime: The parsed, timezone-aware time
+    """
+    with profiler.stage("parse"):
+        return parser.parse(value)
+
+
+def spin_to_scrobble(spin, ended=None):
+    """
+    Builds the scrobble of a spin, as journaled and submitted by lastfm.request_scrobbles()
+
+    Args:
+        spin (dict): The spin, as returned by the Spinitron API
+        ended (str, optional): When the spin actually ended, if it was cut short before its
+            planned end. Last.fm ignores scrobbles timestamped in the future
+    Returns:
+        dict: The scrobble, or None if the spin is too short to be scrobbled
+    """
+    if spin["duration"] <= MIN_SCROBBLE_DURATION:
+        return None
+    return {
+        "artist": spin["artist"],
+        "track": spin["song"],
+        "timestamp": int(parse_time(ended or spin["end"]).timestamp()),
+        "album": spin["release"],
+        "duration": spin["duration"],
+        "spin_id": spin["id"],
+    }
+
+
+class Station:
+    """
+    Polls one station's Spinitron API for new spins and schedules their Now Playing updates and
+    end-of-track scrobbles as separate tasks, so that polling carries on while a track is playing
+    """
+
+    def __init__(
+        self,
+        name,
+        spinitron,
+        accounts,
+        scheduler,
+        scrobble_worker,
+        poll_strategy,
+        rules=None,
+        poll_spin_count=5,
+        clock=SYSTEM_CLOCK,
+        store=None,
+        normalizer=None,
+    ):
+        """
+        Args:
+            name (str): Name of the station, for logging
+            spinitron (spinitron.SpinitronAPI): The station's Spinitron API client
+            accounts (list): The sinks spins are sent to: lastfm.LastfmAccount objects and the
+                other sinks in sinks.py. Each must have a scrobble_journal and scrobble_queue set
+            scheduler (scheduler.Scheduler): Scheduler to run polls and end-of-track scrobbles on
+            scrobble_worker (scrobble_queue.ScrobbleWorker): Worker submitting the sinks'
+                journals and Now Playing updates
+            poll_strategy (polling.PollStrategy): Decides how long to wait between polls. Each
+                station needs its own instance
+            rules (rules.RuleSet, optional): When to scrobble and which spins to skip. By default
+                scrobbling is on all day and Automation spins are skipped
+            poll_spin_count (int, optional): Number of spins fetched per poll. Spins entered since
+                the previous poll are usually all within this window, so catching up on
+                batch-entered spins rarely needs another request
+            clock (clock.Clock, optional): Source of time
+            store (state.StateStore, optional): Database the station's progress is kept in, so
+                that it carries on where it left off after a restart
+            normalizer (normalize.Normalizer, optional): Cleans up the metadata of accepted spins
+                before they are sent to Last.fm
+        """
+        self.name = name
+        self.spinitron = spinitron
+        self.accounts = accounts
+        self.scheduler = scheduler
+        self.scrobble_worker = scrobble_worker
+        self.rules = rules or RuleSet.from_hours(0, 24)
+        self.poll_strategy = poll_strategy
+        self.poll_spin_count = poll_spin_count
+        self.clock = clock
+        self.store = store
+        self.normalizer = normalizer
+
+        self.miss_count = 0
+        self.last_spin_id = None
+        self.last_playlist_id = None
+        self.processed_spin_ids = RecentIds()
+        # What the spins handled recently looked like, to find the ones edited or deleted since
+        self.spin_index = SpinIndex()
+        # Number of handled spins by how they changed afterwards: edited, deleted, and changed
+        # after their scrobbles were submitted
+        self.changes = {"edited": 0, "deleted": 0, "too_late": 0}
+
+        # When the most recent spin is expected to end, which the poll strategy works from
+        self.expected_end = None
+
+        # UNIX time of the last poll that reached Spinitron, for health checks and metrics
+        self.last_successful_poll = None
+
+        # The spin that is currently on air, and the task that will scrobble it when it ends
+        self.playing = None
+        self.playing_timer = None
+
+        # The next poll
+        self.poll_timer = None
+
+        # The spin that was on air when the scrobbler last stopped, scrobbled by start()
+        self._restored_playing = None
+        if store is not None:
+            saved = store.restore(name, limit=self.processed_spin_ids.maxlen)
+            self.last_spin_id = saved.last_spin_id
+            self.last_playlist_id = saved.last_playlist_id
+            for spin_id in saved.recent_spin_ids:
+                self.processed_spin_ids.add(spin_id)
+            self._restored_playing = saved.playing
+
+    def __repr__(self):
+        return f"<Station {self.name}>"
+
+    def log(self, level, message, *args, color=None, **fields):
+        """
+        Logs an event of the station
+
+        Args:
+            level (int): The level, e.g. logging.INFO
+            message (str): The message, with %-style placeholders for args
+            *args: Values of the placeholders
+            color (str, optional): One of the Colors codes, used when logging to a terminal
+            **fields: Fields of the event, e.g. spin_id
+        """
+        if log.isEnabledFor(level):
+            log.log(
+                level,
+                message,
+                *args,
+                extra={"station": self.name, "color": color, **fields},
+            )
+
+    def start(self, delay=0):
+        """
+        Schedules the first poll
+
+        Args:
+            delay (float, optional): Seconds to wait before polling, used to spread the polls of
+                several stations out
+        """
+        if self.last_spin_id is not None:
+            self.log(
+                logging.INFO,
+                "Resuming after spin %d (%d processed spin(s) restored)",
+                self.last_spin_id,
+                len(self.processed_spin_ids),
+            )
+        if self._restored_playing is not None:
+            # Scrobble the spin that was on air before the restart once it ends
+            spin, playlist = self._restored_playing
+            self._restored_playing = None
+            self.playing = spin
+            self.playing_timer = self.scheduler.call_later(
+                (parse_time(spin["end"]) - self.clock.now()).total_seconds(),
+                self.finish_spin,
+                spin,
+                playlist,
+                name=f"scrobble-{self.name}-{spin['id']}",
+            )
+        self.poll_timer = self.scheduler.call_later(
+            delay, self.poll, name=f"poll-{self.name}"
+        )
+
+    def reconfigure(self, rules, accounts, spinitron=None):
+        """
+        Switches the station to a new configuration. Must run on the station's scheduler, so
+        that no poll sees part of the old configuration and part of the new one. The spin on
+        air and scrobbles already journaled are kept.
+
+        Args:
+            rules (rules.RuleSet): The new rules
+            accounts (list): The lastfm.LastfmAccount objects spins are now sent to
+            spinitron (spinitron.SpinitronAPI, optional): New Spinitron client, if the
+                station's API key changed
+        """
+        self.rules = rules
+        self.accounts = accounts
+        if spinitron is not None:
+            self.spinitron = spinitron
+            self.expected_end = None
+        # Poll now rather than at the end of a sleep worked out from the old schedule
+        if self.poll_timer is not None and not self.poll_timer.cancelled:
+            self.poll_timer = self.scheduler.reschedule(self.poll_timer, 0)
+
+    def already_processed(self, spin_id):
+        """
+        Checks whether a spin was processed before, in this run or, if the station has a state
+        store, in an earlier one
+
+        Args:
+            spin_id (int): The ID of the spin
+        Returns:
+            bool: True if the spin should not be processed again
+        """
+        return spin_id in self.processed_spin_ids or (
+            self.store is not None and self.store.was_processed(self.name, spin_id)
+        )
+
+    def mark_processed(self, spin_id):
+        """
+        Remembers that a spin was processed, along with the station's position in the spin
+        history
+
+        Args:
+            spin_id (int): The ID of the spin
+        """
+        self.processed_spin_ids.add(spin_id)
+        if self.store is not None:
+            self.store.mark_processed(
+                self.name, spin_id, self.last_spin_id, self.last_playlist_id
+            )
+
+    def is_ready(self, max_poll_age):
+        """
+        Checks whether the station is working: it has reached Spinitron recently, or it is
+        outside its scrobbling hours and not polling at all
+
+        Args:
+            max_poll_age (float): Seconds since the last successful poll after which the
+                station is considered to be failing
+        Returns:
+            bool: True if the station is healthy
+        """
+        if not self.rules.in_schedule(self.clock.now()):
+            return True
+        return (
+            self.last_successful_poll is not None
+            and self.clock.time() - self.last_successful_poll <= max_poll_age
+        )
+
+    def poll(self):
+        """
+        Scheduled task: checks Spinitron for new spins, then schedules the next poll
+        """
+        delay = self.poll_strategy.base_interval
+        try:
+            with profiler.stage("poll"):
+                delay = self.check_spinitron()
+        finally:
+            self.poll_timer = self.scheduler.call_later(
+                delay, self.poll, name=f"poll-{self.name}"
+            )
+
+    def check_spinitron(self):
+        """
+        Fetches the most recent spins from Spinitron, plus any that were entered since the last
+        processed spin (DJs often batch-enter spins), and handles each new one
+
+        Returns:
+            float: Seconds to wait before the next poll
+        """
+        now = self.clock.now()
+
+        # If the current time is outside of the defined schedule, wait until the schedule starts
+        sleep_duration = self.rules.seconds_until_open(now)
+        if sleep_duration:
+            resume_string = (
+                (now + timedelta(seconds=sleep_duration))
+                .astimezone()
+                .strftime("%Y-%m-%d %H:%M")
+            )
+            self.log(
+                logging.INFO,
+                "OUTSIDE SCHEDULED SCROBBLING HOURS. Sleeping for next %.0f seconds until %s...",
+                sleep_duration,
+                resume_string,
+                color=Colors.YELLOW,
+            )
+            return sleep_duration
+
+        # Playlist and persona normally come from the cache, and an unchanged poll is not
+        # decoded again
+        try:
+            new_spins = []
+            spins = self.spinitron.poll_spins(count=self.poll_spin_count)
+            if spins is not None:
+                self.expected_end = parse_time(spins[0]["end"])
+                if self.last_spin_id is None:
+                    # Nothing processed yet, so there is nothing to catch up on
+                    new_spins = spins[:1]
+                else:
+                    new_spins = self.spinitron.spins_since(self.last_spin_id, spins)
+
+                # A new playlist means a new show: make sure the previous show's data is not kept
+                if self.last_playlist_id != spins[0]["playlist_id"]:
+                    if self.last_playlist_id is not None:
+                        self.spinitron.invalidate_playlist(self.last_playlist_id)
+                    self.last_playlist_id = spins[0]["playlist_id"]
+
+            spin_details = []
+            for spin in new_spins:
+                playlist = self.spinitron.get_playlist(spin["playlist_id"])
+                persona = self.spinitron.get_persona(playlist["persona_id"])
+                spin_details.append((spin, playlist, persona))
+            self.last_successful_poll = self.clock.time()
+        except (r.RequestException, ValueError, KeyError, IndexError) as e:
+            self.spinitron.reset_poll()
+            delay = self.poll_strategy.error_interval()
+            self.log(
+                logging.ERROR,
+                "Could not fetch spin data from Spinitron: %s. Retrying in %s seconds...",
+                e,
+                delay,
+            )
+            return delay
+
+        # Before the new spins, so that a deleted spin on air is not scrobbled as cut short
+        if spins:
+            self.reconcile(spins)
+
+        catching_up = self.last_spin_id is not None
+        for spin, playlist, persona in spin_details:
+            self.last_spin_id = max(self.last_spin_id or 0, spin["id"])
+            # Never process the same spin twice, e.g. one that was already pushed or was
+            # processed before a restart
+            if self.already_processed(spin["id"]):
+                continue
+            self.mark_processed(spin["id"])
+            if catching_up:
+                self.poll_strategy.observe_spin(
+                    parse_time(spin["start"]),
+                    parse_time(spin["end"]),
+                    now=self.clock.now(),
+                )
+
+            self.handle_spin(spin, playlist, persona, catching_up)
+
+        if spin_details:
+            self.miss_count = 0
+            self.scrobble_worker.notify()
+        else:
+            # No spin has been entered since the most recent request
+            self.miss_count += 1
+            self.log(logging.DEBUG, "MISS #%d", self.miss_count)
+
+        previous_interval = self.poll_strategy.current_interval
+        delay = self.poll_strategy.next_interval(
+            self.expected_end, self.miss_count, now=self.clock.now()
+        )
+        if (delay > self.poll_strategy.base_interval) != (
+            previous_interval > self.poll_strategy.base_interval
+        ):
+            self.log(
+                logging.INFO,
+                "Poll interval is now %.0f seconds (%s polling)",
+                delay,
+                self.poll_strategy.name,
+                color=Colors.CYAN,
+                interval=round(delay, 1),
+            )
+        return delay
+
+    def handle_spin(self, spin, playlist, persona, catching_up=True):
+        """
+        Sends a new spin to Last.fm: as Now Playing if it is still on air, otherwise straight to
+        the scrobble journal
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            persona (dict): The persona hosting the playlist
+            catching_up (bool, optional): Whether spins that already finished playing should be
+                scrobbled. False for the very first poll, whose latest spin may be long over
+        """
+        with profiler.stage("filter"):
+            allowed = self.spin_allowed(spin, playlist, persona)
+        # Rejected spins are remembered too, in case an edit makes them pass the rules
+        self.spin_index.add(spin, allowed)
+        if not allowed:
+            return
+        if self.normalizer is not None:
+            spin = self.normalizer.normalize(spin)
+
+        time_difference = (parse_time(spin["end"]) - self.clock.now()).total_seconds()
+        if time_difference > 0:
+            self.start_spin(spin, playlist, persona, time_difference)
+        elif catching_up:
+            # The spin was entered after it had already finished playing
+            self.log(
+                logging.INFO,
+                "CAUGHT UP: %s - %s (Spin ID: %d)",
+                spin["artist"],
+                spin["song"],
+                spin["id"],
+                color=Colors.CYAN,
+                spin_id=spin["id"],
+            )
+            self.queue_scrobble(spin, playlist)
+
+    def receive_push(self, spin):
+        """
+        Scheduled task: handles a spin pushed by Spinitron (see push.py). Pushed spins do not
+        advance last_spin_id, so that the reconciliation polls still pick up any spin whose push
+        was lost, while processed_spin_ids keeps the pushed spins from being handled twice.
+
+        Args:
+            spin (dict): The spin, in the same format as the Spinitron API returns it
+        """
+        if self.already_processed(spin["id"]):
+            return
+        try:
+            playlist = self.spinitron.get_playlist(spin["playlist_id"])
+            persona = self.spinitron.get_persona(playlist["persona_id"])
+        except (r.RequestException, ValueError, KeyError) as e:
+            self.log(
+                logging.ERROR,
+                "Could not fetch the playlist of pushed spin %d: %s. It will be picked up by the next poll.",
+                spin["id"],
+                e,
+                spin_id=spin["id"],
+            )
+            return
+
+        self.mark_processed(spin["id"])
+        self.handle_spin(spin, playlist, persona)
+        self.scrobble_worker.notify()
+
+    def spin_allowed(self, spin, playlist, persona):
+        """
+        Checks a spin against the station's rules, logging the reason if it should not be sent to
+        Last.fm
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            persona (dict): The persona hosting the playlist
+        Returns:
+            bool: True if the spin should be sent to Last.fm
+        """
+        broken = self.rules.evaluate(spin, playlist, persona)
+        if broken is None:
+            return True
+
+        rule, reason = broken
+        if rule == "schedule":
+            self.log(
+                logging.INFO,
+                "SPIN %d BEGAN OUTSIDE SCHEDULED SCROBBLING HOURS. Disregarding...",
+                spin["id"],
+                color=Colors.YELLOW,
+                spin_id=spin["id"],
+                rule=rule,
+            )
+        else:
+            self.log(
+                logging.INFO,
+                "SPIN SKIPPED - belongs to playlist (%s): %s.",
+                playlist["title"],
+                reason,
+                color=Colors.RED,
+                spin_id=spin["id"],
+                rule=rule,
+            )
+        return False
+
+    def make_scrobble(self, spin, playlist, ended=None):
+        """
+        Builds the scrobble of a spin, see spin_to_scrobble()
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            ended (str, optional): When the spin was cut short, if it was
+        Returns:
+            dict: The scrobble, or None if the spin is too short to be scrobbled
+        """
+        scrobble = spin_to_scrobble(spin, ended)
+        if scrobble is not None:
+            # Only read by sinks that keep them, such as the archive
+            scrobble.update(station=self.name, show=playlist.get("title"))
+        return scrobble
+
+    def queue_scrobble(self, spin, playlist, ended=None):
+        """
+        Journals a finished spin for submission to every sink that receives its show
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            ended (str, optional): When the spin was cut short, if it was
+        """
+        scrobble = self.make_scrobble(spin, playlist, ended)
+        if scrobble is None:
+            self.log(
+                logging.INFO,
+                "SCROBBLE SKIPPED: %s has a length of %s, which is too short to scrobble.",
+                spin["song"],
+                spin["duration"],
+                spin_id=spin["id"],
+            )
+            return
+
+        for account in self.accounts:
+            if not account.wants(playlist):
+                continue
+            if self.store is not None and self.store.has_outcome(
+                self.name, account.name, spin["id"], SCROBBLE, (QUEUED,)
+            ):
+                # Already journaled before a restart
+                continue
+            account.scrobble_journal.add(scrobble)
+            if self.store is not None:
+                self.store.record_outcome(
+                    self.name, account.name, spin["id"], SCROBBLE, QUEUED
+                )
+            self.log(
+                logging.INFO,
+                "Scrobble queued for %s (%d pending)",
+                account.name,
+                len(account.scrobble_journal),
+                account=account.name,
+                spin_id=spin["id"],
+            )
+
+    def start_spin(self, spin, playlist, persona, time_difference):
+        """
+        Sends a newly started spin to Last.fm as Now Playing and schedules its scrobble for when
+        it ends. If the previous spin was still due to be playing, it is treated as cut short.
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            persona (dict): The persona hosting the playlist
+            time_difference (float): Seconds until the spin ends
+        """
+        if self.playing is not None:
+            self.cut_short(spin)
+
+        self.log(
+            logging.INFO,
+            "NEW SONG: %s - %s\nSpin ID: %d\nSpin Playlist: %s\nPlaylist Host: %s",
+            spin["artist"],
+            spin["song"],
+            spin["id"],
+            playlist["title"],
+            persona["name"],
+            color=Colors.GREEN,
+            spin_id=spin["id"],
+        )
+
+        self.send_now_playing(spin, playlist)
+        self.log(
+            logging.DEBUG,
+            "Waiting %.0f seconds for the end of song to submit scrobble...",
+            time_difference,
+        )
+
+        self.playing = spin
+        if self.store is not None:
+            self.store.set_playing(self.name, spin, playlist)
+        self.playing_timer = self.scheduler.call_later(
+            time_difference,
+            self.finish_spin,
+            spin,
+            playlist,
+            name=f"scrobble-{self.name}-{spin['id']}",
+        )
+
+    def send_now_playing(self, spin, playlist):
+        """
+        Announces a spin as Now Playing to every sink that receives its show. The updates are
+        sent by the scrobble worker, so that a slow sink does not hold up polling or the other
+        sinks.
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+        """
+        track = {
+            "artist": spin["artist"],
+            "track": spin["song"],
+            "album": spin["release"],
+            "duration": spin["duration"],
+        }
+        for account in self.accounts:
+            if account.sends_now_playing and account.wants(playlist):
+                self.scrobble_worker.send_now_playing(
+                    account.scrobble_queue,
+                    track,
+                    functools.partial(self.now_playing_sent, account, spin["id"]),
+                )
+
+    def now_playing_sent(self, account, spin_id, updated):
+        """
+        Records and logs the outcome of a Now Playing update. Runs on a scrobble worker thread.
+
+        Args:
+            account (sinks.Sink): The sink the update was sent to
+            spin_id (int): The spin
+            updated (bool): Whether the sink accepted the update
+        """
+        if self.store is not None:
+            self.store.record_outcome(
+                self.name,
+                account.name,
+                spin_id,
+                NOW_PLAYING,
+                "success" if updated else "failure",
+            )
+        if not updated:
+            self.log(
+                logging.ERROR,
+                "ERROR: Now Playing request for %s failed",
+                account.name,
+                account=account.name,
+                spin_id=spin_id,
+            )
+        else:
+            self.log(
+                logging.INFO,
+                "Now Playing for %s updated successfully",
+                account.name,
+                account=account.name,
+                spin_id=spin_id,
+            )
+
+    def finish_spin(self, spin, playlist, ended=None):
+        """
+        Scheduled task: queues the scrobble of a spin that has finished playing
+
+        Args:
+            spin (dict): The spin, as returned by the Spinitron API
+            playlist (dict): The playlist the spin belongs to
+            ended (str, optional): When the spin was cut short, if it was
+        """
+        self.log(
+            logging.INFO,
+            "Playback finished: %s - %s",
+            spin["artist"],
+            spin["song"],
+            spin_id=spin["id"],
+        )
+        self.queue_scrobble(spin, playlist, ended)
+        if self.playing is spin:
+            self.playing = None
+            self.playing_timer = None
+            if self.store is not None:
+                self.store.set_playing(self.name)
+        self.scrobble_worker.notify()
+
+    def cut_short(self, next_spin):
+        """
+        Handles a new spin starting before the spin on air was due to end. Following Last.fm's
+        guidelines, the earlier spin is scrobbled right away if it played for at least half its
+        length (or 4 minutes), otherwise its scrobble is cancelled.
+
+        Args:
+            next_spin (dict): The spin that started
+        """
+        spin = self.playing
+        played = (
+            parse_time(next_spin["start"]) - parse_time(spin["start"])
+        ).total_seconds()
+        if played >= min(spin["duration"] / 2, 240):
+            # Timestamped when the next spin started rather than at the planned end, which is
+            # still to come
+            timer = self.playing_timer
+            timer.cancel()
+            self.playing_timer = self.scheduler.call_later(
+                0,
+                self.finish_spin,
+                *timer.args[:2],
+                next_spin["start"],
+                name=timer.name,
+            )
+        else:
+            self.playing_timer.cancel()
+            self.playing = None
+            self.playing_timer = None
+            if self.store is not None:
+                self.store.set_playing(self.name)
+            self.log(
+                logging.WARNING,
+                "SCROBBLE CANCELLED: %s - %s was cut short after %.0f seconds.",
+                spin["artist"],
+                spin["song"],
+                max(played, 0),
+                spin_id=spin["id"],
+            )
+
+    def reconcile(self, spins):
+        """
+        Corrects or cancels the pending actions of recently handled spins that were edited or
+        deleted in Spinitron, as found in a poll's window of recent spins. A spin missing from
+        the window is fetched on its own before it is taken as deleted, since an edit of its
+        start time may have moved it out of the window.
+
+        Args:
+            spins (list): The spins the poll returned, newest first
+        """
+        edited, missing = self.spin_index.compare(
+            spins, complete=len(spins) < self.poll_spin_count
+        )
+        for spin_id in missing:
+            try:
+                spin = self.spinitron.get_spin(spin_id)
+            except r.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    was_allowed = self.spin_index.was_allowed(spin_id)
+                    self.spin_index.discard(spin_id)
+                    self.changes["deleted"] += 1
+                    if was_allowed:
+                        self.cancel_spin(spin_id, "was deleted from Spinitron")
+                    continue
+                self.log(
+                    logging.WARNING,
+                    "Could not check whether spin %d was deleted: %s",
+                    spin_id,
+                    e,
+                    spin_id=spin_id,
+                )
+                continue
+            except (r.RequestException, ValueError) as e:
+                self.log(
+                    logging.WARNING,
+                    "Could not check whether spin %d was deleted: %s",
+                    spin_id,
+                    e,
+                    spin_id=spin_id,
+                )
+                continue
+            if self.spin_index.has_changed(spin):
+                edited.append(spin)
+            else:
+                # It still exists, but is outside the window from now on
+                self.spin_index.discard(spin_id)
+
+        for spin in edited:
+            self.apply_edit(spin)
+
+    def apply_edit(self, spin):
+        """
+        Handles a spin that was edited after it was handled: the spin on air is rescheduled
+        with its new details and announced again if its metadata changed, and a pending
+        scrobble is replaced. The rules are applied again, so the spin is cancelled if it no
+        longer passes them, and handled as a new spin if it was rejected before but passes now.
+
+        Args:
+            spin (dict): The spin as it is now, as returned by the Spinitron API
+        """
+        was_allowed = self.spin_index.was_allowed(spin["id"])
+        self.changes["edited"] += 1
+        try:
+            playlist = self.spinitron.get_playlist(spin["playlist_id"])
+            persona = self.spinitron.get_persona(playlist["persona_id"])
+        except (r.RequestException, ValueError, KeyError) as e:
+            self.log(
+                logging.ERROR,
+                "Could not fetch the playlist of edited spin %d: %s",
+                spin["id"],
+                e,
+                spin_id=spin["id"],
+            )
+            return
+        self.log(
+            logging.INFO,
+            "SPIN EDITED: %s - %s (Spin ID: %d)",
+            spin["artist"],
+            spin["song"],
+            spin["id"],
+            color=Colors.CYAN,
+            spin_id=spin["id"],
+        )
+
+        with profiler.stage("filter"):
+            allowed = self.spin_allowed(spin, playlist, persona)
+        self.spin_index.add(spin, allowed)
+        if not allowed:
+            if was_allowed:
+                self.cancel_spin(spin["id"], "no longer passes the station's rules")
+            return
+        if not was_allowed:
+            # Rejected when it was first seen, so nothing was sent for it yet
+            self.handle_spin(spin, playlist, persona)
+            self.scrobble_worker.notify()
+            return
+        if self.normalizer is not None:
+            spin = self.normalizer.normalize(spin)
+
+        if self.playing is not None and self.playing["id"] == spin["id"]:
+            previous = self.playing
+            self.playing_timer.cancel()
+            self.playing = spin
+            if self.store is not None:
+                self.store.set_playing(self.name, spin, playlist)
+            self.playing_timer = self.scheduler.call_later(
+                max((parse_time(spin["end"]) - self.clock.now()).total_seconds(), 0),
+                self.finish_spin,
+                spin,
+                playlist,
+                name=f"scrobble-{self.name}-{spin['id']}",
+            )
+            if any(
+                spin[key] != previous[key]
+                for key in ("artist", "song", "release", "duration")
+            ):
+                self.send_now_playing(spin, playlist)
+            return
+
+        scrobble = self.make_scrobble(spin, playlist)
+        if scrobble is None:
+            self.cancel_spin(spin["id"], "is now too short to scrobble")
+            return
+        revised = self.revise_scrobbles(spin["id"], scrobble)
+        if revised:
+            self.log(
+                logging.INFO,
+                "Pending scrobble corrected for %s",
+                ", ".join(revised),
+                spin_id=spin["id"],
+            )
+
+    def cancel_spin(self, spin_id, reason):
+        """
+        Cancels the scrobble of a spin that was handled but should not be scrobbled after all,
+        whether it is on air or waiting in the journals
+
+        Args:
+            spin_id (int): The spin
+            reason (str): Why, completing "SCROBBLE CANCELLED: <artist> - <track> ..."
+        """
+        if self.playing is not None and self.playing["id"] == spin_id:
+            spin = self.playing
+            self.playing_timer.cancel()
+            self.playing = None
+            self.playing_timer = None
+            if self.store is not None:
+                self.store.set_playing(self.name)
+            self.log(
+                logging.WARNING,
+                "SCROBBLE CANCELLED: %s - %s %s.",
+                spin["artist"],
+                spin["song"],
+                reason,
+                spin_id=spin_id,
+            )
+            return
+
+        withdrawn = self.revise_scrobbles(spin_id, None)
+        for account_name in withdrawn:
+            if self.store is not None:
+                self.store.record_outcome(
+                    self.name, account_name, spin_id, SCROBBLE, CANCELLED
+                )
+        if withdrawn:
+            self.log(
+                logging.WARNING,
+                "SCROBBLE CANCELLED: spin %d %s; withdrawn from %s.",
+                spin_id,
+                reason,
+                ", ".join(withdrawn),
+                spin_id=spin_id,
+            )
+
+    def revise_scrobbles(self, spin_id, scrobble):
+        """
+        Replaces or removes the pending scrobbles of a spin in every sink's journal
+
+        Args:
+            spin_id (int): The spin
+            scrobble (dict): The corrected scrobble, or None to remove it
+        Returns:
+            list: Names of the sinks whose pending scrobble was revised
+        """
+        revised = [
+            account.name
+            for account in self.accounts
+            if account.scrobble_journal.revise(spin_id, scrobble)
+        ]
+        if not revised:
+            self.changes["too_late"] += 1
+            self.log(
+                logging.INFO,
+                "Spin %d has no pending scrobble to correct; scrobbles that were already submitted are left as they are",
+                spin_id,
+                spin_id=spin_id,
+            )
+        return revised
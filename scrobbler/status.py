@@ -0,0 +1,227 @@
+"""
+Status endpoint on the container's published port (80 inside the container, 4000 outside by
+default). It serves:
+
+    /metrics  Prometheus metrics, see metrics.render_metrics()
+    /healthz  Liveness: 200 while the scheduler and the scrobble worker are running
+    /readyz   Readiness: 200 while every station is reaching Spinitron
+    /push     Spinitron's metadata push, in push mode, see push.PushReceiver
+
+A watchdog thread also checks liveness and exits the process when the scheduler has stopped
+running tasks, so that Docker's restart policy restarts a wedged scrobbler.
+"""
+
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from logs import stop_logging
+from push import PushError, decode_body
+
+log = logging.getLogger(__name__)
+
+
+class Health:
+    """
+    Liveness and readiness checks. Liveness relies on a heartbeat task run by the scheduler: if a
+    task blocks the scheduler, the heartbeat stops.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        scrobble_worker,
+        stations,
+        max_heartbeat_age=120,
+        max_poll_age=300,
+        clock=time.monotonic,
+    ):
+        """
+        Args:
+            scheduler (scheduler.Scheduler): The scheduler running the stations' tasks
+            scrobble_worker (scrobble_queue.ScrobbleWorker): The scrobble worker thread
+            stations (list): The station.Station objects being run
+            max_heartbeat_age (float, optional): Seconds without a heartbeat after which the
+                scheduler is considered wedged
+            max_poll_age (float, optional): Seconds without a successful poll after which a
+                station is considered failing
+            clock (callable, optional): Function returning the current time in seconds
+        """
+        self.scheduler = scheduler
+        self.scrobble_worker = scrobble_worker
+        self.stations = stations
+        self.max_heartbeat_age = max_heartbeat_age
+        self.max_poll_age = max_poll_age
+        self.clock = clock
+        self.last_heartbeat = clock()
+
+    def start(self, interval=15):
+        """
+        Schedules the heartbeat task
+
+        Args:
+            interval (float, optional): Seconds between heartbeats. Must be well below
+                max_heartbeat_age
+        """
+
+        def heartbeat():
+            self.last_heartbeat = self.clock()
+            self.scheduler.call_later(interval, heartbeat, name="heartbeat")
+
+        heartbeat()
+
+    def live(self):
+        """
+        Returns:
+            list: Reasons the process is not alive, empty if it is
+        """
+        problems = []
+        heartbeat_age = self.clock() - self.last_heartbeat
+        if heartbeat_age > self.max_heartbeat_age:
+            problems.append(f"scheduler has not run a task for {heartbeat_age:.0f}s")
+        if not self.scrobble_worker.is_alive():
+            problems.append("scrobble worker has stopped")
+        return problems
+
+    def ready(self):
+        """
+        Returns:
+            list: Reasons the scrobbler is not ready, empty if it is
+        """
+        problems = self.live()
+        for station in self.stations:
+            if not station.is_ready(self.max_poll_age):
+                problems.append(
+                    f"station {station.name} has not reached Spinitron in the last {self.max_poll_age}s"
+                )
+        return problems
+
+
+class StatusServer(ThreadingHTTPServer):
+    """
+    HTTP server for the metrics and health routes, run on a daemon thread
+    """
+
+    daemon_threads = True
+
+    # Pushes are a few hundred bytes; anything much larger is not from Spinitron
+    max_push_size = 64 * 1024
+
+    def __init__(self, address, health, render_metrics, push_receiver=None):
+        """
+        Args:
+            address (tuple): Host and port to listen on
+            health (Health): The health checks
+            render_metrics (callable): Function returning the metrics in Prometheus text format
+            push_receiver (push.PushReceiver, optional): Receiver for Spinitron's metadata
+                push. /push is only served when one is given
+        """
+        super().__init__(address, _StatusHandler)
+        self.health = health
+        self.render_metrics = render_metrics
+        self.push_receiver = push_receiver
+
+    def start(self):
+        """
+        Starts serving on a daemon thread
+        """
+        threading.Thread(
+            target=self.serve_forever, name="status-server", daemon=True
+        ).start()
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path
+        if self._is_push(path):
+            self._respond_push(path, parts.query)
+        elif path == "/metrics":
+            self._respond(
+                200,
+                self.server.render_metrics(),
+                "text/plain; version=0.0.4; charset=utf-8",
+            )
+        elif path == "/healthz":
+            self._respond_health(self.server.health.live())
+        elif path == "/readyz":
+            self._respond_health(self.server.health.ready())
+        else:
+            self._respond(404, "Not found\n")
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if not self._is_push(parts.path):
+            self._respond(404, "Not found\n")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.server.max_push_size:
+            self._respond(413, "Push too large\n")
+            return
+        body = self.rfile.read(length)
+        try:
+            fields = decode_body(body, self.headers.get("Content-Type"))
+        except PushError as e:
+            self._respond(400, f"{e}\n")
+            return
+        self._respond_push(parts.path, parts.query, fields)
+
+    def _is_push(self, path):
+        return self.server.push_receiver is not None and (
+            path == "/push" or path.startswith("/push/")
+        )
+
+    def _respond_push(self, path, query, fields=None):
+        params = {key: values[0] for key, values in parse_qs(query).items()}
+        params.update(fields or {})
+        status, message = self.server.push_receiver.handle(path, params, self.headers)
+        self._respond(status, message + "\n")
+
+    def _respond_health(self, problems):
+        if problems:
+            self._respond(503, "\n".join(problems) + "\n")
+        else:
+            self._respond(200, "ok\n")
+
+    def _respond(self, status, body, content_type="text/plain; charset=utf-8"):
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Scrapes and health checks would flood the logs
+        pass
+
+
+class Watchdog(threading.Thread):
+    """
+    Exits the process when the liveness check fails, so that the container is restarted
+    """
+
+    def __init__(self, health, interval=30):
+        """
+        Args:
+            health (Health): The health checks
+            interval (float, optional): Seconds between checks
+        """
+        super().__init__(name="watchdog", daemon=True)
+        self.health = health
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            problems = self.health.live()
+            if problems:
+                log.critical(
+                    "WATCHDOG: %s. Exiting so the container is restarted...",
+                    "; ".join(problems),
+                )
+                stop_logging()
+                os._exit(1)